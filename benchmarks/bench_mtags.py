@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+"""
+Times reading and writing M-TAGS files with every installed JSON backend.
+
+Usage: python -m benchmarks.bench_mtags [--repeat N] [TAGSFILE ...]
+
+With no tags files given, a synthetic one the size of a large box set is
+generated. Point it at the biggest tags files in your library for real numbers.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import timeit
+
+from euphonogenizer import mtags
+
+
+def make_synthetic_tracks(count):
+  tracks = []
+  for n in range(count):
+    tracks.append({
+        '@': '%04d. Track number %d.flac' % (n + 1, n + 1),
+        'ALBUM': 'The Complete Recordings (Disc %d)' % (n // 20 + 1),
+        'ALBUM ARTIST': 'Various Artists',
+        'ARTIST': 'Performer %d' % (n % 37),
+        'COMMENT': 'Ripped with EAC — secure mode, test & copy',
+        'DATE': '19%02d' % (n % 100),
+        'DISCNUMBER': str(n // 20 + 1),
+        'GENRE': ['Jazz', 'Vocal'] if n % 3 else 'Jazz',
+        'REPLAYGAIN_TRACK_GAIN': '-%d.%02d dB' % (n % 12, n % 100),
+        'REPLAYGAIN_TRACK_PEAK': '0.%06d' % (n * 7919 % 1000000),
+        'TITLE': 'Track number %d' % (n + 1),
+        'TOTALDISCS': str(count // 20 + 1),
+        'TRACKNUMBER': '%02d' % (n % 20 + 1),
+    })
+  return tracks
+
+def available_backends():
+  backends = []
+  for name in mtags.json_backend_preference:
+    try:
+      mtags.json_backend_loaders[name]()
+      backends.append(name)
+    except ImportError:
+      pass
+  return backends
+
+def bench_file(filename, backends, repeat, scratch):
+  size = os.path.getsize(filename)
+  print('%s (%d bytes)' % (filename, size))
+
+  written = {}
+
+  for name in backends:
+    mtags.set_json_backend(name)
+    tags = mtags.TagsFile(filename)
+    out = os.path.join(scratch, name + '.tags')
+
+    read = min(timeit.repeat(
+        lambda: mtags.TagsFile(filename), number=1, repeat=repeat))
+    write = min(timeit.repeat(
+        lambda: tags.write(out), number=1, repeat=repeat))
+
+    with open(out, 'rb') as f:
+      written[name] = f.read()
+
+    print('  %-12s read %8.2f ms   write %8.2f ms   (%d tracks)' % (
+        name, read * 1000, write * 1000, len(tags.tracks)))
+
+  if len(set(written.values())) > 1:
+    print('  WARNING: backends did not write identical bytes!')
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark M-TAGS reading.')
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--tracks', type=int, default=5000,
+      help='number of tracks in the synthetic tags file')
+  parser.add_argument('tagsfiles', nargs='*')
+  args = parser.parse_args()
+
+  backends = available_backends()
+  scratch = tempfile.mkdtemp()
+
+  try:
+    tagsfiles = args.tagsfiles
+    if not tagsfiles:
+      synthetic = os.path.join(scratch, 'synthetic.tags')
+      mtags.TagsFile(make_synthetic_tracks(args.tracks)).write(synthetic)
+      tagsfiles = [synthetic]
+
+    for each in tagsfiles:
+      bench_file(each, backends, args.repeat, scratch)
+  finally:
+    shutil.rmtree(scratch)
+    mtags.set_json_backend()
+
+if __name__ == '__main__':
+  main()
@@ -19,19 +19,33 @@ class AlbumArtNotImplementedException(Exception):
   pass
 
 def embed(cover, target):
+  """
+  Embeds cover as the only picture in target, returning False if it already
+  was, in which case nothing is changed.
+  """
   if is_mutagen_file(target):
-    embed_file(cover, uneasy(target))
+    return embed_file(cover, uneasy(target))
   else:
     mutagen_file = File(target, easy=False)
-    embed_file(cover, mutagen_file)
-    mutagen_file.save()
+    changed = embed_file(cover, mutagen_file)
+    if changed:
+      mutagen_file.save()
+    return changed
+
+def read_cover(cover):
+  with open(cover, 'rb') as f:
+    return f.read()
 
 def embed_to_flac(cover, cover_image, flac_file):
+  data = read_cover(cover)
+  pictures = flac_file.pictures
+  if (len(pictures) == 1 and pictures[0].type == PictureType.COVER_FRONT
+      and pictures[0].data == data):
+    return False
+
   flac_file.clear_pictures()
   pic = Picture()
-
-  with open(cover, 'rb') as f:
-    pic.data = f.read()
+  pic.data = data
 
   pic.type = PictureType.COVER_FRONT
   pic.mime = img_mime[cover_image.format.lower()]
@@ -39,18 +53,25 @@ def embed_to_flac(cover, cover_image, flac_file):
   pic.depth = img_bpp[cover_image.mode]
 
   flac_file.add_picture(pic)
+  return True
 
 def embed_to_mp3(cover, cover_image, mp3_file):
+  data = read_cover(cover)
+  pictures = mp3_file.tags.getall('APIC')
+  if (len(pictures) == 1 and pictures[0].type == PictureType.COVER_FRONT
+      and pictures[0].data == data):
+    return False
+
   mp3_file.tags.delall('APIC')
 
-  with open(cover, 'rb') as f:
-    apic = APIC(
-        encoding = Encoding.UTF8,
-        mime = img_mime[cover_image.format.lower()],
-        type = PictureType.COVER_FRONT,
-        data = f.read())
+  apic = APIC(
+      encoding = Encoding.UTF8,
+      mime = img_mime[cover_image.format.lower()],
+      type = PictureType.COVER_FRONT,
+      data = data)
 
-    mp3_file.tags.add(apic)
+  mp3_file.tags.add(apic)
+  return True
 
 def embed_to_mp4(cover, cover_image, mp4_file):
   raise AlbumArtNotImplementedException(
@@ -66,7 +87,7 @@ embed_callbacks = {
 def embed_file(cover, mutagen_file):
   class_name = mutagen_file.__class__.__name__
   try:
-    embed_using_image(
+    return embed_using_image(
         cover, mutagen_file, embed_callbacks[class_name])
   except KeyError:
     raise AlbumArtUnsupportedException(
@@ -5,6 +5,7 @@ import argparse
 import os
 
 from .common import progname
+from .shard import parse_shard
 
 desc = '''
 Manages music libraries with metadata in M-TAGS format.
@@ -112,6 +113,76 @@ shared_cmd_parser.add_argument('--limit',
     metavar='INT',
 )
 
+shared_cmd_parser.add_argument('--jobs',
+    default=1,
+    help='number of processes used to read tags files in parallel',
+    type=int,
+    metavar='INT',
+)
+
+walk_parser = argparse.ArgumentParser(add_help=False)
+
+walk_parser.add_argument('--exclude',
+    action='append',
+    help='skip files and directories matching this glob (may be repeated)',
+    metavar='GLOB',
+)
+
+walk_parser.add_argument('--max-depth',
+    default=None,
+    dest='max_depth',
+    help='descend at most this many directories below the current one',
+    type=int,
+    metavar='INT',
+)
+
+walk_parser.add_argument('--skip-hidden',
+    action='store_true',
+    dest='skip_hidden',
+    help="don't descend into hidden directories",
+)
+walk_parser.set_defaults(skip_hidden=False)
+
+def Shard(value):
+  try:
+    return parse_shard(value)
+  except ValueError as e:
+    raise argparse.ArgumentTypeError(str(e))
+
+
+shard_parser = argparse.ArgumentParser(add_help=False)
+
+shard_parser.add_argument('--shard',
+    default=None,
+    help='only process the directories in shard K of N (as in 1/4)',
+    type=Shard,
+    metavar='K/N',
+)
+
+mergeable_parser = argparse.ArgumentParser(add_help=False)
+
+mergeable_parser.add_argument('--mergeable',
+    action='store_true',
+    default=False,
+    help='with --shard, write records that the merge command can combine',
+)
+
+index_parser = argparse.ArgumentParser(add_help=False)
+
+index_parser.add_argument('--index-file',
+    default='.euphonogenizer.db',
+    dest='index_file',
+    help='the library index database to use (.euphonogenizer.db)',
+    metavar='FILE',
+)
+
+index_parser.add_argument('--socket',
+    default='.euphonogenizer.sock',
+    dest='socket',
+    help='the socket the watch daemon listens on (.euphonogenizer.sock)',
+    metavar='PATH',
+)
+
 quiet_parser = argparse.ArgumentParser(add_help=False)
 
 quiet_parser.add_argument('-q', '--quiet',
@@ -148,12 +219,12 @@ cover_group.add_argument('--include-covers-aggressive',
 
 cover_group.set_defaults(include_covers=False)
 
-cover_group.add_argument('--per-track-cover-search',
+cover_parser.add_argument('--per-track-cover-search',
     action='store_true',
     dest='per_track_cover_search',
-    help='aggressively search each track for cover art (EXTREMELY SLOW!)',
+    help='search for cover art for each track, not just once per directory',
 )
-cover_group.set_defaults(per_track_cover_search=False)
+cover_parser.set_defaults(per_track_cover_search=False)
 
 embed_cover_parser = argparse.ArgumentParser(
         add_help=False, parents=[cover_parser])
@@ -201,7 +272,8 @@ filter_group.add_argument('--contains',
     metavar='PATTERN',
 )
 
-list_or_count_parser = argparse.ArgumentParser(add_help=False)
+list_or_count_parser = argparse.ArgumentParser(
+        add_help=False, parents=[index_parser])
 
 list_or_count_parser.add_argument('--display',
     default='%artist% - %title%',
@@ -209,15 +281,47 @@ list_or_count_parser.add_argument('--display',
     metavar='PATTERN',
 )
 
+source_group = list_or_count_parser.add_mutually_exclusive_group()
+
+source_group.add_argument('--from-index',
+    action='store_true',
+    default=False,
+    dest='from_index',
+    help="read tracks from the library index instead of the tags files",
+)
+
+source_group.add_argument('--from-daemon',
+    action='store_true',
+    default=False,
+    dest='from_daemon',
+    help='ask the running watch daemon for tracks instead of walking',
+)
+
+list_or_count_parser.add_argument('--output',
+    default=None,
+    dest='output',
+    help='write the output to FILE (as UTF-8) instead of standard output',
+    metavar='FILE',
+)
+
 list_or_count_parser.add_argument('--unique',
     action='store_true',
     default=False,
     help='only print or count each uniquely formatted line once',
 )
 
+list_or_count_parser.add_argument('--unique-memory',
+    default=64,
+    dest='unique_memory',
+    help='MiB of memory --unique may use before spilling to disk (default: 64)',
+    type=int,
+    metavar='MiB',
+)
+
 copy_cmd_parser=cmd_parser.add_parser('copy',
     help='copy all referenced files found in metadata',
-    parents=[shared_cmd_parser, quiet_parser, embed_cover_parser],
+    parents=[shared_cmd_parser, walk_parser, shard_parser, quiet_parser,
+        embed_cover_parser],
 )
 
 copy_cmd_parser.add_argument('--to',
@@ -226,6 +330,26 @@ copy_cmd_parser.add_argument('--to',
     metavar='PATTERN',
 )
 
+copy_cmd_parser.add_argument('--io-jobs',
+    default=1,
+    dest='io_jobs',
+    help='number of threads copying files while --jobs processes write tags',
+    type=int,
+    metavar='N',
+)
+
+copy_cmd_parser.add_argument('--link',
+    choices=['hard', 'sym'],
+    default=None,
+    help='link to the original files instead, unless they would be modified',
+)
+
+copy_cmd_parser.add_argument('--manifest',
+    action='store_true',
+    default=False,
+    help='keep a manifest at the destination root so reruns skip what is done',
+)
+
 copy_cmd_parser.add_argument('--dry-run',
     action='store_true',
     dest='dry_run',
@@ -261,6 +385,14 @@ copy_cmd_parser.add_argument('--even-if-readonly',
 )
 copy_cmd_parser.set_defaults(even_if_readonly=False)
 
+copy_cmd_parser.add_argument('--padding',
+    default=None,
+    dest='padding',
+    help='bytes to leave for tags to grow into when a file has to be rewritten',
+    type=int,
+    metavar='BYTES',
+)
+
 copy_cmd_parser.add_argument('--progress',
     action='store_true',
     dest='progress',
@@ -284,7 +416,8 @@ copy_cmd_parser.set_defaults(skip_cue=True)
 
 findcovers_cmd_parser = cmd_parser.add_parser('findcovers',
     help='find covers for tracks based on patterns',
-    parents=[shared_cmd_parser, cover_parser, filter_parser],
+    parents=[shared_cmd_parser, walk_parser, shard_parser, cover_parser,
+        filter_parser],
 )
 
 findcovers_cmd_parser.add_argument('--filter-value',
@@ -302,7 +435,44 @@ findcovers_cmd_parser.set_defaults(explain=False)
 
 list_cmd_parser = cmd_parser.add_parser('list',
     help='print out all found tracks',
-    parents=[shared_cmd_parser, filter_parser, list_or_count_parser],
+    parents=[shared_cmd_parser, walk_parser, shard_parser, filter_parser,
+        list_or_count_parser, mergeable_parser],
+)
+
+list_cmd_parser.add_argument('--format',
+    default='text',
+    choices=['text', 'jsonl', 'csv', 'tsv'],
+    help='print formatted lines (text), or a row of --column values per track',
+)
+
+list_cmd_parser.add_argument('--column',
+    action='append',
+    help='a named column for --format, like album=%%album%% (may be repeated)',
+    metavar='NAME=PATTERN',
+)
+
+list_cmd_parser.add_argument('--sort-by',
+    action='append',
+    dest='sort_by',
+    help='sort the output by this pattern (may be repeated)',
+    type=lambda pattern: (pattern, False),
+    metavar='PATTERN',
+)
+
+list_cmd_parser.add_argument('--sort-by-descending',
+    action='append',
+    dest='sort_by',
+    help='like --sort-by, but sort by this pattern in descending order',
+    type=lambda pattern: (pattern, True),
+    metavar='PATTERN',
+)
+
+list_cmd_parser.add_argument('--sort-memory',
+    default=64,
+    dest='sort_memory',
+    help='MiB of memory --sort-by may use before sorting on disk (default: 64)',
+    type=int,
+    metavar='MiB',
 )
 
 list_cmd_parser.add_argument('--groupby',
@@ -318,6 +488,21 @@ list_cmd_parser.add_argument('--groupby-indent',
     metavar='INT',
 )
 
+list_cmd_parser.add_argument('--groupby-per-dir',
+    action='store_true',
+    dest='groupby_per_dir',
+    help='print groups after each directory (when no group spans directories)',
+)
+list_cmd_parser.set_defaults(groupby_per_dir=False)
+
+list_cmd_parser.add_argument('--groupby-memory',
+    default=64,
+    dest='groupby_memory',
+    help='MiB of memory --groupby may use before sorting on disk (default: 64)',
+    type=int,
+    metavar='MiB',
+)
+
 list_cmd_parser.add_argument('--group-startswith',
     action=RequireOtherArgument('groupby'),
     help='display only output whose group starts with the specified pattern',
@@ -326,12 +511,98 @@ list_cmd_parser.add_argument('--group-startswith',
 
 count_cmd_parser = cmd_parser.add_parser('count',
     help='like "list", but count the number of displayed tracks',
-    parents=[shared_cmd_parser, filter_parser, list_or_count_parser],
+    parents=[shared_cmd_parser, walk_parser, shard_parser, filter_parser,
+        list_or_count_parser, mergeable_parser],
+)
+
+stats_cmd_parser = cmd_parser.add_parser('stats',
+    help='count tracks, distinct values and totals, optionally by group',
+    parents=[shared_cmd_parser, walk_parser, filter_parser,
+        list_or_count_parser],
+)
+
+stats_cmd_parser.add_argument('--groupby',
+    default=False,
+    help='compute separate statistics for each group matching this pattern',
+    metavar='PATTERN',
+)
+
+stats_cmd_parser.add_argument('--groupby-indent',
+    default=2,
+    help='number of spaces to use for indent when printing grouped items',
+    type=int,
+    metavar='INT',
+)
+
+stats_cmd_parser.add_argument('--group-startswith',
+    action=RequireOtherArgument('groupby'),
+    help='only include groups that start with the specified pattern',
+    metavar='PATTERN',
+)
+
+stats_cmd_parser.add_argument('--distinct',
+    action='append',
+    help='count the distinct values of this pattern (may be repeated)',
+    metavar='PATTERN',
+)
+
+stats_cmd_parser.add_argument('--sum',
+    action='append',
+    help='add up the numeric values of this pattern (may be repeated)',
+    metavar='PATTERN',
+)
+
+stats_cmd_parser.add_argument('--format',
+    default='text',
+    choices=['text', 'jsonl', 'csv', 'tsv'],
+    help='print the statistics as text, or as a row per group',
 )
 
 generate_cmd_parser = cmd_parser.add_parser('generate',
     help='create new M-TAGS files based on existing metadata',
-    parents=[quiet_parser],
+    parents=[walk_parser, shard_parser, quiet_parser],
+)
+
+index_cmd_parser = cmd_parser.add_parser('index',
+    help='build or refresh the library index used by --from-index',
+    parents=[walk_parser, quiet_parser, index_parser],
+)
+
+index_cmd_parser.add_argument('--rebuild',
+    action='store_true',
+    dest='rebuild',
+    help='read every tags file again instead of only the changed ones',
+)
+index_cmd_parser.set_defaults(rebuild=False)
+
+merge_cmd_parser = cmd_parser.add_parser('merge',
+    help='combine the output of list or count runs with --shard --mergeable',
+)
+
+merge_cmd_parser.add_argument('files',
+    nargs='+',
+    help='the output of every shard',
+    metavar='FILE',
+)
+
+merge_cmd_parser.add_argument('--output',
+    default=None,
+    dest='output',
+    help='write the output to FILE (as UTF-8) instead of standard output',
+    metavar='FILE',
+)
+
+watch_cmd_parser = cmd_parser.add_parser('watch',
+    help='keep the library index up to date and answer --from-daemon queries',
+    parents=[walk_parser, quiet_parser, index_parser],
+)
+
+watch_cmd_parser.add_argument('--poll',
+    default=None,
+    dest='poll',
+    help='look for changes every SECONDS instead of using inotify',
+    type=float,
+    metavar='SECONDS',
 )
 
 parser.add_argument('--tagsfile',
@@ -353,3 +624,9 @@ parser.add_argument('--disable-magic',
 )
 parser.set_defaults(magic=True)
 
+
+parser.add_argument('--json-backend',
+    default='auto',
+    choices=['auto', 'orjson', 'simplejson', 'json'],
+    help='JSON library used to read and write tags files (default: fastest)',
+)
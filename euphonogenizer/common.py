@@ -3,6 +3,7 @@
 
 from __future__ import print_function
 
+import atexit
 import os
 import stat
 import sys
@@ -29,23 +30,107 @@ def unicwd():
     return eval('os.getcwdu()')
   return os.getcwd()
 
+class OutputSink(object):
+  """
+  Writes lines to a stream, encoding them once with the stream's encoding and
+  collecting the bytes in a buffer that's written out when it gets big. When
+  the stream is a terminal, every line goes out right away instead, so that
+  interactive output (like --progress) still shows up as it happens.
+  """
+
+  buffer_size = 1 << 16
+
+  def __init__(self, stream=None, encoding=None, interactive=None):
+    # Without a stream of its own, the sink writes to whatever stdout is.
+    self.follows_stdout = stream is None
+    if stream is None:
+      stream = sys.stdout
+
+    self.stream = stream
+    self.raw = getattr(stream, 'buffer', None)
+    if self.raw is None and 'b' in getattr(stream, 'mode', ''):
+      self.raw = stream
+
+    self.encoding = encoding or getattr(stream, 'encoding', None) or 'ascii'
+
+    if interactive is None:
+      try:
+        interactive = stream.isatty()
+      except (AttributeError, ValueError):
+        interactive = False
+    self.interactive = interactive
+
+    self.chunks = []
+    self.size = 0
+
+  def write(self, message, end=None):
+    if end is None:
+      end = os.linesep
+
+    if self.raw is None:
+      # Nothing to write bytes to (e.g. colorama has wrapped stdout), so let
+      # the stream do its own encoding.
+      self.flush()
+      self.stream.write(message + end)
+      if self.interactive:
+        self.stream.flush()
+      return
+
+    data = (message + end).encode(self.encoding, 'replace')
+    self.chunks.append(data)
+    self.size += len(data)
+
+    if self.interactive or self.size >= self.buffer_size:
+      self.flush()
+
+  def flush(self):
+    if self.chunks:
+      chunks, self.chunks = self.chunks, []
+      self.size = 0
+      if self.raw is not self.stream:
+        # Anything already written to the text layer has to go out first.
+        self.stream.flush()
+      self.raw.write(b''.join(chunks))
+    if self.raw is not None:
+      self.raw.flush()
+
+  def close(self):
+    self.flush()
+    if not self.follows_stdout:
+      self.stream.close()
+
+
+_output = None
+
+def set_output(sink):
+  """
+  Sends everything printed with uniprint to sink instead of stdout, or back to
+  stdout if sink is None. The previous sink is flushed, and closed if it was
+  writing to a file of its own.
+  """
+  global _output
+  if _output is not None:
+    _output.close()
+  _output = sink
+
+def get_output():
+  global _output
+  # Follow stdout around if somebody replaces it, like pytest does.
+  if _output is None or (
+      _output.follows_stdout and _output.stream is not sys.stdout):
+    if _output is not None:
+      _output.flush()
+    _output = OutputSink()
+  return _output
+
+def flush_output():
+  if _output is not None:
+    _output.flush()
+
+atexit.register(flush_output)
+
 def uniprint(message, end=None):
-  if end is None:
-    end = os.linesep
-
-  if sys.stdout.encoding:
-    try:
-      sys.stdout.buffer.write(
-          message.encode(sys.stdout.encoding, errors='replace'))
-      print('', end=end)
-    except AttributeError:
-      print(message.encode(sys.stdout.encoding, errors='replace'), end=end)
-  else:
-    try:
-      sys.stdout.buffer.write(message.encode('ascii', errors='replace'))
-      print('', end=end)
-    except AttributeError:
-      print(message.encode('ascii', errors='replace'), end=end)
+  get_output().write(message, end)
 
 def unistr(s):
   if sys.version_info[0] < 3:
@@ -4,10 +4,11 @@
 
 from __future__ import print_function
 
+import argparse
 import glob
 import os
 import re
-import shutil
+import signal
 import stat
 import sys
 
@@ -15,22 +16,36 @@ import colorama
 import colorama.ansi
 
 from . import albumart
+from . import fastcopy
+from . import grouping
+from . import index
+from . import manifest
 from . import mtags
+from . import parallel
+from . import rows
+from . import shard
+from . import stats
 from . import terminalsize
 from . import titleformat
+from . import unique
+from . import walk
+from . import watch
 
 from .args import parser, EmbedCoversArg
-from .common import (compat_iteritems, dbg, err, progname, unicwd, uniprint,
-                     unistr, write_with_override)
-from .tagext import is_mutagen_file
+from .common import (compat_iteritems, dbg, err, progname, set_output, unicwd,
+                     uniprint, unistr, write_with_override, OutputSink)
+from .tagext import id3_frames, is_mutagen_file
 
 from mutagen import File
+from mutagen._vorbis import VComment
+from mutagen.asf import ASF
 from mutagen.flac import FLAC
 from mutagen.id3 import ID3FileType
-from mutagen.easyid3 import EasyID3FileType
+from mutagen.easyid3 import EasyID3, EasyID3FileType
 from mutagen.easymp4 import EasyMP4
 from mutagen.mp3 import EasyMP3, MP3
 from mutagen.mp4 import MP4
+from mutagen.ogg import OggFileType
 from mutagen.trueaudio import EasyTrueAudio
 from mutagen.trueaudio import TrueAudio
 from mutagen._compat import iteritems
@@ -42,6 +57,11 @@ escape_glob_dict = {
 
 escape_glob_rc = re.compile('|'.join(map(re.escape, escape_glob_dict)))
 
+single_variable_pattern = re.compile(r'^%[^%]+%$')
+
+# Bytes left after the tags for them to grow into when a file is rewritten.
+default_padding = 8192
+
 
 def escape_glob(path):
   return escape_glob_rc.sub(lambda m: escape_glob_dict[m.group(0)], path)
@@ -90,10 +110,26 @@ class DefaultConfigurable(object):
 class PrintHandler(DefaultConfigurable):
   def __init__(self, args, titleformatter, fileformatter):
     super(PrintHandler, self).__init__(args, titleformatter, fileformatter)
-    self._unique_output = set()
-    self._groupby_output = {}
     self.progress = args and hasattr(args, 'progress') and args.progress
     self.unique = args and hasattr(args, 'unique') and args.unique
+    self.groupby_per_dir = (
+        hasattr(args, 'groupby_per_dir') and args.groupby_per_dir)
+    self.printed_group = False
+
+    max_memory = None
+    if hasattr(args, 'unique_memory') and args.unique_memory is not None:
+      max_memory = args.unique_memory * 1024 * 1024
+    self._unique_output = unique.UniqueKeyStore(max_memory)
+
+    max_memory = None
+    if hasattr(args, 'groupby_memory') and args.groupby_memory is not None:
+      max_memory = args.groupby_memory * 1024 * 1024
+    self._groupby_output = grouping.GroupedOutput(max_memory)
+
+    max_memory = None
+    if hasattr(args, 'sort_memory') and args.sort_memory is not None:
+      max_memory = args.sort_memory * 1024 * 1024
+    self._sorted_output = grouping.ExternalSorter(max_memory)
 
     self.last_jump = 0
     self.init_ansi()
@@ -106,6 +142,10 @@ class PrintHandler(DefaultConfigurable):
   def groupby_output(self):
     return self._groupby_output
 
+  @property
+  def sorted_output(self):
+    return self._sorted_output
+
   def init_ansi(self):
     if self.progress:
       colorama.init()
@@ -121,38 +161,53 @@ class PrintHandler(DefaultConfigurable):
 
   def handle_group_uniprint(self, output, group):
     if group:
-      if group not in self.groupby_output:
-        self.groupby_output[group] = [output]
-      else:
-        self.groupby_output[group].append(output)
+      self.groupby_output.add(group, output)
     else:
       uniprint(output)
 
-  def print_or_defer_output(self, output, group=None):
-    if self.unique:
-      unique_key = output
-      if group is not None:
-        # Unique only applies within groups -- this is to prevent unexpected
-        # behavior when output lines have the same output but are in different
-        # groups (for example, when two tracks have the same name but are on
-        # differently named albums).
-        unique_key = group + output
-      if unique_key not in self.unique_output:
-        self.unique_output.add(unique_key)
-        self.handle_group_uniprint(output, group)
-    else:
+  def is_new_output(self, output, group=None):
+    if group is not None:
+      # Unique only applies within groups -- this is to prevent unexpected
+      # behavior when output lines have the same output but are in different
+      # groups (for example, when two tracks have the same name but are on
+      # differently named albums).
+      return self.unique_output.add(group, output)
+    return self.unique_output.add(output)
+
+  def handle_sorted_uniprint(self, output, group, sort_key):
+    if sort_key is None:
       self.handle_group_uniprint(output, group)
+    else:
+      size = len(output) + (len(group) if group else 0) + len(sort_key) * 32
+      self.sorted_output.add(sort_key, (output, group), size)
+
+  def print_or_defer_output(self, output, group=None, sort_key=None):
+    # Duplicates are dropped before sorting, so the first one found is kept.
+    if self.unique and not self.is_new_output(output, group):
+      return
+    self.handle_sorted_uniprint(output, group, sort_key)
 
   def print_deferred_output(self):
+    # Sorting comes before grouping, so groups come out in the order of their
+    # first line once sorted, and the lines in each group stay sorted.
+    for sort_key, (output, group) in self.sorted_output.drain():
+      self.handle_group_uniprint(output, group)
+
     if self.args and hasattr(self.args, 'groupby') and self.args.groupby:
-      first = True
-      for key in self.groupby_output:
-        if not first:
+      indent = ' ' * self.args.groupby_indent
+      for key, lines in self.groupby_output.groups():
+        if self.printed_group:
           uniprint('')
         uniprint(key + ':')
-        for each in self.groupby_output[key]:
-          uniprint(' ' * self.args.groupby_indent + each)
-        first = False
+        for each in lines:
+          uniprint(indent + each)
+        self.printed_group = True
+
+  def on_dir_done(self, dirpath):
+    if self.groupby_per_dir:
+      # Every group in this directory is complete, so there's no reason to
+      # hold on to them any longer.
+      self.print_deferred_output()
 
   def debug(self, text):
     if not self.progress:
@@ -170,11 +225,15 @@ class PrintHandler(DefaultConfigurable):
   def on_after_update(self):
     pass
 
-  def update_progress(self, done, total, plural_noun):
+  def update_progress(self, done, total, plural_noun, counting=False):
     if self.progress:
       self.on_before_update()
       s = self.jump_to_and_clear_progress()
-      s = s + self.get_completion_output(done, total, plural_noun) + os.linesep
+      if counting:
+        s = s + self.get_counting_output(done, total, plural_noun) + os.linesep
+      else:
+        s = s + self.get_completion_output(done, total, plural_noun)
+        s = s + os.linesep
       self.last_jump = self.last_jump - 1
       s = s + self.undo_last_jump()
       uniprint(s, end='')
@@ -209,8 +268,8 @@ class PrintHandler(DefaultConfigurable):
     self.on_after_update()
 
   def get_completion_output(self, done, total, plural_noun, sumtotal=None):
-    s = '%d of %d %s processed (%d%%' % (
-        done, total, plural_noun, done * 100 // total)
+    percent = done * 100 // total if total else 100
+    s = '%d of %d %s processed (%d%%' % (done, total, plural_noun, percent)
 
     if sumtotal is None:
       s = s + ')'
@@ -219,6 +278,10 @@ class PrintHandler(DefaultConfigurable):
 
     return s
 
+  def get_counting_output(self, done, found, plural_noun):
+    return '%d of %d+ %s processed (still counting...)' % (
+        done, found, plural_noun)
+
   def update_status(self, status=None, long_form=None):
     self.on_before_update()
 
@@ -312,16 +375,46 @@ class PrintHandler(DefaultConfigurable):
     return colorama.ansi.clear_line(0)
 
 
+class MergeableOutputHandler(PrintHandler):
+  """
+  Used with --shard and --mergeable. Instead of printing anything, collects
+  the lines each directory would print (after --unique, but before grouping)
+  into a record for the merge command, keyed by where the directory was in
+  the walk.
+  """
+
+  def __init__(self, args, titleformatter, fileformatter):
+    super(MergeableOutputHandler, self).__init__(
+        args, titleformatter, fileformatter)
+    self.dir_keys = {}
+    self.lines = []
+
+  def handle_sorted_uniprint(self, output, group, sort_key):
+    self.lines.append([group, output])
+
+  def on_dir_done(self, dirpath):
+    key = self.dir_keys.pop(dirpath, ())
+    if self.lines:
+      uniprint(shard.write_record({'key': list(key), 'lines': self.lines}))
+      self.lines = []
+
+  def print_deferred_output(self):
+    pass
+
+
 class DefaultPrintingConfigurable(DefaultConfigurable):
   def __init__(self, args, titleformatter, fileformatter, printer=None):
     super(DefaultPrintingConfigurable, self).__init__(
         args, titleformatter, fileformatter)
 
     if printer is None:
-      printer = PrintHandler(self.args, self.titleformatter, self.fileformatter)
+      printer = self.create_printer()
 
     self._printer = printer
 
+  def create_printer(self):
+    return PrintHandler(self.args, self.titleformatter, self.fileformatter)
+
   @property
   def printer(self):
     return self._printer
@@ -332,6 +425,14 @@ class CoverArtFinder(DefaultPrintingConfigurable):
     super(CoverArtFinder, self).__init__(
         args, titleformatter, fileformatter, printer)
     self._cover_dirs = set()
+    # These are kept across tracks, so searching each track (as with
+    # --per-track-cover-search) only formats and matches what's different
+    # about it. Both are bounded: only the most recent directories' listings
+    # and a limited number of answers per pattern are kept.
+    self.listings = walk.ListingCache()
+    self.cover_formatter = titleformat.MemoizingFormatter(self.titleformatter)
+    self.cover_name_formatter = titleformat.MemoizingFormatter(
+        self.fileformatter)
 
     self.include = hasattr(self.args, 'include_covers') and args.include_covers
     self.progress = hasattr(args, 'progress') and args.progress
@@ -340,6 +441,18 @@ class CoverArtFinder(DefaultPrintingConfigurable):
   def cover_dirs(self):
     return self._cover_dirs
 
+  def glob(self, cover_file):
+    """
+    Returns what glob.glob(escape_glob(cover_file)) would. Every pattern tried
+    for a directory usually looks in the same one or two places, so they're
+    matched against listings of those instead of each listing them again.
+    """
+    dirname, name = os.path.split(cover_file)
+    if not name or '*' in dirname or '?' in dirname:
+      # Wildcards in the directory part need a real glob.
+      return glob.glob(escape_glob(cover_file))
+    return self.listings.glob(dirname, escape_glob(name))
+
   def find_cover_art(self, dirname, track, dstpath=None, silent=False):
     if not self.include:
       # Just don't even bother.
@@ -355,8 +468,8 @@ class CoverArtFinder(DefaultPrintingConfigurable):
               'Finding cover art', ' for directory: ' + dirname)
       for each in self.args.include_covers:
         cover_file = os.path.join(
-            dirname, self.titleformatter.format(track, each))
-        cover_glob = glob.glob(escape_glob(cover_file))
+            dirname, self.cover_formatter.format(track, each))
+        cover_glob = self.glob(cover_file)
         if explain and not silent:
           uniprint("  attempting pattern '" + each + "'")
           uniprint('    ==> ' + cover_file)
@@ -366,7 +479,7 @@ class CoverArtFinder(DefaultPrintingConfigurable):
               uniprint('      %d: %s' % (n, each_glob))
           else:
             uniprint('    no matches')
-        if cover_glob and os.path.isfile(cover_glob[0]):
+        if cover_glob and self.listings.isfile(cover_glob[0]):
           found_cover = cover_glob[0]
           if not dstpath:
             retval = found_cover
@@ -376,7 +489,7 @@ class CoverArtFinder(DefaultPrintingConfigurable):
             cover_track = track.copy()
             cover_track['@'] = found_cover
             ext = found_cover.split('.')[-1]
-            dst = self.fileformatter.format(
+            dst = self.cover_name_formatter.format(
                 cover_track, self.args.cover_name) + '.' + ext
             dst = os.path.join(dstpath, dst)
             retval = (found_cover, dst)
@@ -437,6 +550,9 @@ class MutagenFileMetadataHandler(DefaultPrintingConfigurable):
       'TOTALTRACKS': 'TRACKTOTAL',
   }
 
+  # The types whose save() takes a padding callback.
+  padded_types = (ASF, FLAC, ID3FileType, MP4, OggFileType)
+
   def __init__(
       self, args=None, titleformatter=None, fileformatter=None, printer=None):
     super(MutagenFileMetadataHandler, self).__init__(
@@ -448,6 +564,14 @@ class MutagenFileMetadataHandler(DefaultPrintingConfigurable):
     tagext.configure_id3_ext()
 
     self.progress = hasattr(args, 'progress') and args.progress
+    self.padding = default_padding
+    if hasattr(args, 'padding') and args.padding is not None:
+      self.padding = args.padding
+
+    # How many files have had metadata saved, and how many of those had to be
+    # rewritten in full because their tags didn't fit.
+    self.writes = 0
+    self.rewrites = 0
 
   def handle_metadata(self, filename, mutagen_file, track, is_new_file, silent):
     if self.args.write_file_metadata:
@@ -480,60 +604,75 @@ class MutagenFileMetadataHandler(DefaultPrintingConfigurable):
           self.maybe_clear_existing_metadata(
               filename, mutagen_file, is_new_file)
 
-        complex_discnumber = None
-        complex_totaldiscs = None
-        complex_tracknumber = None
-        complex_totaltracks = None
-
-        for key, value in iteritems(track):
-          if key == '@':
-            continue
-
-          mutagen_key = self.marshal_mutagen_key(
-              mutagen_file, key, is_complex_type)
-
-          if is_complex_type:
-            if mutagen_key == 'discnumber':
-              complex_discnumber = value
-              continue
-            elif mutagen_key == 'totaldiscs':
-              complex_totaldiscs = value
-              continue
-            elif mutagen_key == 'tracknumber':
-              complex_tracknumber = value
-              continue
-            elif mutagen_key == 'totaltracks':
-              complex_totaltracks = value
-              continue
-
+        for mutagen_key, value in self.marshal_metadata(
+            mutagen_file, track, is_complex_type):
           mutagen_file[mutagen_key] = value
 
-        if is_complex_type:
-          if complex_totaldiscs:
-            if complex_discnumber:
-              complex_value = complex_discnumber + '/' + complex_totaldiscs
-              mutagen_file['discnumber'] = complex_value
-            else:
-              mutagen_file['totaldiscs'] = complex_totaldiscs
-          elif complex_discnumber:
-            mutagen_file['discnumber'] = complex_discnumber
-
-          if complex_totaltracks:
-            if complex_tracknumber:
-              complex_value = complex_tracknumber + '/' + complex_totaltracks
-              mutagen_file['tracknumber'] = complex_value
-            else:
-              mutagen_file['totaltracks'] = complex_totaltracks
-          elif complex_tracknumber:
-            mutagen_file['tracknumber'] = complex_tracknumber
-
-        if not self.args.dry_run and not is_new_instance:
+        # Otherwise, it's up to whoever passed in the file to save it.
+        if not self.args.dry_run and is_new_instance:
           self.handle_metadata_write(filename, mutagen_file, is_new_file)
       except UnwritableMetadataException:
         self.on_unwritable_metadata(filename)
 
     return changed
 
+  def marshal_metadata(self, mutagen_file, track, is_complex_type):
+    """
+    Returns the (mutagen key, value) pairs to write for a track, in the order
+    they should be written. Complex types get the track and disc numbers
+    combined with their totals, as in 3/12.
+    """
+    metadata = []
+
+    complex_discnumber = None
+    complex_totaldiscs = None
+    complex_tracknumber = None
+    complex_totaltracks = None
+
+    for key, value in iteritems(track):
+      if key == '@':
+        continue
+
+      mutagen_key = self.marshal_mutagen_key(
+          mutagen_file, key, is_complex_type)
+
+      if is_complex_type:
+        if mutagen_key == 'discnumber':
+          complex_discnumber = value
+          continue
+        elif mutagen_key == 'totaldiscs':
+          complex_totaldiscs = value
+          continue
+        elif mutagen_key == 'tracknumber':
+          complex_tracknumber = value
+          continue
+        elif mutagen_key == 'totaltracks':
+          complex_totaltracks = value
+          continue
+
+      metadata.append((mutagen_key, value))
+
+    if is_complex_type:
+      if complex_totaldiscs:
+        if complex_discnumber:
+          complex_value = complex_discnumber + '/' + complex_totaldiscs
+          metadata.append(('discnumber', complex_value))
+        else:
+          metadata.append(('totaldiscs', complex_totaldiscs))
+      elif complex_discnumber:
+        metadata.append(('discnumber', complex_discnumber))
+
+      if complex_totaltracks:
+        if complex_tracknumber:
+          complex_value = complex_tracknumber + '/' + complex_totaltracks
+          metadata.append(('tracknumber', complex_value))
+        else:
+          metadata.append(('totaltracks', complex_totaltracks))
+      elif complex_tracknumber:
+        metadata.append(('tracknumber', complex_tracknumber))
+
+    return metadata
+
   def on_unwritable_metadata(self, filename):
     if not self.args.quiet:
       if self.args.even_if_readonly:
@@ -560,10 +699,16 @@ class MutagenFileMetadataHandler(DefaultPrintingConfigurable):
       self.printer.update_last_file('Success!')
 
   def safe_handle_metadata_write(self, filename, mutagen_file, is_new_file):
+    """
+    Writes the metadata unless the file is readonly, returning whether it was
+    written.
+    """
     try:
       self.handle_metadata_write(filename, mutagen_file, is_new_file)
     except UnwritableMetadataException:
       self.on_unwritable_metadata(filename)
+      return False
+    return True
 
   @classmethod
   def marshal_mutagen_key(cls, mutagen_file, key, is_complex_type):
@@ -594,23 +739,36 @@ class MutagenFileMetadataHandler(DefaultPrintingConfigurable):
     return upperkey
 
   def safe_clear_metadata(self, mutagen_file):
+    """
+    Clears the tags in memory, leaving the file alone until it's saved. Using
+    delete() would write the file without its tags (and, for FLAC, without its
+    padding), so the save afterwards would have to rewrite the whole thing.
+    """
+    if mutagen_file.tags is None:
+      return
+
     # It might be the case that Mutagen fails to correctly initialize the file
     # object; if this is the case, we'll correct that for them (it's probably a
     # bug) and then erase the metadata anyway. This might be a Python 3 thing.
-    if isinstance(mutagen_file, FLAC) and mutagen_file.tags is not None:
+    if isinstance(mutagen_file, FLAC):
       if mutagen_file.tags not in mutagen_file.metadata_blocks:
         mutagen_file.metadata_blocks.append(mutagen_file.tags)
-    mutagen_file.delete()
+
+    if isinstance(mutagen_file.tags, VComment):
+      # FLAC and Ogg files always have their comments, so keep the same ones.
+      del mutagen_file.tags[:]
+    else:
+      # The easy interfaces can only clear what they know about, so start over
+      # with new tags altogether, just as delete() would have.
+      mutagen_file.tags = None
+      mutagen_file.add_tags()
 
   def maybe_clear_existing_metadata(self, filename, mutagen_file, is_new_file):
-    self.maybe_force_write(
-        filename, is_new_file, lambda: self.safe_clear_metadata(mutagen_file))
+    self.safe_clear_metadata(mutagen_file)
 
   def has_metadata_changed(self, mutagen_file, track, is_complex_type):
     if is_complex_type:
-      # If you're dealing with any of these complex types, it's wayyyy easier to
-      # simply just rewrite the metadata every single time. Just go to the disk.
-      return True
+      return self.has_complex_metadata_changed(mutagen_file, track)
 
     left_keys = mutagen_file.keys()
     right_keys = track.keys()
@@ -664,6 +822,31 @@ class MutagenFileMetadataHandler(DefaultPrintingConfigurable):
 
     return False
 
+  def has_complex_metadata_changed(self, mutagen_file, track):
+    """
+    Writes what marshal_metadata says to write into a fresh set of tags in
+    memory, and compares them with the file's tags through mutagen's easy
+    interface. Going through the same interface both ways means its quirks
+    (several keys for one frame, MP4 storing track numbers as integers, and so
+    on) show up on both sides. ID3 tags are compared frame by frame instead
+    (leaving out embedded cover art, which is handled separately), since the
+    easy interface can't see the fields it has no key for, like comments.
+    """
+    if mutagen_file.tags is None:
+      return True
+
+    try:
+      expected = type(mutagen_file.tags)()
+      for key, value in self.marshal_metadata(mutagen_file, track, True):
+        expected[key] = value
+    except (KeyError, TypeError, ValueError):
+      # Whatever it is, writing it is the only way to find out.
+      return True
+
+    if isinstance(expected, EasyID3):
+      return id3_frames(expected) != id3_frames(mutagen_file.tags)
+    return dict(expected) != dict(mutagen_file.tags)
+
   def on_existing_file_skipped(self):
     if not self.args.quiet:
       if hasattr(self.args, 'progress') and self.args.progress:
@@ -682,10 +865,40 @@ class MutagenFileMetadataHandler(DefaultPrintingConfigurable):
         self.printer.update_status('Writing metadata', ' for: ' + filename)
 
     self.maybe_force_write(
-        filename, is_new_file, lambda: mutagen_file.save(filename))
+        filename, is_new_file, lambda: self.save(filename, mutagen_file))
 
     return True
 
+  def save(self, filename, mutagen_file):
+    self.writes += 1
+    if isinstance(mutagen_file, self.padded_types):
+      mutagen_file.save(filename, padding=self.choose_padding)
+    else:
+      mutagen_file.save(filename)
+
+  def choose_padding(self, info):
+    """
+    Decides how much padding to leave after the tags (see mutagen's
+    PaddingInfo). If the tags fit in the space the old ones took up, the rest
+    stays padding and they're written in place. Otherwise, everything after
+    them has to move anyway, so --padding bytes are left for them to grow into
+    next time.
+    """
+    if info.padding >= 0:
+      return info.padding
+    self.rewrites += 1
+    return self.padding
+
+  def summary(self):
+    """
+    Describes how many files had metadata written and how many of those were
+    rewritten in full, or returns None if none did.
+    """
+    if not self.writes:
+      return None
+    return '%d %s tagged (%d rewritten in full)' % (
+        self.writes, 'file' if self.writes == 1 else 'files', self.rewrites)
+
   def maybe_force_write(self, filename, is_new_file, forced_write_closure):
     try:
       write_with_override(filename, forced_write_closure,
@@ -719,6 +932,30 @@ class AutomaticConfiguringCommand(DefaultPrintingConfigurable):
     super(AutomaticConfiguringCommand, self).__init__(
         args, titleformatter, fileformatter, printer)
 
+  def walk_options(self):
+    exclude = hasattr(self.args, 'exclude') and self.args.exclude or None
+    max_depth = None
+    if hasattr(self.args, 'max_depth'):
+      max_depth = self.args.max_depth
+    skip_hidden = hasattr(self.args, 'skip_hidden') and self.args.skip_hidden
+
+    return {
+        'exclude': walk.ExcludeRules(exclude),
+        'max_depth': max_depth,
+        'skip_hidden': skip_hidden,
+    }
+
+  def walk_library(self):
+    top = unicwd()
+    walker = walk.walk(top, **self.walk_options())
+
+    if hasattr(self.args, 'shard') and self.args.shard:
+      k, n = self.args.shard
+      keys = getattr(self.printer, 'dir_keys', None)
+      walker = shard.ShardFilter(walker, top, k, n, keys)
+
+    return walker
+
 
 class TrackCommand(AutomaticConfiguringCommand):
   def __init__(
@@ -729,7 +966,15 @@ class TrackCommand(AutomaticConfiguringCommand):
     self.quiet = hasattr(args, 'quiet') and args.quiet
     self.progress = hasattr(args, 'progress') and args.progress
     self.total_tags = 0
+    self.total_tags_known = False
     self.tags_done = 0
+    self._discovery = None
+    self.from_index = hasattr(args, 'from_index') and args.from_index
+    self.from_daemon = hasattr(args, 'from_daemon') and args.from_daemon
+    if hasattr(args, 'shard') and args.shard and (
+        self.from_index or self.from_daemon):
+      parser.error('--shard only works when walking the library')
+    self.jobs = (hasattr(args, 'jobs') and args.jobs) or 1
 
   @property
   def records_processed(self):
@@ -797,26 +1042,47 @@ class TrackCommand(AutomaticConfiguringCommand):
   def do_run(self):
     self._records_processed = 0
     visited_dirs = {}
-    tagsname = self.args.tagsfile
+
+    if self.from_index:
+      self.handle_all_indexed_tags(visited_dirs)
+      return visited_dirs
+    elif self.from_daemon:
+      self.handle_all_daemon_tags(visited_dirs)
+      return visited_dirs
+
+    all_tags = self.iter_all_tags(self.args.tagsfile)
 
     if self.progress:
-      v = {'s': 0}
-      self.handle_all_tags(
-          tagsname,
-          lambda dirpath, dirnames, filenames, all_tags:
-              self._setd(v, 's', v['s'] + len(all_tags)))
-      self.total_tags = v['s']
-      self.on_progress_count_complete()
-
-    self.handle_all_tags(
-        tagsname,
-        lambda dirpath, dirnames, filenames, all_tags:
-            self.handle_each_tag(dirpath, all_tags, visited_dirs))
+      # Rather than walking the whole tree once just to count the tags files,
+      # the walk runs in the background and processing starts right away. The
+      # total fills in as the walk goes along.
+      all_tags = self._discovery = parallel.BackgroundIterator(
+          all_tags, weigh=lambda dirpath_and_tags: len(dirpath_and_tags[1]))
+      self.on_progress_start()
+
+    if self.jobs > 1:
+      self.handle_all_tags_in_parallel(all_tags, visited_dirs)
+    else:
+      for dirpath, tagsfiles in all_tags:
+        self.handle_each_tag(dirpath, tagsfiles, visited_dirs)
+
+    if self._discovery is not None:
+      # The walk can finish after the last directory was taken from it, so
+      # nothing above would have noticed.
+      self.update_discovered_total()
+      self.on_progress_tag_done()
 
     return visited_dirs
 
-  def _setd(self, d, key, value):
-    d[key] = value
+  def update_discovered_total(self):
+    if self._discovery is not None and not self.total_tags_known:
+      self.total_tags = self._discovery.total
+      if self._discovery.done:
+        self.total_tags_known = True
+        self.on_progress_count_complete()
+
+  def on_progress_start(self):
+    pass
 
   def on_progress_count_complete(self):
     pass
@@ -824,18 +1090,79 @@ class TrackCommand(AutomaticConfiguringCommand):
   def on_progress_tag_done(self):
     pass
 
-  def handle_all_tags(self, tagsname, on_tags_found):
-    for dirpath, dirnames, filenames in os.walk(unicwd()):
-      all_tags = [each for each in filenames if each == tagsname]
-      on_tags_found(dirpath, dirnames, filenames, all_tags)
+  def iter_all_tags(self, tagsname):
+    """
+    Walks the working directory, yielding (dirpath, tagsfiles) for every
+    directory that has at least one tags file in it.
+    """
+    for dirpath, dirs, files in self.walk_library():
+      all_tags = [each.name for each in files if each.name == tagsname]
+      if all_tags:
+        yield dirpath, all_tags
+
+  def open_index(self):
+    try:
+      return index.LibraryIndex(self.args.index_file)
+    except index.IndexUnavailableException as e:
+      parser.error(unistr(e))
+
+  def handle_all_indexed_tags(self, visited_dirs):
+    library_index = self.open_index()
+    try:
+      for dirpath, all_tracks in self.iter_indexed_dirs(library_index):
+        self.handle_each_loaded_tag(
+            dirpath,
+            [mtags.TagsFile(tracks) for tracks in all_tracks],
+            visited_dirs)
+    finally:
+      library_index.close()
+
+  def iter_indexed_dirs(self, library_index):
+    return library_index.iter_dirs()
+
+  def handle_all_daemon_tags(self, visited_dirs):
+    try:
+      for dirpath, all_tracks in watch.query(
+          self.args.socket, {'query': 'tracks'}):
+        self.handle_each_loaded_tag(
+            dirpath,
+            [mtags.TagsFile(tracks) for tracks in all_tracks],
+            visited_dirs)
+    except watch.WatchUnavailableException as e:
+      parser.error(unistr(e))
+
+  def handle_all_tags_in_parallel(self, all_tags, visited_dirs):
+    pool = parallel.create_pool(self.jobs)
+    try:
+      # The walk itself happens in the pool's task feeder thread.
+      with parallel.OrderedPoolMap(
+          pool, self.jobs, parallel.load_tags, all_tags) as results:
+        for dirpath, all_tracks in results:
+          self.handle_each_loaded_tag(
+              dirpath,
+              [mtags.TagsFile(tracks) for tracks in all_tracks],
+              visited_dirs)
+    finally:
+      pool.terminate()
+      pool.join()
 
   def handle_each_tag(self, dirpath, all_tags, visited_dirs):
+    # Load lazily, so that each file is handled before the next one is read.
+    self.handle_each_loaded_tag(
+        dirpath,
+        (mtags.TagsFile(os.path.join(dirpath, tagsfile))
+            for tagsfile in all_tags),
+        visited_dirs)
+
+  def handle_each_loaded_tag(self, dirpath, loaded_tags, visited_dirs):
+    self.update_discovered_total()
     self.on_progress_tag_done()
-    for tagsfile in all_tags:
-      tags = mtags.TagsFile(os.path.join(dirpath, tagsfile))
+    for tags in loaded_tags:
       self.handle_tags(dirpath, tags, visited_dirs)
       self.tags_done = self.tags_done + 1
+      self.update_discovered_total()
       self.on_progress_tag_done()
+    self.printer.on_dir_done(dirpath)
 
   def process_record(self, visited_dirs, on_accounting_done):
     if self.args and self.records_processed == self.args.limit:
@@ -888,32 +1215,256 @@ class ListCommand(TrackCommand):
     super(ListCommand, self).__init__(
         args, titleformatter, fileformatter, printer)
     self.groupby = args and hasattr(args, 'groupby') and args.groupby
+    self.sort_by = hasattr(args, 'sort_by') and args.sort_by or []
+    self.mergeable = hasattr(args, 'mergeable') and args.mergeable
+    self.columns = None
+    self.row_writer = None
+
+    if self.mergeable:
+      if not args.shard:
+        parser.error('--mergeable needs --shard')
+      if args.limit >= 0:
+        parser.error("--limit can't be merged across shards")
+      if self.sort_by:
+        parser.error("--sort-by can't be merged across shards")
+
+    output_format = hasattr(args, 'format') and args.format or 'text'
+    if output_format != 'text':
+      self.row_writer = self.create_row_writer(output_format)
+    elif hasattr(args, 'column') and args.column:
+      parser.error('--column needs --format jsonl, csv or tsv')
+
+  def create_row_writer(self, output_format):
+    if self.groupby:
+      parser.error('--groupby only works with --format text')
+    self.columns = self.compile_columns(self.args.column)
+    return rows.create_writer(
+        output_format, [name for name, pattern, static in self.columns])
+
+  def compile_columns(self, column_specs):
+    """
+    Returns (name, pattern, static value) for each column, where the static
+    value is None unless the pattern doesn't depend on the track. Without any
+    columns, there's a single one named display with the --display pattern.
+    """
+    if not column_specs:
+      column_specs = ['display=' + self.args.display]
+
+    columns = []
+    for spec in column_specs:
+      try:
+        name, pattern = rows.parse_column(
+            spec, [each[0] for each in columns])
+      except ValueError as e:
+        parser.error(unistr(e))
+      static = pattern if self.is_static_pattern(pattern) else None
+      columns.append((name, pattern, static))
+    return columns
+
+  def format_columns(self, track, formatted):
+    values = []
+    for name, pattern, static in self.columns:
+      if static is not None:
+        values.append(static)
+      elif pattern == self.args.display:
+        values.append(formatted)
+      else:
+        values.append(self.titleformatter.format(track, pattern))
+    return values
+
+  def sort_key(self, track, formatted):
+    """
+    Formats each --sort-by pattern for the track, once, into a key that sorts
+    numbers by their value (as intify reads them) and then everything by text.
+    """
+    if not self.sort_by:
+      return None
+
+    key = []
+    for pattern, descending in self.sort_by:
+      if pattern == self.args.display:
+        value = formatted
+      else:
+        value = self.titleformatter.format(track, pattern)
+      part = (titleformat.intify(value), value)
+      key.append(grouping.Descending(part) if descending else part)
+    return tuple(key)
+
+  def create_printer(self):
+    if hasattr(self.args, 'mergeable') and self.args.mergeable:
+      return MergeableOutputHandler(
+          self.args, self.titleformatter, self.fileformatter)
+    return super(ListCommand, self).create_printer()
+
+  def merge_header(self):
+    """
+    Everything the merge command needs to know to put the output of every
+    shard back together, which also has to be the same for every shard.
+    """
+    header = None
+    if self.row_writer is not None:
+      header = self.row_writer.header()
+
+    return {
+        'cmd': self.args.cmd,
+        'shard': list(self.args.shard),
+        'unique': bool(self.printer.unique),
+        'unique_memory': self.args.unique_memory,
+        'groupby': self.groupby or None,
+        'groupby_indent': getattr(self.args, 'groupby_indent', 2),
+        'groupby_per_dir': bool(self.printer.groupby_per_dir),
+        'groupby_memory': getattr(self.args, 'groupby_memory', None),
+        'header': header,
+    }
+
+  def run(self):
+    if self.mergeable:
+      uniprint(shard.write_record(self.merge_header()))
+    elif self.row_writer is not None:
+      header = self.row_writer.header()
+      if header is not None:
+        uniprint(header)
+    return super(ListCommand, self).run()
+
+  def indexed_filter(self):
+    """
+    Returns the filter option and its value if the library index can find the
+    matching tracks by itself, or None if every track has to be checked. That
+    works when the display pattern is a single variable and the filter doesn't
+    depend on the track. --limit counts every track checked, not just the ones
+    that match, so it needs the full scan too.
+    """
+    if not single_variable_pattern.match(self.args.display):
+      return None
+    if self.args.limit >= 0:
+      return None
+
+    for operator in ('equals', 'startswith', 'contains'):
+      needle = getattr(self.args, operator)
+      if needle is not False and needle is not None:
+        if self.is_static_pattern(needle):
+          return operator, needle
+        return None
+
+    return None
+
+  def iter_indexed_dirs(self, library_index):
+    indexed_filter = self.indexed_filter()
+    if indexed_filter is None:
+      return library_index.iter_dirs()
+
+    # Formatting depends on these options too, so they're part of the key.
+    key = 'case_sensitive=%s magic=%s %s' % (
+        self.args.case_sensitive, self.args.magic, self.args.display)
+    library_index.update_field(
+        key, lambda track: self.titleformatter.format(track, self.args.display))
+
+    # The filter still runs on every track found, so the output is the same.
+    operator, needle = indexed_filter
+    return library_index.iter_dirs_where(key, operator, needle)
 
   def on_formatted_track_included(self, track, formatted, group, **kwargs):
-    self.printer.print_or_defer_output(formatted, group)
+    sort_key = self.sort_key(track, formatted)
+
+    if self.row_writer is None:
+      self.printer.print_or_defer_output(formatted, group, sort_key)
+      return
+
+    # All the columns are formatted in the same pass, and each row is written
+    # as soon as it's ready (unless it has to be sorted first).
+    values = self.format_columns(track, formatted)
+    if not self.printer.unique or self.printer.unique_output.add(*values):
+      self.printer.handle_sorted_uniprint(
+          self.row_writer.format_row(values), None, sort_key)
 
   def handle_formatted_track(self, track, formatted, **kwargs):
+    group = self.filter_formatted_track(track, formatted, **kwargs)
+    if group is not False:
+      self.on_formatted_track_included(track, formatted, group, **kwargs)
+
+  def filter_formatted_track(self, track, formatted, **kwargs):
+    """
+    Returns the track's group (None without --groupby) if it should be
+    included, or False if the filters leave it out.
+    """
     group = None
     if self.groupby:
       group = self.titleformatter.format(track, self.groupby)
       if not self.should_group_filter_include(group, track, **kwargs):
-        return
+        return False
     if self.should_filter_include(formatted, track, **kwargs):
-      self.on_formatted_track_included(track, formatted, group, **kwargs)
+      return group
+    return False
 
   def handle_track(self, track, **kwargs):
     formatted = self.titleformatter.format(track, self.args.display)
     self.handle_formatted_track(track, formatted, **kwargs)
 
-  def handle_tags(self, dirpath, tags, visited_dirs):
+  def track_params(self):
     track_params = {}
     self.precompute_static_filter_patterns(track_params)
     if self.groupby:
       self.precompute_static_group_filter_patterns(track_params)
+    return track_params
+
+  def handle_tags(self, dirpath, tags, visited_dirs):
+    track_params = self.track_params()
     for track in tags.tracks:
       self.process_record(
           visited_dirs, lambda: self.handle_track(track, **track_params))
 
+  def needs_included_tracks(self):
+    """
+    Returns whether on_formatted_track_included needs the track itself, rather
+    than just its formatted output and group.
+    """
+    return bool(self.row_writer or self.sort_by)
+
+  def format_all_tracks(self, tracks):
+    """
+    Formats and filters the tracks of one tags file, for the pool workers.
+    Returns an entry per track: None if it was filtered out, otherwise
+    (formatted, group, track), where track is None unless it's needed.
+    """
+    track_params = self.track_params()
+    keep_tracks = self.needs_included_tracks()
+    entries = []
+
+    for track in tracks:
+      formatted = self.titleformatter.format(track, self.args.display)
+      group = self.filter_formatted_track(track, formatted, **track_params)
+      if group is False:
+        entries.append(None)
+      else:
+        entries.append((formatted, group, track if keep_tracks else None))
+
+    return entries
+
+  def handle_all_tags_in_parallel(self, all_tags, visited_dirs):
+    # Tracks are formatted and filtered in the workers. Everything that
+    # depends on the order of the tracks (--limit, --unique, grouping and the
+    # output itself) still happens here, in walk order.
+    pool = parallel.create_pool(self.jobs, (
+        self.__class__, self.args, self.titleformatter, self.fileformatter))
+    try:
+      with parallel.OrderedPoolMap(
+          pool, self.jobs, parallel.format_tags, all_tags) as results:
+        for dirpath, all_entries in results:
+          for entries in all_entries:
+            for entry in entries:
+              self.process_record(
+                  visited_dirs, lambda: self.handle_entry(entry))
+            self.tags_done = self.tags_done + 1
+          self.printer.on_dir_done(dirpath)
+    finally:
+      pool.terminate()
+      pool.join()
+
+  def handle_entry(self, entry):
+    if entry is not None:
+      formatted, group, track = entry
+      self.on_formatted_track_included(track, formatted, group)
+
 
 class CountCommand(ListCommand):
   def __init__(
@@ -923,11 +1474,152 @@ class CountCommand(ListCommand):
     self.totalcount = 0
 
   def on_formatted_track_included(self, track, formatted, group, **kwargs):
-    self.totalcount = self.totalcount + 1
+    if self.mergeable and self.printer.unique:
+      # Which lines are unique across every shard is up to the merge.
+      self.printer.print_or_defer_output(formatted, group)
+    elif not self.printer.unique or self.printer.is_new_output(formatted, group):
+      self.totalcount = self.totalcount + 1
+
+  def needs_formatting(self):
+    """
+    Returns whether any option depends on the formatted output. If not, every
+    track counts, and the tracks don't even need to be saturated to be counted.
+    """
+    if self.groupby or self.printer.unique:
+      return True
+    for operator in ('equals', 'startswith', 'contains'):
+      if getattr(self.args, operator):
+        return True
+    return False
+
+  def do_run(self):
+    if self.needs_formatting():
+      return super(CountCommand, self).do_run()
+
+    self._records_processed = 0
+    visited_dirs = {}
+
+    if self.from_index:
+      library_index = self.open_index()
+      try:
+        self.count_tracks(library_index.count()[1], visited_dirs)
+      finally:
+        library_index.close()
+    elif self.from_daemon:
+      try:
+        for status in watch.query(self.args.socket, {'query': 'status'}):
+          self.count_tracks(status['tracks'], visited_dirs)
+      except watch.WatchUnavailableException as e:
+        parser.error(unistr(e))
+    elif self.jobs > 1:
+      self.count_all_tags_in_parallel(
+          self.iter_all_tags(self.args.tagsfile), visited_dirs)
+    else:
+      for dirpath, all_tags in self.iter_all_tags(self.args.tagsfile):
+        for tagsfile in all_tags:
+          self.count_tracks(
+              mtags.count_tracks(os.path.join(dirpath, tagsfile)),
+              visited_dirs)
+
+    return visited_dirs
+
+  def count_all_tags_in_parallel(self, all_tags, visited_dirs):
+    pool = parallel.create_pool(self.jobs)
+    try:
+      with parallel.OrderedPoolMap(
+          pool, self.jobs, parallel.count_tags, all_tags) as results:
+        for dirpath, counts in results:
+          for count in counts:
+            self.count_tracks(count, visited_dirs)
+    finally:
+      pool.terminate()
+      pool.join()
+
+  def count_tracks(self, count, visited_dirs):
+    # The same as calling process_record for each track, only all at once.
+    limit = self.args.limit
+    if limit >= 0 and self._records_processed + count >= limit:
+      self.totalcount += limit - self._records_processed
+      self._records_processed = limit
+      raise LimitReachedException(visited_dirs=visited_dirs)
+
+    self.totalcount += count
+    self._records_processed += count
 
   def run(self):
     visited_dirs = super(CountCommand, self).run()
-    uniprint(unistr(self.totalcount))
+    if not self.mergeable:
+      uniprint(unistr(self.totalcount))
+    elif not self.printer.unique:
+      uniprint(shard.write_record({'count': self.totalcount}))
+    return visited_dirs
+
+
+class StatsCommand(ListCommand):
+  def __init__(
+      self, args=None, titleformatter=None, fileformatter=None, printer=None):
+    # These name the columns, so they're needed before the row writer is made.
+    self.distinct = hasattr(args, 'distinct') and args.distinct or []
+    self.sums = hasattr(args, 'sum') and args.sum or []
+    super(StatsCommand, self).__init__(
+        args, titleformatter, fileformatter, printer)
+    self.aggregator = stats.Aggregator(len(self.distinct), len(self.sums))
+    if not self.groupby:
+      # The totals are still worth printing when nothing matched.
+      self.aggregator.add_group(None)
+
+  def create_row_writer(self, output_format):
+    names = ['group'] if self.groupby else []
+    names.append('tracks')
+    names.extend('distinct ' + pattern for pattern in self.distinct)
+    names.extend('sum ' + pattern for pattern in self.sums)
+    return rows.create_writer(output_format, names)
+
+  def needs_included_tracks(self):
+    return bool(self.distinct or self.sums)
+
+  def on_formatted_track_included(self, track, formatted, group, **kwargs):
+    if self.printer.unique and not self.printer.is_new_output(formatted, group):
+      return
+    self.aggregator.add(
+        group,
+        [self.titleformatter.format(track, each) for each in self.distinct],
+        [self.titleformatter.format(track, each) for each in self.sums])
+
+  def print_text_results(self):
+    indent = ' ' * self.args.groupby_indent if self.groupby else ''
+    first = True
+
+    for group, tracks, distinct, sums in self.aggregator.results():
+      if self.groupby:
+        if not first:
+          uniprint('')
+        uniprint(group + ':')
+      uniprint(indent + 'tracks: %d' % tracks)
+      for pattern, count in zip(self.distinct, distinct):
+        uniprint(indent + '%s: %d distinct' % (pattern, count))
+      for pattern, total in zip(self.sums, sums):
+        uniprint(indent + '%s: %s total' % (pattern, total))
+      first = False
+
+  def print_row_results(self):
+    for group, tracks, distinct, sums in self.aggregator.results():
+      values = [group] if self.groupby else []
+      values.append(tracks)
+      values.extend(distinct)
+      values.extend(sums)
+      uniprint(self.row_writer.format_row(values))
+
+  def run(self):
+    # The header (if any) comes first, but rows can't until every track has
+    # been counted.
+    visited_dirs = super(StatsCommand, self).run()
+
+    if self.row_writer is None:
+      self.print_text_results()
+    else:
+      self.print_row_results()
+
     return visited_dirs
 
 
@@ -938,19 +1630,48 @@ class CopyCommand(CoverArtFileMetadataConfigurableCommand):
         printer, cover_finder, metadata_handler)
 
     self.is_fast_forwarding = self.progress
-
-  def on_progress_count_complete(self):
-    super(CopyCommand, self).on_progress_count_complete()
+    self.io_jobs = (hasattr(args, 'io_jobs') and args.io_jobs) or 1
+    self.copier = fastcopy.FileCopier()
+    self.link = hasattr(args, 'link') and args.link or None
+    # How tracks are linked, if they are. They can only be linked to if nothing
+    # is going to be written to them, or it would be written to the originals.
+    self.writes_tracks = bool(
+        self.args.write_file_metadata or self.args.embed_covers)
+    self.link_tracks = None
+    if not self.writes_tracks:
+      self.link_tracks = self.link
+    self.pipeline = None
+    self.copied_files = set()
+    self.manifest = None
+    # The sources of queued tracks, by destination, until their metadata has
+    # been written and can be recorded in the manifest.
+    self.queued_sources = {}
+
+  def on_progress_start(self):
+    super(CopyCommand, self).on_progress_start()
     if self.is_fast_forwarding:
       self.printer.update_status('Fast forwarding...')
 
   def on_progress_tag_done(self):
     super(CopyCommand, self).on_progress_tag_done()
     self.printer.update_progress(
-        self.tags_done, self.total_tags, 'tags')
-
-  def check_new_file(self, dst):
-    if os.path.isfile(dst):
+        self.tags_done, self.total_tags, 'tags',
+        counting=not self.total_tags_known)
+
+  def check_new_file(self, dst, src=None, writable=False):
+    # Anything copied this run (or queued to be) counts, even if two tracks
+    # have the same destination.
+    exists = dst in self.copied_files
+    if not exists and os.path.isfile(dst):
+      # Unless the manifest knows it was copied from an older src.
+      exists = (src is None or self.manifest is None
+                or not self.manifest.is_stale(dst, src))
+      if exists and writable and fastcopy.is_linked(dst, src):
+        # A link left by an earlier --link run. Writing to it would write to
+        # the original, so it's replaced with a copy first.
+        exists = False
+
+    if exists:
       if not self.args.quiet:
         if not self.is_fast_forwarding:
           self.printer.update_last_file('File already exists', ': ' + dst)
@@ -965,20 +1686,37 @@ class CopyCommand(CoverArtFileMetadataConfigurableCommand):
     except OSError:
       pass
 
-  def create_dirs_and_copy(self, dirname, src, dst, noun):
-    is_new_file = self.check_new_file(dst)
+  def create_dirs_and_copy(self, dirname, src, dst, noun, copies=None,
+      link=None, writable=False):
+    """
+    Copies src to dst unless dst already exists, returning whether it didn't.
+    If copies is a list, the copy is added to it instead of being done here.
+    link is passed along to FileCopier.copy. If writable, dst is also copied
+    over if it's a link, since it's going to be written to.
+    """
+    is_new_file = self.check_new_file(dst, src, writable)
 
     if is_new_file:
       if not self.quiet and not self.progress:
         uniprint(dst)
       if os.path.isfile(src):
         if not self.args.dry_run:
+          self.copied_files.add(dst)
+        if copies is not None:
+          # Recorded in the manifest by on_copied, once they're done.
+          if not self.args.dry_run:
+            copies.append((dirname, src, dst, link))
+        elif not self.args.dry_run:
           self.create_dirs(dirname)
 
           if self.progress:
             self.printer.update_status('Copying ' + noun)
 
-          shutil.copy2(src, dst)
+          self.copier.copy(src, dst, link)
+          # Only once it's all there, or a copy that was cut short would be
+          # taken for a finished one from then on.
+          if self.manifest is not None:
+            self.manifest.record(dst, src)
       else:
         if self.progress:
           uniprint(dst)
@@ -986,7 +1724,8 @@ class CopyCommand(CoverArtFileMetadataConfigurableCommand):
 
     return is_new_file
 
-  def create_dirs_and_copy_if_size_changed(self, dirname, src, dst, noun):
+  def create_dirs_and_copy_if_size_changed(
+      self, dirname, src, dst, noun, copies=None, link=None):
     srcsize = os.path.getsize(src)
     dstsize = -1
 
@@ -996,30 +1735,59 @@ class CopyCommand(CoverArtFileMetadataConfigurableCommand):
       pass
 
     if srcsize != dstsize:
-      self.create_dirs_and_copy(dirname, src, dst, noun)
+      self.create_dirs_and_copy(dirname, src, dst, noun, copies, link)
 
-  def handle_cover(self, dirpath, track, dirname, dst_file, mutagen_file):
-    cover = self.cover_finder.find_cover_art(
+  def find_cover(self, dirpath, track, dirname):
+    return self.cover_finder.find_cover_art(
         dirpath, track, dirname, silent=self.is_fast_forwarding)
 
-    if cover:
-      coversrc = cover[0]
-      coverdst = cover[1]
-      if (not self.args.embed_covers
-          or self.args.embed_covers == EmbedCoversArg.EMBED_AND_COPY):
-        if self.is_fast_forwarding:
-          self.create_dirs_and_copy_if_size_changed(
-              dirname, coversrc, coverdst, 'cover art')
-        else:
-          self.create_dirs_and_copy(dirname, coversrc, coverdst, 'cover art')
-      if self.args.embed_covers:
-        albumart.embed(coversrc, mutagen_file)
+  def find_and_copy_cover(
+      self, dirpath, track, dirname, copies=None, cover=None):
+    """
+    Finds the cover art for a track (unless it's given as cover) and copies it
+    if it should be, returning the cover art's filename, or None if there
+    isn't any.
+    """
+    if cover is None:
+      cover = self.find_cover(dirpath, track, dirname)
+
+    if not cover:
+      return None
+
+    coversrc = cover[0]
+    coverdst = cover[1]
+    if (not self.args.embed_covers
+        or self.args.embed_covers == EmbedCoversArg.EMBED_AND_COPY):
+      # The manifest knows better than the size whether it has changed, but
+      # only for what it has a record of.
+      if self.is_fast_forwarding and (
+          self.manifest is None or self.manifest.get(coverdst) is None):
+        self.create_dirs_and_copy_if_size_changed(
+            dirname, coversrc, coverdst, 'cover art', copies, self.link)
+      else:
+        self.create_dirs_and_copy(
+            dirname, coversrc, coverdst, 'cover art', copies, self.link)
+    return coversrc
+
+  def handle_cover(
+      self, dirpath, track, dirname, dst_file, mutagen_file, cover=None):
+    """
+    Copies and embeds the cover art for a track as it should be, returning
+    the cover art's filename (or None) and whether anything was embedded.
+    """
+    coversrc = self.find_and_copy_cover(
+        dirpath, track, dirname, cover=cover)
+    embedded = False
+    if coversrc and self.args.embed_covers:
+      embedded = albumart.embed(coversrc, mutagen_file)
+    return coversrc, embedded
 
   def handle_file_metadata(self, filename, track, is_new_file, mutagen_file):
     changed = self.metadata_handler.handle_metadata(
         filename, mutagen_file, track, is_new_file, self.is_fast_forwarding)
     if self.is_fast_forwarding and changed:
       self.is_fast_forwarding = False
+    return changed
 
   def handle_track(self, dirpath, track, visited_dirs, **kwargs):
     track_filename = unistr(track.get('@'))
@@ -1035,11 +1803,63 @@ class CopyCommand(CoverArtFileMetadataConfigurableCommand):
         track, self.args.to + '.$ext(%filename_ext%)')
     dirname, basename = os.path.split(dst)
 
-    is_new_file = self.create_dirs_and_copy(dirname, src, dst, 'track')
+    if self.pipeline is not None:
+      self.queue_track(dirpath, track, src, dst, dirname)
+    else:
+      self.copy_track(dirpath, track, src, dst, dirname)
+
+    if self.args.write_mtags:
+      if dirname not in visited_dirs:
+        visited_dirs[dirname] = []
+      visited_dirs[dirname].append((basename, track))
+
+  def synced_metadata(self, track, coversrc):
+    """
+    Returns the tags digest and cover the manifest records for a track once
+    its metadata has been handled.
+    """
+    tags = ''
+    if self.args.write_file_metadata:
+      tags = manifest.tags_digest(track)
+    cover = ''
+    if coversrc and self.args.embed_covers:
+      cover = manifest.cover_digest(coversrc)
+    return tags, cover
+
+  def find_synced_cover(self, dirpath, track, src, dst, dirname):
+    """
+    Finds the cover art for an existing track, returning (cover, synced),
+    where synced says whether the manifest has the track as up to date.
+    """
+    cover = self.find_cover(dirpath, track, dirname)
+    coversrc = cover[0] if cover else None
+    return cover, self.manifest.is_synced(
+        dst, src, *self.synced_metadata(track, coversrc))
+
+  def copy_track(self, dirpath, track, src, dst, dirname):
+    is_new_file = self.create_dirs_and_copy(dirname, src, dst, 'track',
+        link=self.link_tracks, writable=self.writes_tracks)
+
+    cover = None
+    if self.manifest is not None and not is_new_file:
+      cover, synced = self.find_synced_cover(
+          dirpath, track, src, dst, dirname)
+      if synced:
+        # Nothing about it has changed, so it doesn't even have to be opened.
+        self.find_and_copy_cover(dirpath, track, dirname, cover=cover)
+        return
 
     if not is_new_file and not self.args.update_metadata:
       # Check this up here to keep us from opening the file, which is faster.
       self.metadata_handler.on_existing_file_skipped()
+      return
+
+    written = True
+    if (self.args.dry_run and is_new_file) or self.link_tracks:
+      # Nothing was copied (or it's the original, which mustn't be touched),
+      # so there's nothing to open, but the cover art is still worth copying.
+      coversrc = self.find_and_copy_cover(
+          dirpath, track, dirname, cover=cover)
     else:
       mutagen_file = File(dst, easy=True)
 
@@ -1047,15 +1867,144 @@ class CopyCommand(CoverArtFileMetadataConfigurableCommand):
         self.is_fast_forwarding = False
 
       # Passing a mutagen file prevents this method from autosaving it.
-      self.handle_file_metadata(dst, track, is_new_file, mutagen_file)
-      self.handle_cover(dirpath, track, dirname, dst, mutagen_file)
-      self.metadata_handler.safe_handle_metadata_write(
+      changed = self.handle_file_metadata(
+          dst, track, is_new_file, mutagen_file)
+      coversrc, embedded = self.handle_cover(
+          dirpath, track, dirname, dst, mutagen_file, cover)
+      # A file with nothing new to write, whether it was just copied or is
+      # already right, isn't written to at all.
+      if changed or embedded:
+        written = self.metadata_handler.safe_handle_metadata_write(
+            dst, mutagen_file, is_new_file)
+
+    if written and self.manifest is not None and not self.args.dry_run:
+      self.manifest.record_metadata(
+          dst, src, *self.synced_metadata(track, coversrc))
+
+  def queue_track(self, dirpath, track, src, dst, dirname):
+    """
+    Like copy_track, but the copying and metadata writing are queued on the
+    pipeline. Everything that decides what to do or prints what's being done
+    still happens here, in order.
+    """
+    copies = []
+    metadata_task = None
+    is_new_file = self.create_dirs_and_copy(dirname, src, dst, 'track',
+        copies, self.link_tracks, self.writes_tracks)
+
+    cover = None
+    synced = False
+    if self.manifest is not None and not is_new_file:
+      cover, synced = self.find_synced_cover(
+          dirpath, track, src, dst, dirname)
+
+    if synced:
+      self.find_and_copy_cover(dirpath, track, dirname, copies, cover)
+    elif not is_new_file and not self.args.update_metadata:
+      self.metadata_handler.on_existing_file_skipped()
+    else:
+      if self.is_fast_forwarding and is_new_file:
+        self.is_fast_forwarding = False
+
+      coversrc = self.find_and_copy_cover(
+          dirpath, track, dirname, copies, cover)
+      if not (self.args.dry_run and is_new_file) and not self.link_tracks:
+        metadata_task = (
+            dst, track, is_new_file, coversrc, self.is_fast_forwarding)
+
+      if self.manifest is not None and not self.args.dry_run:
+        if metadata_task is None:
+          self.manifest.record_metadata(
+              dst, src, *self.synced_metadata(track, coversrc))
+        else:
+          # Recorded by on_metadata_written, once it's been written.
+          self.queued_sources[dst] = src
+
+    if copies or metadata_task is not None:
+      self.pipeline.submit(copies, metadata_task)
+
+  def write_track_metadata(self, dst, track, is_new_file, coversrc, silent):
+    """
+    Writes the tags and embeds the cover art of a track that's already been
+    copied, returning whether its metadata changed and whether it was written
+    (which it isn't if it didn't need to be, or couldn't be).
+    """
+    mutagen_file = File(dst, easy=True)
+    # Passing a mutagen file prevents this method from autosaving it.
+    changed = self.metadata_handler.handle_metadata(
+        dst, mutagen_file, track, is_new_file, silent)
+    embedded = False
+    if coversrc and self.args.embed_covers:
+      embedded = albumart.embed(coversrc, mutagen_file)
+    written = True
+    if changed or embedded:
+      written = self.metadata_handler.safe_handle_metadata_write(
           dst, mutagen_file, is_new_file)
+    return changed, written
+
+  def write_queued_metadata(self, task):
+    # The writes and rewrites have already been counted by our own handler.
+    return self.write_track_metadata(*task) + (None, 0, 0)
+
+  def on_copied(self, copies):
+    if self.manifest is not None:
+      for dirname, src, dst, link in copies:
+        self.manifest.record(dst, src)
+
+  def on_metadata_written(self, task, result):
+    changed, written, output, writes, rewrites = result
+    self.metadata_handler.writes += writes
+    self.metadata_handler.rewrites += rewrites
+    if output:
+      # Anything a worker printed goes through the printer, so it lands in the
+      # right place in the progress display.
+      for line in output.splitlines():
+        self.printer.update_last_file(line)
+    if self.is_fast_forwarding and changed:
+      self.is_fast_forwarding = False
 
-    if self.args.write_mtags:
-      if dirname not in visited_dirs:
-        visited_dirs[dirname] = []
-      visited_dirs[dirname].append((basename, track))
+    dst, track, is_new_file, coversrc, silent = task
+    src = self.queued_sources.pop(dst, None)
+    if written and src is not None:
+      self.manifest.record_metadata(
+          dst, src, *self.synced_metadata(track, coversrc))
+
+  def do_run(self):
+    if self.jobs == 1 and self.io_jobs == 1:
+      return super(CopyCommand, self).do_run()
+
+    pool = None
+    second_stage = self.write_queued_metadata
+    if self.jobs > 1:
+      # Workers can't draw the progress display, so they print plain messages
+      # for on_metadata_written to pass along.
+      worker_args = argparse.Namespace(**vars(self.args))
+      worker_args.progress = False
+      pool = parallel.create_pool(self.jobs, command=(
+          type(self), worker_args, self.titleformatter, self.fileformatter))
+      second_stage = parallel.write_metadata
+
+    try:
+      self.pipeline = parallel.StagedPipeline(
+          self.io_jobs, self.copier.copy_all, second_stage,
+          self.on_metadata_written, pool, self.jobs,
+          on_first_done=self.on_copied)
+      try:
+        visited_dirs = super(CopyCommand, self).do_run()
+      except LimitReachedException:
+        # Everything up to the limit still has to be finished.
+        self.pipeline.close()
+        raise
+      except BaseException:
+        self.pipeline.terminate()
+        raise
+      self.pipeline.close()
+      return visited_dirs
+    finally:
+      self.pipeline = None
+      if pool is not None:
+        pool.terminate()
+        pool.join()
 
   def handle_tags(self, dirpath, tags, visited_dirs):
     totaltracks = len(tags.tracks)
@@ -1075,7 +2024,34 @@ class CopyCommand(CoverArtFileMetadataConfigurableCommand):
         self.printer.update_current(
             done, totaltracks, 'tracks', self._records_processed)
 
+  def open_manifest(self):
+    if not (hasattr(self.args, 'manifest') and self.args.manifest):
+      return None
+
+    root = manifest.destination_root(self.args.to)
+    if self.args.dry_run and not os.path.isfile(
+        os.path.join(root, manifest.filename)):
+      # A dry run shouldn't create one, and there'd be nothing to read.
+      return None
+
+    try:
+      return manifest.SyncManifest(root)
+    except manifest.ManifestUnavailableException as e:
+      parser.error(unistr(e))
+
   def run(self):
+    self.manifest = self.open_manifest()
+    try:
+      visited_dirs = self.copy_library()
+      if self.manifest is not None and not self.args.dry_run:
+        self.manifest.save()
+    finally:
+      if self.manifest is not None:
+        self.manifest.close()
+        self.manifest = None
+    return visited_dirs
+
+  def copy_library(self):
     if self.progress:
       self.printer.update_status('Initializing...')
     visited_dirs = super(CopyCommand, self).run()
@@ -1089,10 +2065,15 @@ class CopyCommand(CoverArtFileMetadataConfigurableCommand):
           pending_mtags.append(trackinfo)
         mtagsfile = mtags.TagsFile(pending_mtags)
         mtags_dst = os.path.join(dirname, self.args.tagsfile)
-        if not self.args.quiet:
-          uniprint(mtags_dst)
+        written = True
         if not self.args.dry_run:
-          mtagsfile.write(mtags_dst)
+          written = mtagsfile.write(mtags_dst, only_if_changed=True)
+        if written and not self.args.quiet:
+          uniprint(mtags_dst)
+    if not self.args.quiet:
+      for summary in (self.copier.summary(), self.metadata_handler.summary()):
+        if summary:
+          self.printer.update_status(summary)
     return visited_dirs
 
 
@@ -1173,9 +2154,9 @@ class GenerateCommand(AutomaticConfiguringCommand):
   def handle_all_media(self):
     all_tags = {}
 
-    for dirpath, dirnames, filenames in os.walk(unicwd()):
-      for each in filenames:
-        mutagen_file = File(os.path.join(dirpath, each), easy=True)
+    for dirpath, dirs, files in self.walk_library():
+      for each in files:
+        mutagen_file = File(each.path, easy=True)
         if mutagen_file is not None:
           if dirpath not in all_tags:
             all_tags[dirpath] = {
@@ -1184,9 +2165,10 @@ class GenerateCommand(AutomaticConfiguringCommand):
             }
 
           self.process_single_media(
-              each, mutagen_file, all_tags[dirpath]['tracks'])
+              each.name, mutagen_file, all_tags[dirpath]['tracks'])
 
     tags_written = 0
+    tags_unchanged = 0
 
     for each in sorted(all_tags.keys()):
       tracks = all_tags[each]['tracks']
@@ -1196,25 +2178,155 @@ class GenerateCommand(AutomaticConfiguringCommand):
 
       filename = all_tags[each]['file']
 
+      if not mtags.TagsFile(tracks).write(filename, only_if_changed=True):
+        tags_unchanged = tags_unchanged + 1
+        continue
+
       if not self.args.quiet:
         self.printer.print_or_defer_output(
             'writing tags file: %s (%d tracks)' % (filename, len(tracks)))
 
-      mtags.TagsFile(tracks).write(filename)
-
       tags_written = tags_written + 1
 
-    if tags_written == 0:
+    if tags_written == 0 and tags_unchanged == 0:
       self.printer.print_or_defer_output(
           "couldn't find any tags to write -- are you in the right directory?")
     elif tags_written > 1:
       self.printer.print_or_defer_output(
           "%d tag files written" % (tags_written))
 
+    if tags_unchanged > 0:
+      self.printer.print_or_defer_output(
+          "%d tag %s already up to date" % (
+              tags_unchanged, 'file' if tags_unchanged == 1 else 'files'))
+
   def run(self):
     self.handle_all_media()
 
 
+class IndexCommand(AutomaticConfiguringCommand):
+  def iter_tagsfiles(self):
+    for dirpath, dirs, files in self.walk_library():
+      for each in files:
+        if each.name == self.args.tagsfile:
+          yield each.path, each.stat()
+
+  def on_tags_read(self, path, tags):
+    if not self.args.quiet:
+      uniprint('indexing %s (%d tracks)' % (path, len(tags.tracks)))
+
+  def run(self):
+    if self.args.rebuild and os.path.isfile(self.args.index_file):
+      os.remove(self.args.index_file)
+
+    try:
+      library_index = index.LibraryIndex(self.args.index_file, create=True)
+    except index.IndexUnavailableException as e:
+      parser.error(unistr(e))
+
+    try:
+      refresh_stats = library_index.refresh(
+          unicwd(), self.iter_tagsfiles(), self.on_tags_read)
+    finally:
+      library_index.close()
+
+    for path, e in refresh_stats.failed:
+      err("couldn't index %s: %s" % (path, unistr(e)))
+
+    if not self.args.quiet:
+      uniprint(
+          '%d tags files indexed (%d added, %d updated, %d removed,'
+          ' %d unchanged, %d failed)' % (
+              refresh_stats.total, refresh_stats.added, refresh_stats.updated,
+              refresh_stats.removed, refresh_stats.unchanged,
+              len(refresh_stats.failed)))
+
+    return refresh_stats
+
+
+class MergeCommand(AutomaticConfiguringCommand):
+  def read_all_records(self):
+    headers = []
+    all_records = []
+
+    for filename in self.args.files:
+      try:
+        header, records = shard.read_records(filename)
+      except (IOError, ValueError) as e:
+        parser.error("can't merge %s: %s" % (filename, e))
+      headers.append(header)
+      all_records.append(records)
+
+    try:
+      shard.check_headers(headers)
+    except ValueError as e:
+      parser.error("can't merge: %s" % e)
+
+    return headers[0], shard.merge_records(all_records)
+
+  def run(self):
+    header, records = self.read_all_records()
+
+    if header['cmd'] == 'count' and not header['unique']:
+      uniprint(unistr(sum(record['count'] for record in records)))
+      return
+
+    # Do what the printer of a single run would have done with each line.
+    printer = PrintHandler(argparse.Namespace(
+        unique=header['unique'],
+        unique_memory=header['unique_memory'],
+        groupby=header['groupby'],
+        groupby_indent=header['groupby_indent'],
+        groupby_per_dir=header['groupby_per_dir'],
+        groupby_memory=header['groupby_memory']), None, None)
+    totalcount = 0
+
+    if header['header'] is not None:
+      uniprint(header['header'])
+
+    for record in records:
+      for group, line in record['lines']:
+        if header['cmd'] == 'count':
+          if printer.is_new_output(line, group):
+            totalcount += 1
+        else:
+          printer.print_or_defer_output(line, group)
+      printer.on_dir_done(None)
+
+    if header['cmd'] == 'count':
+      uniprint(unistr(totalcount))
+    else:
+      printer.print_deferred_output()
+
+
+class WatchCommand(AutomaticConfiguringCommand):
+  def log(self, message):
+    if not self.args.quiet:
+      uniprint(message)
+
+  def run(self):
+    try:
+      library_index = index.LibraryIndex(self.args.index_file, create=True)
+    except index.IndexUnavailableException as e:
+      parser.error(unistr(e))
+
+    daemon = watch.WatchDaemon(
+        library_index, unicwd(), self.args.tagsfile, self.args.socket,
+        self.walk_options(), self.args.poll, self.log)
+
+    # Being stopped by a service manager shouldn't leave the socket behind.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+      daemon.serve()
+    except watch.WatchUnavailableException as e:
+      parser.error(unistr(e))
+    except KeyboardInterrupt:
+      pass
+    finally:
+      library_index.close()
+
+
 def provide_configured_command(args):
   if args.cmd is None:
     parser.print_usage()
@@ -1223,19 +2335,39 @@ def provide_configured_command(args):
     return ListCommand(args)
   elif args.cmd == 'count':
     return CountCommand(args)
+  elif args.cmd == 'stats':
+    return StatsCommand(args)
   elif args.cmd == 'copy':
     return CopyCommand(args)
   elif args.cmd == 'findcovers':
     return FindCoversCommand(args)
   elif args.cmd == 'generate':
     return GenerateCommand(args)
+  elif args.cmd == 'index':
+    return IndexCommand(args)
+  elif args.cmd == 'watch':
+    return WatchCommand(args)
+  elif args.cmd == 'merge':
+    return MergeCommand(args)
   else:
     parser.error("can't understand command '%s' -- this is a bug!" % (args.cmd))
 
 def main():
   args = parser.parse_args()
+  try:
+    mtags.set_json_backend(args.json_backend)
+  except ImportError:
+    parser.error("JSON backend '%s' is not installed" % (args.json_backend))
+  if hasattr(args, 'output') and args.output:
+    try:
+      set_output(OutputSink(open(args.output, 'wb'), encoding='utf-8'))
+    except IOError as e:
+      parser.error("can't write to %s: %s" % (args.output, e.strerror))
   command = provide_configured_command(args)
-  command.run()
+  try:
+    command.run()
+  finally:
+    set_output(None)
 
 if __name__ == '__main__':
   main()
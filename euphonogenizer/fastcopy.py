@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+import collections
+import errno
+import os
+import shutil
+import sys
+import threading
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+
+# From linux/fs.h: _IOW(0x94, 9, int).
+FICLONE = 0x40049409
+
+# What the kernel says when a method just doesn't work for these two files
+# (different filesystems, a filesystem that can't do it, an old kernel), as
+# opposed to the copy itself going wrong. Anything else (like EPERM or EBADF)
+# is a real error, and is raised.
+_unsupported_errnos = frozenset(
+    getattr(errno, name) for name in (
+        'EINVAL', 'ENOSYS', 'ENOTSUP', 'ENOTTY', 'EOPNOTSUPP', 'EXDEV')
+    if hasattr(errno, name))
+
+# A filesystem without links (vfat, exfat, some SMB mounts) refuses them with
+# EPERM, and a file can have too many hard links already. Either way, it can
+# still be copied.
+_unlinkable_errnos = _unsupported_errnos | frozenset(
+    getattr(errno, name) for name in ('EMLINK', 'EPERM')
+    if hasattr(errno, name))
+
+
+def is_linked(dst, src):
+  """
+  Returns whether writing to dst would also write to something else: whether
+  it's a symbolic link, or a hard link to src.
+  """
+  if os.path.islink(dst):
+    return True
+  try:
+    return os.path.samefile(src, dst)
+  except OSError:
+    return False
+
+
+def _reflink(infd, outfd, size):
+  fcntl.ioctl(outfd, FICLONE, infd)
+  return True
+
+def _copy_file_range(infd, outfd, size):
+  copied = 0
+  while copied < size:
+    n = os.copy_file_range(infd, outfd, size - copied)
+    if n == 0:
+      # Some filesystems claim to support it and then copy nothing.
+      return False
+    copied += n
+  return True
+
+def _sendfile(infd, outfd, size):
+  copied = 0
+  while copied < size:
+    n = os.sendfile(outfd, infd, copied, size - copied)
+    if n == 0:
+      return False
+    copied += n
+  return True
+
+
+# The ways of copying a file without reading it into user space, best first.
+kernel_methods = []
+
+if sys.platform.startswith('linux'):
+  if fcntl is not None:
+    kernel_methods.append(('reflink', _reflink))
+  if hasattr(os, 'copy_file_range'):
+    kernel_methods.append(('copy_file_range', _copy_file_range))
+  if hasattr(os, 'sendfile'):
+    kernel_methods.append(('sendfile', _sendfile))
+
+
+class FileCopier(object):
+  """
+  Copies files the cheapest way the kernel allows: a reflink, which shares
+  the data until either file changes (Btrfs and XFS), then copy_file_range,
+  then sendfile, and finally shutil.copy2 if none of those work. Timestamps
+  and permissions are copied over just as copy2 does.
+
+  Files can also be hard or symbolic links to the original instead, falling
+  back to copying them when that can't be done (like across devices).
+
+  A method that fails for one pair of devices isn't tried again for them.
+  counts says how many files were copied with each method. It's safe to copy
+  from several threads at once.
+  """
+
+  def __init__(self):
+    self.counts = collections.Counter()
+    self._lock = threading.Lock()
+    self._unsupported = set()
+
+  def copy(self, src, dst, link=None):
+    """
+    Copies src to dst, returning the name of the method that did it. If link
+    is 'hard' or 'sym', dst is made a link of that kind to src if it can be.
+    If the copy fails (or is interrupted), dst is removed rather than left
+    half written.
+    """
+    if os.path.lexists(dst):
+      # Replace it rather than writing into it, which would write through to
+      # the original if it's a link.
+      os.remove(dst)
+
+    try:
+      method = link and self._link(src, dst, link)
+      if not method:
+        method = self._copy_in_kernel(src, dst) or 'copy2'
+        if method == 'copy2':
+          shutil.copy2(src, dst)
+        else:
+          shutil.copystat(src, dst)
+    except BaseException:
+      # Otherwise it could be taken for a finished copy later.
+      try:
+        os.remove(dst)
+      except OSError:
+        pass
+      raise
+
+    with self._lock:
+      self.counts[method] += 1
+    return method
+
+  def _link(self, src, dst, link):
+    try:
+      if link == 'hard':
+        os.link(src, dst)
+        return 'hardlink'
+      os.symlink(os.path.abspath(src), dst)
+      return 'symlink'
+    except (IOError, OSError) as e:
+      if e.errno not in _unlinkable_errnos:
+        raise
+    return None
+
+  def _copy_in_kernel(self, src, dst):
+    if not kernel_methods:
+      return None
+
+    with open(src, 'rb') as fsrc:
+      infd = fsrc.fileno()
+      st = os.fstat(infd)
+      with open(dst, 'wb') as fdst:
+        outfd = fdst.fileno()
+        devices = (st.st_dev, os.fstat(outfd).st_dev)
+
+        for name, method in kernel_methods:
+          if (name, devices) in self._unsupported:
+            continue
+          try:
+            if method(infd, outfd, st.st_size):
+              return name
+          except (IOError, OSError) as e:
+            if e.errno not in _unsupported_errnos:
+              raise
+          self._unsupported.add((name, devices))
+          # Start over with whatever's left of the last attempt thrown away.
+          os.ftruncate(outfd, 0)
+          os.lseek(outfd, 0, os.SEEK_SET)
+          os.lseek(infd, 0, os.SEEK_SET)
+
+    return None
+
+  def copy_all(self, copies):
+    """
+    Copies each (dirname, src, dst, link), creating dirname first if it has
+    to.
+    """
+    for dirname, src, dst, link in copies:
+      try:
+        os.makedirs(dirname)
+      except OSError:
+        pass
+      self.copy(src, dst, link)
+
+  def summary(self):
+    """
+    Describes how many files were copied and how, or returns None if nothing
+    was.
+    """
+    total = sum(self.counts.values())
+    if not total:
+      return None
+    methods = ', '.join('%d by %s' % (self.counts[name], name)
+        for name in ['hardlink', 'symlink']
+            + [name for name, method in kernel_methods] + ['copy2']
+        if self.counts[name])
+    return '%d %s copied (%s)' % (
+        total, 'file' if total == 1 else 'files', methods)
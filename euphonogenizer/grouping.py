@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+import heapq
+import itertools
+import pickle
+import tempfile
+
+
+# Roughly what one buffered item costs in memory beyond its text: the tuple
+# holding it, the sequence number, and the list slot.
+_bytes_per_item = 120
+
+# Merging too many runs at once would mean too many open files, so past this
+# many they're merged into a single run first.
+max_runs = 64
+
+
+class Descending(object):
+  """
+  Wraps a sort key so that it sorts in reverse, which lets ascending and
+  descending keys be mixed in a single tuple.
+  """
+
+  __slots__ = ('key',)
+
+  def __init__(self, key):
+    self.key = key
+
+  def __getstate__(self):
+    return (self.key,)
+
+  def __setstate__(self, state):
+    self.key, = state
+
+  def __eq__(self, other):
+    return self.key == other.key
+
+  def __ne__(self, other):
+    return self.key != other.key
+
+  def __lt__(self, other):
+    return other.key < self.key
+
+  def __gt__(self, other):
+    return other.key > self.key
+
+
+class ExternalSorter(object):
+  """
+  Sorts items by key without keeping them all in memory. Items are buffered
+  until they would take more than max_memory bytes, and then sorted and
+  written out as a run in a temporary file. The runs and whatever is still
+  buffered are merged when the items are read back. Items with equal keys come
+  back in the order they were added.
+  """
+
+  def __init__(self, max_memory=None):
+    self.max_memory = max_memory
+    self.buffer = []
+    self.buffer_size = 0
+    self.runs = []
+    self.seq = 0
+
+  def add(self, key, item, size=0):
+    """
+    Adds an item to be sorted by key. size is roughly how many bytes the key
+    and the item take, which decides when to spill to disk.
+    """
+    self.buffer.append((key, self.seq, item))
+    self.seq += 1
+    self.buffer_size += size + _bytes_per_item
+
+    if self.max_memory is not None and self.buffer_size >= self.max_memory:
+      self.spill()
+
+  def spill(self):
+    # (key, seq) is unique, so sorting never has to compare the items.
+    self.buffer.sort(key=_record_key)
+    self.runs.append(_write_run(self.buffer))
+    self.buffer = []
+    self.buffer_size = 0
+
+    if len(self.runs) >= max_runs:
+      merged = _write_run(heapq.merge(
+          *[_read_run(run) for run in self.runs], key=_record_key))
+      for run in self.runs:
+        run.close()
+      self.runs = [merged]
+
+  def drain(self):
+    """
+    Yields (key, item) for everything added so far in sorted order, and then
+    starts over empty.
+    """
+    self.buffer.sort(key=_record_key)
+    runs, self.runs = self.runs, []
+    buffered, self.buffer = self.buffer, []
+    self.buffer_size = 0
+    self.seq = 0
+
+    try:
+      for key, seq, item in heapq.merge(
+          buffered, *[_read_run(run) for run in runs], key=_record_key):
+        yield key, item
+    finally:
+      for run in runs:
+        run.close()
+
+
+class GroupedOutput(object):
+  """
+  Collects (group, line) pairs and hands them back grouped, with groups in the
+  order they first appeared and lines in the order they were added. The lines
+  go through an ExternalSorter, so memory stays bounded however much output
+  there is. Only the group names themselves (one per group, not per line) are
+  always kept in memory.
+  """
+
+  def __init__(self, max_memory=None):
+    self.sorter = ExternalSorter(max_memory)
+    self.ordinals = {}
+
+  def add(self, group, line):
+    ordinal = self.ordinals.get(group)
+    if ordinal is None:
+      ordinal = self.ordinals[group] = len(self.ordinals)
+
+    self.sorter.add(ordinal, (group, line), len(group) + len(line))
+
+  def groups(self):
+    """
+    Yields (group, lines) for everything added so far, where lines is an
+    iterator over the group's lines, and then starts over empty. Each lines
+    iterator has to be used up before moving on to the next group.
+    """
+    self.ordinals = {}
+
+    for ordinal, records in itertools.groupby(
+        self.sorter.drain(), lambda record: record[0]):
+      first = next(records)[1]
+      yield first[0], itertools.chain(
+          [first[1]], (item[1] for key, item in records))
+
+
+def _record_key(record):
+  return record[0], record[1]
+
+def _write_run(records):
+  run = tempfile.TemporaryFile()
+  pickler = pickle.Pickler(run, pickle.HIGHEST_PROTOCOL)
+  for record in records:
+    pickler.dump(record)
+    # Otherwise the pickler remembers every record it has written.
+    pickler.clear_memo()
+  run.seek(0)
+  return run
+
+def _read_run(run):
+  unpickler = pickle.Unpickler(run)
+  while True:
+    try:
+      yield unpickler.load()
+    except EOFError:
+      return
@@ -0,0 +1,422 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+import json
+import os
+import sqlite3
+
+from . import mtags
+
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+CREATE TABLE IF NOT EXISTS tagsfiles (
+  id INTEGER PRIMARY KEY,
+  path TEXT NOT NULL UNIQUE,
+  dirpath TEXT NOT NULL,
+  seq INTEGER NOT NULL,
+  mtime REAL NOT NULL,
+  size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracks (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  tagsfile INTEGER NOT NULL REFERENCES tagsfiles(id) ON DELETE CASCADE,
+  position INTEGER NOT NULL,
+  fields TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tracks_by_tagsfile ON tracks(tagsfile, position);
+CREATE INDEX IF NOT EXISTS tagsfiles_by_seq ON tagsfiles(seq);
+CREATE TABLE IF NOT EXISTS fields (
+  key TEXT PRIMARY KEY,
+  last_track INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS field_values (
+  key TEXT NOT NULL,
+  value TEXT NOT NULL,
+  track INTEGER NOT NULL REFERENCES tracks(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS field_values_by_value ON field_values(key, value);
+CREATE INDEX IF NOT EXISTS field_values_by_track ON field_values(track);
+CREATE TABLE IF NOT EXISTS field_grams (
+  key TEXT NOT NULL,
+  gram TEXT NOT NULL,
+  value TEXT NOT NULL,
+  PRIMARY KEY (key, gram, value)
+) WITHOUT ROWID;
+'''
+
+schema_version = '2'
+
+gram_size = 3
+
+
+# What reading a tags file that's unreadable or isn't valid M-TAGS can raise.
+# (Bad JSON and bad UTF-8 are both ValueErrors.)
+_unreadable_errors = (IOError, OSError, ValueError)
+
+
+def grams(value):
+  return set(value[i:i + gram_size] for i in range(len(value) - gram_size + 1))
+
+
+class IndexUnavailableException(Exception):
+  pass
+
+
+class RefreshStats(object):
+  def __init__(self):
+    self.added = 0
+    self.updated = 0
+    self.removed = 0
+    self.unchanged = 0
+    # (path, exception) for each tags file that couldn't be read.
+    self.failed = []
+
+  @property
+  def total(self):
+    return self.added + self.updated + self.unchanged
+
+
+class LibraryIndex(object):
+  """
+  A SQLite database of every track in the library, as saturated by TagsFile,
+  along with the mtime and size of the tags file it came from. Paths are stored
+  relative to the root the index was built from, and the root relative to the
+  database itself, so the database can be moved along with the library (as long
+  as it's kept in the same place within it).
+  """
+
+  def __init__(self, filename, create=False):
+    if not create and not os.path.isfile(filename):
+      raise IndexUnavailableException(
+          'no library index at %s (create one with the index command)'
+          % filename)
+
+    self.filename = filename
+    self.db = sqlite3.connect(filename)
+    self.db.execute('PRAGMA foreign_keys = ON')
+
+    version = self.get_meta('version')
+
+    if version is None and create:
+      self.db.executescript(_schema)
+      with self.db:
+        self.set_meta('version', schema_version)
+    elif version != schema_version:
+      self.db.close()
+      raise IndexUnavailableException(
+          'the library index at %s is from an incompatible version'
+          ' (rebuild it with index --rebuild)' % filename)
+
+  def close(self):
+    self.db.close()
+
+  def get_meta(self, key):
+    try:
+      row = self.db.execute(
+          'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    except sqlite3.DatabaseError:
+      return None
+    return row[0] if row else None
+
+  def set_meta(self, key, value):
+    self.db.execute(
+        'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+  @property
+  def root(self):
+    root = self.get_meta('root')
+    if root is None:
+      return None
+    # Indexes from before roots were relative have absolute ones, which join
+    # to themselves.
+    return os.path.normpath(os.path.join(self._dirname(), root))
+
+  def _dirname(self):
+    return os.path.dirname(os.path.abspath(self.filename))
+
+  def _set_root(self, root):
+    try:
+      root = os.path.relpath(os.path.abspath(root), self._dirname())
+    except ValueError:
+      # On another drive, so there's no relative path to it.
+      root = os.path.abspath(root)
+    self.set_meta('root', root)
+
+  def refresh(self, root, tagsfiles, on_tags_read=None):
+    """
+    Brings the index up to date with the tags files found by a walk over root.
+    tagsfiles yields (path, stat result) in walk order. Only files whose mtime
+    or size differ from what was indexed are read again, and files that weren't
+    found are dropped. A file that can't be read is left as it was indexed
+    before (if it was) and listed in the RefreshStats returned.
+    """
+    stats = RefreshStats()
+    known = {}
+
+    for row in self.db.execute(
+        'SELECT id, path, seq, mtime, size FROM tagsfiles'):
+      known[row[1]] = row
+
+    with self.db:
+      self._set_root(root)
+
+      for seq, (path, st) in enumerate(tagsfiles):
+        relpath = os.path.relpath(path, root)
+        self._update(stats, relpath, path, seq, st, known.pop(relpath, None),
+            on_tags_read)
+
+      for row in known.values():
+        self.db.execute('DELETE FROM tagsfiles WHERE id = ?', (row[0],))
+        stats.removed += 1
+
+    return stats
+
+  def update_tagsfile(self, path, st, on_tags_read=None):
+    """
+    Indexes a single tags file again if it changed, as the watch daemon does
+    when it's told about one. A file that wasn't indexed before goes after all
+    the others, since there's no walk to say where it belongs.
+    """
+    stats = RefreshStats()
+    relpath = os.path.relpath(path, self.root)
+
+    with self.db:
+      previous = self.db.execute(
+          'SELECT id, path, seq, mtime, size FROM tagsfiles WHERE path = ?',
+          (relpath,)).fetchone()
+
+      if previous is not None:
+        seq = previous[2]
+      else:
+        seq = self.db.execute(
+            'SELECT COALESCE(MAX(seq) + 1, 0) FROM tagsfiles').fetchone()[0]
+
+      self._update(stats, relpath, path, seq, st, previous, on_tags_read)
+
+    return stats
+
+  def remove_tagsfile(self, path):
+    with self.db:
+      cursor = self.db.execute('DELETE FROM tagsfiles WHERE path = ?',
+          (os.path.relpath(path, self.root),))
+    return cursor.rowcount
+
+  def remove_dir(self, dirpath):
+    reldir = os.path.relpath(dirpath, self.root)
+    prefix = reldir + os.sep
+
+    with self.db:
+      cursor = self.db.execute(
+          'DELETE FROM tagsfiles WHERE dirpath = ? OR substr(path, 1, ?) = ?',
+          (reldir, len(prefix), prefix))
+    return cursor.rowcount
+
+  def _update(self, stats, relpath, path, seq, st, previous, on_tags_read):
+    if previous is not None:
+      tagsfile_id, unused_path, old_seq, mtime, size = previous
+      if mtime == st.st_mtime and size == st.st_size:
+        if old_seq != seq:
+          self.db.execute('UPDATE tagsfiles SET seq = ? WHERE id = ?',
+              (seq, tagsfile_id))
+        stats.unchanged += 1
+        return
+
+    try:
+      tags = mtags.TagsFile(path)
+    except _unreadable_errors as e:
+      # Keep what was there, so it's tried again next time.
+      if previous is not None and old_seq != seq:
+        self.db.execute('UPDATE tagsfiles SET seq = ? WHERE id = ?',
+            (seq, tagsfile_id))
+      stats.failed.append((path, e))
+      return
+
+    if previous is not None:
+      self.db.execute('DELETE FROM tagsfiles WHERE id = ?', (tagsfile_id,))
+      stats.updated += 1
+    else:
+      stats.added += 1
+
+    self.add_tags(relpath, seq, st, tags)
+
+    if on_tags_read is not None:
+      on_tags_read(path, tags)
+
+  def add_tags(self, relpath, seq, st, tags):
+    cursor = self.db.execute(
+        'INSERT INTO tagsfiles (path, dirpath, seq, mtime, size)'
+        ' VALUES (?, ?, ?, ?, ?)',
+        (relpath, os.path.dirname(relpath), seq, st.st_mtime, st.st_size))
+    tagsfile_id = cursor.lastrowid
+
+    self.db.executemany(
+        'INSERT INTO tracks (tagsfile, position, fields) VALUES (?, ?, ?)',
+        [(tagsfile_id, position, json.dumps(track, ensure_ascii=False))
+         for position, track in enumerate(tags.tracks)])
+
+  def count(self):
+    """
+    Returns the number of tags files and tracks in the index.
+    """
+    return (
+        self.db.execute('SELECT COUNT(*) FROM tagsfiles').fetchone()[0],
+        self.db.execute('SELECT COUNT(*) FROM tracks').fetchone()[0])
+
+  def iter_dirs(self):
+    """
+    Yields (dirpath, [tracks, ...]) in the order the directories were walked,
+    with one list of saturated tracks per tags file in the directory.
+    """
+    return self._group_by_dir(self.db.execute(
+        'SELECT tagsfiles.dirpath, tracks.tagsfile, tracks.fields'
+        ' FROM tracks JOIN tagsfiles ON tracks.tagsfile = tagsfiles.id'
+        ' ORDER BY tagsfiles.seq, tracks.position'))
+
+  def update_field(self, key, format_value):
+    """
+    Stores format_value(track) for every track that doesn't have a value for
+    key yet, so that tracks can be looked up by it. The first call for a key
+    formats the whole library; later ones only format tracks indexed since.
+    key has to identify the formatting completely, options and all.
+    """
+    loads = mtags.get_json_backend().loads
+    row = self.db.execute(
+        'SELECT last_track FROM fields WHERE key = ?', (key,)).fetchone()
+    last_track = row[0] if row else 0
+    values = []
+    new_grams = set()
+
+    for track_id, fields in self.db.execute(
+        'SELECT id, fields FROM tracks WHERE id > ? ORDER BY id',
+        (last_track,)):
+      value = format_value(loads(fields))
+      values.append((key, value, track_id))
+      new_grams.update((gram, value) for gram in grams(value))
+      last_track = track_id
+
+    with self.db:
+      self.db.executemany(
+          'INSERT INTO field_values (key, value, track) VALUES (?, ?, ?)',
+          values)
+      self.db.executemany(
+          'INSERT OR IGNORE INTO field_grams (key, gram, value)'
+          ' VALUES (?, ?, ?)',
+          [(key, gram, value) for gram, value in new_grams])
+      self.db.execute(
+          'INSERT OR REPLACE INTO fields (key, last_track) VALUES (?, ?)',
+          (key, last_track))
+
+    return len(values)
+
+  def iter_dirs_where(self, key, operator, needle):
+    """
+    Like iter_dirs, but only yields the tracks whose value for key (see
+    update_field) equals, starts with or contains needle, depending on whether
+    operator is 'equals', 'startswith' or 'contains'. Tags files without any
+    matching tracks are left out entirely.
+    """
+    select = (
+        'SELECT tagsfiles.dirpath, tracks.tagsfile, tracks.fields'
+        ' FROM field_values'
+        ' JOIN tracks ON field_values.track = tracks.id'
+        ' JOIN tagsfiles ON tracks.tagsfile = tagsfiles.id'
+        ' WHERE field_values.key = ? AND %s'
+        ' ORDER BY tagsfiles.seq, tracks.position')
+
+    if operator == 'equals':
+      rows = self.db.execute(
+          select % 'field_values.value = ?', (key, needle))
+    elif operator == 'startswith':
+      # Walk the (key, value) index from the first value that could possibly
+      # match to the first one that can't.
+      condition = ('field_values.value >= ?'
+                   ' AND substr(field_values.value, 1, ?) = ?')
+      params = [key, needle, len(needle), needle]
+      upper = _successor(needle)
+      if upper is not None:
+        condition += ' AND field_values.value < ?'
+        params.append(upper)
+      rows = self.db.execute(select % condition, params)
+    elif operator == 'contains':
+      self.db.execute(
+          'CREATE TEMP TABLE IF NOT EXISTS matching_values (value TEXT)')
+      self.db.execute('DELETE FROM temp.matching_values')
+      self.db.executemany(
+          'INSERT INTO temp.matching_values (value) VALUES (?)',
+          [(value,) for value in self._values_containing(key, needle)])
+      rows = self.db.execute(select % (
+          'field_values.value IN (SELECT value FROM temp.matching_values)'),
+          (key,))
+    else:
+      raise ValueError('unknown operator %r' % (operator,))
+
+    return self._group_by_dir(rows)
+
+  def _values_containing(self, key, needle):
+    needle_grams = grams(needle)
+
+    if not needle_grams:
+      # Too short to have any n-grams, so check every distinct value instead.
+      candidates = [row[0] for row in self.db.execute(
+          'SELECT DISTINCT value FROM field_values WHERE key = ?', (key,))]
+    else:
+      # Start from the rarest n-gram, which narrows things down the fastest.
+      counted = sorted((self.db.execute(
+          'SELECT COUNT(*) FROM field_grams WHERE key = ? AND gram = ?',
+          (key, gram)).fetchone()[0], gram) for gram in needle_grams)
+      candidates = None
+      for count, gram in counted:
+        found = set(row[0] for row in self.db.execute(
+            'SELECT value FROM field_grams WHERE key = ? AND gram = ?',
+            (key, gram)))
+        candidates = found if candidates is None else candidates & found
+        if not candidates:
+          break
+
+    # Sharing every n-gram doesn't mean they're in the right order.
+    return [value for value in candidates if needle in value]
+
+  def _group_by_dir(self, rows):
+    root = self.root
+    dirpath_for = lambda reldir: os.path.join(root, reldir) if reldir else root
+    loads = mtags.get_json_backend().loads
+    current_dir = None
+    current_file = None
+    all_tracks = []
+
+    for dirpath, tagsfile_id, fields in rows:
+      if dirpath != current_dir:
+        if all_tracks:
+          yield dirpath_for(current_dir), all_tracks
+        current_dir = dirpath
+        all_tracks = []
+        current_file = None
+
+      if tagsfile_id != current_file:
+        current_file = tagsfile_id
+        all_tracks.append([])
+
+      all_tracks[-1].append(loads(fields))
+
+    if all_tracks:
+      yield dirpath_for(current_dir), all_tracks
+
+
+def _successor(prefix):
+  """
+  Returns the smallest string that sorts after every string starting with
+  prefix, or None if there isn't one that can be stored.
+  """
+  while prefix:
+    code = ord(prefix[-1]) + 1
+    if 0xD800 <= code <= 0xDFFF:
+      code = 0xE000
+    if code <= 0x10FFFF:
+      return prefix[:-1] + chr(code)
+    prefix = prefix[:-1]
+  return None
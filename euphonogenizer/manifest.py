@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+import binascii
+import json
+import os
+import re
+import sqlite3
+
+from . import unique
+
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+  path TEXT PRIMARY KEY,
+  src TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  mtime REAL NOT NULL,
+  tags TEXT,
+  cover TEXT
+);
+'''
+
+schema_version = '1'
+
+filename = '.euphonogenizer-sync.db'
+
+# How many changes are kept before they're saved anyway, so an interrupted run
+# only loses what it did since.
+save_every = 200
+
+# Anything from here on in a pattern depends on the track.
+_special = re.compile(r"[%$\[']")
+
+
+def destination_root(pattern):
+  """
+  Returns the directory every file a --to pattern can produce ends up under,
+  which is everything up to the last separator before anything that depends
+  on the track.
+  """
+  match = _special.search(pattern)
+  static = pattern[:match.start()] if match else pattern
+  return os.path.dirname(static) or os.curdir
+
+def tags_digest(track):
+  """
+  Returns a digest of a track's tags, leaving out its filename.
+  """
+  fields = sorted((key, value) for key, value in track.items() if key != '@')
+  return binascii.hexlify(unique.digest(
+      json.dumps(fields, ensure_ascii=False))).decode('ascii')
+
+def cover_digest(cover):
+  """
+  Returns what's recorded for cover art embedded from the file cover: its path,
+  size and mtime, so that editing the image in place counts as a change.
+  """
+  st = os.stat(cover)
+  return json.dumps([os.path.abspath(cover), st.st_size, st.st_mtime],
+                    ensure_ascii=False)
+
+def _copied_from(entry, src):
+  st = os.stat(src)
+  return (entry[0] == os.path.abspath(src) and entry[1] == st.st_size
+          and entry[2] == st.st_mtime)
+
+
+class ManifestUnavailableException(Exception):
+  pass
+
+
+class SyncManifest(object):
+  """
+  A SQLite database kept at the root of a copy's destination, recording for
+  each file copied there the file it was copied from (with its size and mtime
+  then), and for tracks, a digest of the tags written to it and the cover art
+  embedded in it (see cover_digest). If the source still has the same size and
+  mtime, the copy is current, and if the tags and cover are the same too, the
+  track doesn't have to be opened at all.
+
+  tags and cover are None when they aren't known: the file hasn't had its
+  metadata written, or was there before the manifest was. They're the empty
+  string when nothing was written. Changes are saved every save_every changes,
+  and by save(); anything else is thrown away by close().
+  """
+
+  def __init__(self, root):
+    self.root = root
+    self.filename = os.path.join(root, filename)
+    self.unsaved = 0
+
+    try:
+      if not os.path.isdir(root):
+        os.makedirs(root)
+      self.db = sqlite3.connect(self.filename)
+      self.db.executescript(_schema)
+      version = self.db.execute(
+          "SELECT value FROM meta WHERE key = 'version'").fetchone()
+    except (OSError, sqlite3.DatabaseError) as e:
+      raise ManifestUnavailableException(
+          "can't use the sync manifest at %s: %s" % (self.filename, e))
+
+    if version is None:
+      self.db.execute(
+          "INSERT INTO meta (key, value) VALUES ('version', ?)",
+          (schema_version,))
+    elif version[0] != schema_version:
+      self.db.close()
+      raise ManifestUnavailableException(
+          'the sync manifest at %s is from an incompatible version'
+          ' (delete it to start over)' % self.filename)
+
+  def _relpath(self, dst):
+    return os.path.relpath(dst, self.root)
+
+  def _changed(self):
+    self.unsaved += 1
+    if self.unsaved >= save_every:
+      self.save()
+
+  def get(self, dst):
+    """
+    Returns (src, size, mtime, tags, cover) for dst, or None if it isn't in
+    the manifest.
+    """
+    return self.db.execute(
+        'SELECT src, size, mtime, tags, cover FROM files WHERE path = ?',
+        (self._relpath(dst),)).fetchone()
+
+  def is_stale(self, dst, src):
+    """
+    Returns True if dst is known to have been copied from something other
+    than src as it is now.
+    """
+    entry = self.get(dst)
+    return entry is not None and not _copied_from(entry, src)
+
+  def is_synced(self, dst, src, tags, cover):
+    """
+    Returns True if dst is known to have been copied from src as it is now,
+    with the given tags digest and cover.
+    """
+    entry = self.get(dst)
+    return (entry is not None and entry[3] == tags and entry[4] == cover
+            and _copied_from(entry, src))
+
+  def record(self, dst, src, tags=None, cover=None):
+    st = os.stat(src)
+    self.db.execute(
+        'INSERT OR REPLACE INTO files (path, src, size, mtime, tags, cover)'
+        ' VALUES (?, ?, ?, ?, ?, ?)',
+        (self._relpath(dst), os.path.abspath(src), st.st_size, st.st_mtime,
+         tags, cover))
+    self._changed()
+
+  def record_metadata(self, dst, src, tags, cover):
+    """
+    Records the tags digest and cover written to dst, which is assumed to have
+    been copied from src if the manifest didn't know about it yet.
+    """
+    cursor = self.db.execute(
+        'UPDATE files SET tags = ?, cover = ? WHERE path = ?',
+        (tags, cover, self._relpath(dst)))
+    if cursor.rowcount == 0:
+      self.record(dst, src, tags, cover)
+    else:
+      self._changed()
+
+  def save(self):
+    self.db.commit()
+    self.unsaved = 0
+
+  def close(self):
+    # Anything not saved is thrown away.
+    self.db.close()
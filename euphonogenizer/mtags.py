@@ -3,22 +3,180 @@
 
 import chardet
 import codecs
-import simplejson
-import sys
+import functools
+import json
+import os
+import shutil
+import tempfile
+
+from json.encoder import encode_basestring
 
 from .common import compat_iteritems
 
 
+# These are the exact settings that foobar2000-compatible M-TAGS files have
+# always been written with. Any backend that serializes for us must produce the
+# same bytes, or every tags file we touch will show up as changed.
+_dump_kwargs = {
+    'ensure_ascii': False,
+    'sort_keys': True,
+    'indent': 3,
+    'separators': (',', ' : '),
+}
+
+
+class JsonBackend(object):
+  def __init__(self, name, loads, dumps):
+    self.name = name
+    self.loads = loads
+    self.dumps = dumps
+
+
+def _load_orjson():
+  import orjson
+  # orjson can't indent by anything other than two spaces, so it only gets to
+  # do the reading. Writing goes through the stdlib encoder, which is
+  # byte-for-byte identical to what simplejson has always produced for us.
+  return JsonBackend(
+      'orjson', orjson.loads, functools.partial(json.dumps, **_dump_kwargs))
+
+def _load_simplejson():
+  import simplejson
+  return JsonBackend('simplejson', simplejson.loads,
+      functools.partial(simplejson.dumps, **_dump_kwargs))
+
+def _load_json():
+  return JsonBackend(
+      'json', json.loads, functools.partial(json.dumps, **_dump_kwargs))
+
+json_backend_loaders = {
+    'orjson': _load_orjson,
+    'simplejson': _load_simplejson,
+    'json': _load_json,
+}
+
+# The order in which 'auto' tries the backends, fastest first.
+json_backend_preference = ['orjson', 'simplejson', 'json']
+
+_backend = None
+
+
+def set_json_backend(name='auto'):
+  """
+  Selects the JSON library used to read and write M-TAGS files. Passing 'auto'
+  picks the fastest one that is installed. Raises ImportError if a specific
+  backend was requested but isn't available.
+  """
+  global _backend
+
+  if name == 'auto':
+    for each in json_backend_preference:
+      try:
+        _backend = json_backend_loaders[each]()
+        break
+      except ImportError:
+        continue
+  else:
+    _backend = json_backend_loaders[name]()
+
+  return _backend
+
+def get_json_backend():
+  if _backend is None:
+    set_json_backend()
+  return _backend
+
+def decode_tags_bytes(tbytes):
+  if tbytes.startswith(codecs.BOM_UTF8):
+    # This is what both foobar2000 and we write, so skip the (slow) detection.
+    encoding = 'utf-8-sig'
+  else:
+    encoding = chardet.detect(tbytes)['encoding'] or 'utf-8'
+
+  return tbytes.decode(encoding)
+
+def loads(tbytes):
+  return get_json_backend().loads(decode_tags_bytes(tbytes))
+
+
+class _UnsupportedLayout(Exception):
+  pass
+
+
+def _dumps_value(value, indent):
+  if isinstance(value, str):
+    return encode_basestring(value)
+  elif isinstance(value, list):
+    if not value:
+      return '[]'
+    for each in value:
+      if not isinstance(each, str):
+        raise _UnsupportedLayout()
+    sep = ',\n' + indent + '   '
+    return ('[\n' + indent + '   '
+        + sep.join([encode_basestring(each) for each in value])
+        + '\n' + indent + ']')
+  raise _UnsupportedLayout()
+
+def _dumps_fast(desaturated):
+  # M-TAGS files are always a list of flat objects whose values are strings or
+  # lists of strings. Laying that out by hand is much faster than going through
+  # an indenting encoder, which (in every JSON library) falls back to pure
+  # Python. Anything else is handed to the backend.
+  if not desaturated:
+    return '[]'
+
+  chunks = ['[']
+  track_sep = '\n   '
+
+  for track in desaturated:
+    chunks.append(track_sep)
+    track_sep = ',\n   '
+
+    if not isinstance(track, dict):
+      raise _UnsupportedLayout()
+
+    if not track:
+      chunks.append('{}')
+      continue
+
+    field_sep = '{\n      '
+    for key in sorted(track):
+      if not isinstance(key, str):
+        raise _UnsupportedLayout()
+      chunks.append(field_sep)
+      chunks.append(encode_basestring(key))
+      chunks.append(' : ')
+      chunks.append(_dumps_value(track[key], '      '))
+      field_sep = ',\n      '
+
+    chunks.append('\n   }')
+
+  chunks.append('\n]')
+  return ''.join(chunks)
+
+def dumps(desaturated):
+  try:
+    return _dumps_fast(desaturated)
+  except _UnsupportedLayout:
+    return get_json_backend().dumps(desaturated)
+
+def count_tracks(filename):
+  """
+  Returns the number of tracks in a tags file without saturating them, which
+  is all that's needed to count them.
+  """
+  with open(filename, 'rb') as tags:
+    return len(loads(tags.read()))
+
+
 class TagsFile:
   def __init__(self, filenameorlist):
     if isinstance(filenameorlist, list):
       self.tracks = filenameorlist
     else:
       with open(filenameorlist, 'rb') as tags:
-        tbytes = tags.read()
-        tagsjson = simplejson.loads(
-            tbytes, encoding=chardet.detect(tbytes)['encoding'])
-        self._process_saturated_tags(tagsjson)
+        self._process_saturated_tags(loads(tags.read()))
 
   def _process_saturated_tags(self, tagsjson):
     self.tracks = []
@@ -55,8 +213,61 @@ class TagsFile:
         desaturated.append(current_desaturated)
     return desaturated
 
-  def write(self, filename):
-    with codecs.open(filename, 'w', encoding='utf-8-sig') as fp:
-      simplejson.dump(self.desaturate(), fp,
-          ensure_ascii=False, sort_keys=True, indent=3, separators=(',', ' : '))
-      fp.write('\n')
+  def to_bytes(self):
+    return (codecs.BOM_UTF8
+        + dumps(self.desaturate()).encode('utf-8') + b'\n')
+
+  def write(self, filename, only_if_changed=False):
+    """
+    Writes the tags to filename. With only_if_changed, the serialized tags are
+    first compared against what is already on disk, and the file is only
+    (atomically) replaced when they differ, which leaves the mtime of unchanged
+    files alone. Returns whether the file was written.
+    """
+    tbytes = self.to_bytes()
+
+    if not only_if_changed:
+      with open(filename, 'wb') as fp:
+        fp.write(tbytes)
+      return True
+
+    if has_same_contents(filename, tbytes):
+      return False
+
+    replace_atomically(filename, tbytes)
+    return True
+
+
+def has_same_contents(filename, tbytes):
+  try:
+    if os.path.getsize(filename) != len(tbytes):
+      return False
+    with open(filename, 'rb') as fp:
+      return fp.read() == tbytes
+  except (IOError, OSError):
+    return False
+
+def replace_atomically(filename, tbytes):
+  dirname, basename = os.path.split(filename)
+  fd, tmpname = tempfile.mkstemp(
+      prefix='.' + basename + '.', suffix='.tmp', dir=dirname or os.curdir)
+
+  try:
+    with os.fdopen(fd, 'wb') as fp:
+      fp.write(tbytes)
+
+    if os.path.exists(filename):
+      shutil.copymode(filename, tmpname)
+    else:
+      # mkstemp always creates files as 0600, which isn't what open() would do.
+      umask = os.umask(0)
+      os.umask(umask)
+      os.chmod(tmpname, 0o666 & ~umask)
+
+    os.replace(tmpname, filename)
+  except:
+    try:
+      os.remove(tmpname)
+    except OSError:
+      pass
+    raise
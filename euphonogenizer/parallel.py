@@ -0,0 +1,275 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+import collections
+import io
+import multiprocessing
+import multiprocessing.pool
+import os
+import signal
+import threading
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+from . import common
+from . import mtags
+
+
+# The command each worker formats tracks with, if it was given one.
+_command = None
+
+def _init_worker(json_backend, command=None):
+  global _command
+  # Ctrl+C is handled by the main process, which tears the pool down.
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  mtags.set_json_backend(json_backend)
+  if command is not None:
+    command_class, args, titleformatter, fileformatter = command
+    _command = command_class(args, titleformatter, fileformatter)
+
+def create_pool(jobs, command=None):
+  """
+  Creates a pool of worker processes. If command is given, it should be
+  (command class, args, titleformatter, fileformatter), and each worker builds
+  its own copy of the command from those for format_tags to use.
+  """
+  return multiprocessing.Pool(jobs, initializer=_init_worker,
+      initargs=(mtags.get_json_backend().name, command))
+
+def load_tags(task):
+  """
+  Parses and saturates every tags file in a single directory. Only the tracks
+  are sent back, since they're all the main process needs to rebuild TagsFiles.
+  """
+  dirpath, all_tags = task
+  return dirpath, [mtags.TagsFile(os.path.join(dirpath, tagsfile)).tracks
+                   for tagsfile in all_tags]
+
+def format_tags(task):
+  """
+  Like load_tags, but also formats the tracks with the worker's command, so
+  only what the command makes of each track has to be sent back.
+  """
+  dirpath, all_tags = task
+  return dirpath, [
+      _command.format_all_tracks(
+          mtags.TagsFile(os.path.join(dirpath, tagsfile)).tracks)
+      for tagsfile in all_tags]
+
+def count_tags(task):
+  dirpath, all_tags = task
+  return dirpath, [mtags.count_tracks(os.path.join(dirpath, tagsfile))
+                   for tagsfile in all_tags]
+
+def write_metadata(task):
+  """
+  Writes the metadata of a single copied track with the worker's command (see
+  CopyCommand.write_track_metadata). Whatever the command prints is captured
+  and sent back along with its results, for the main process to print, and so
+  are the number of files it saved and rewrote in full, for it to count.
+  """
+  handler = _command.metadata_handler
+  writes = handler.writes
+  rewrites = handler.rewrites
+  captured = io.StringIO()
+  common.set_output(common.OutputSink(captured, interactive=False))
+  try:
+    changed, written = _command.write_track_metadata(*task)
+    return (changed, written, captured.getvalue(), handler.writes - writes,
+            handler.rewrites - rewrites)
+  finally:
+    common.set_output(None)
+
+
+class OrderedPoolMap(object):
+  """
+  Maps func over tasks in a pool, yielding results in the order of the tasks.
+
+  Pool.imap on its own will happily read every task and keep every finished
+  result around while the consumer is busy, so this only lets a bounded number
+  of tasks be in flight at once. Always close() it (or use it as a context
+  manager), even if you stop iterating early.
+  """
+
+  def __init__(self, pool, jobs, func, tasks, chunksize=4):
+    max_in_flight = jobs * chunksize * 4
+
+    self._pool = pool
+    self._func = func
+    self._tasks = tasks
+    self._chunksize = chunksize
+    self._in_flight = threading.Semaphore(max_in_flight)
+    self._max_in_flight = max_in_flight
+    self._stopped = False
+
+  def _throttled_tasks(self):
+    for task in self._tasks:
+      self._in_flight.acquire()
+      if self._stopped:
+        return
+      yield task
+
+  def __iter__(self):
+    results = self._pool.imap(
+        self._func, self._throttled_tasks(), self._chunksize)
+    for result in results:
+      self._in_flight.release()
+      yield result
+
+  def close(self):
+    # Unblock the pool's task feeder if it's waiting on us, or terminate()
+    # would wait for it forever.
+    self._stopped = True
+    for i in range(self._max_in_flight + 1):
+      self._in_flight.release()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+
+class StagedPipeline(object):
+  """
+  Runs work through two stages. The first stage runs in a pool of io_jobs
+  threads, which suits I/O-bound work like copying files. The second runs in
+  pool, a process pool of jobs workers, or on the calling thread if pool is
+  None; with a pool, second_stage has to be picklable.
+
+  Work finishes in the order it was submitted, and on_done(task, result) is
+  called on the calling thread with the result of each second stage. If
+  on_first_done is given, on_first_done(first) is called there too once each
+  first stage has finished without raising. At most
+  max_in_flight pieces of work are in either stage at once, so submit() blocks
+  until there's room. That keeps a fast producer from getting arbitrarily far
+  ahead of the slowest stage. Always close() it (or use it as a context
+  manager), and terminate() it instead if you're giving up on the work.
+  """
+
+  def __init__(self, io_jobs, first_stage, second_stage, on_done, pool=None,
+      jobs=1, max_in_flight=None, on_first_done=None):
+    if max_in_flight is None:
+      max_in_flight = (io_jobs + jobs) * 4
+
+    self._io_pool = multiprocessing.pool.ThreadPool(io_jobs)
+    self._pool = pool
+    self._first_stage = first_stage
+    self._second_stage = second_stage
+    self._on_done = on_done
+    self._on_first_done = on_first_done
+    self._max_in_flight = max_in_flight
+    self._pending = collections.deque()
+
+  def _run_first_stage(self, first, second):
+    self._first_stage(first)
+    if second is not None and self._pool is not None:
+      # Hand off to the second stage right away rather than waiting for the
+      # calling thread to get around to it.
+      return self._pool.apply_async(self._second_stage, (second,))
+
+  def submit(self, first, second=None):
+    """
+    Queues first for the first stage and then, if it isn't None, second for
+    the second stage.
+    """
+    while len(self._pending) >= self._max_in_flight:
+      self._finish_oldest()
+
+    self._pending.append((second, first, self._io_pool.apply_async(
+        self._run_first_stage, (first, second))))
+
+    # Without a process pool, the second stage runs here, so keep it busy with
+    # whatever has made it through the first stage so far.
+    while self._pending and self._pending[0][2].ready():
+      self._finish_oldest()
+
+  def _finish_oldest(self):
+    second, first, first_result = self._pending.popleft()
+    handoff = first_result.get()
+    if self._on_first_done is not None:
+      self._on_first_done(first)
+    if second is None:
+      return
+    if handoff is None:
+      result = self._second_stage(second)
+    else:
+      result = handoff.get()
+    self._on_done(second, result)
+
+  def close(self):
+    """
+    Waits for everything submitted to get through both stages.
+    """
+    try:
+      while self._pending:
+        self._finish_oldest()
+    except BaseException:
+      self.terminate()
+      raise
+    self._io_pool.close()
+    self._io_pool.join()
+
+  def terminate(self):
+    self._pending.clear()
+    self._io_pool.terminate()
+    self._io_pool.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    if exc_type is None:
+      self.close()
+    else:
+      self.terminate()
+
+
+class BackgroundIterator(object):
+  """
+  Runs an iterator in a daemon thread so that a slow producer (like a walk over
+  a network share) can run ahead of its consumer. Items are handed over through
+  a queue in order. total is the sum of weigh(item) over everything produced so
+  far, and done is set once the producer is exhausted.
+  """
+
+  _end = object()
+
+  def __init__(self, iterable, weigh=None):
+    self.total = 0
+    self.done = False
+    self._iterable = iterable
+    self._weigh = weigh or (lambda item: 1)
+    self._queue = queue.Queue()
+    self._thread = threading.Thread(target=self._produce)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _produce(self):
+    try:
+      for item in self._iterable:
+        self.total += self._weigh(item)
+        self._queue.put(item)
+    except BaseException as e:
+      self._queue.put(_BackgroundError(e))
+    finally:
+      self.done = True
+      self._queue.put(self._end)
+
+  def __iter__(self):
+    while True:
+      item = self._queue.get()
+      if item is self._end:
+        return
+      if isinstance(item, _BackgroundError):
+        raise item.error
+      yield item
+
+
+class _BackgroundError(object):
+  def __init__(self, error):
+    self.error = error
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+import csv
+import json
+
+
+class _LineBuffer(object):
+  # Just enough of a file for csv.writer to write a single row into.
+  def __init__(self):
+    self.data = ''
+
+  def write(self, data):
+    self.data += data
+
+
+class JsonLinesWriter(object):
+  """
+  Formats each row as a JSON object on a line of its own, with the column
+  names as keys in the order they were given.
+  """
+
+  def __init__(self, names):
+    self.names = names
+
+  def header(self):
+    return None
+
+  def format_row(self, values):
+    return json.dumps(
+        dict(zip(self.names, values)), ensure_ascii=False, sort_keys=False)
+
+
+class DelimitedWriter(object):
+  """
+  Formats rows as CSV (or TSV, with dialect='excel-tab'), with the column names
+  as the first row.
+  """
+
+  def __init__(self, names, dialect='excel'):
+    self.names = names
+    self.buffer = _LineBuffer()
+    self.writer = csv.writer(self.buffer, dialect, lineterminator='')
+
+  def header(self):
+    return self.format_row(self.names)
+
+  def format_row(self, values):
+    self.buffer.data = ''
+    self.writer.writerow(values)
+    return self.buffer.data
+
+
+def create_writer(output_format, names):
+  if output_format == 'jsonl':
+    return JsonLinesWriter(names)
+  elif output_format == 'csv':
+    return DelimitedWriter(names)
+  elif output_format == 'tsv':
+    return DelimitedWriter(names, 'excel-tab')
+  raise ValueError('unknown output format %r' % (output_format,))
+
+def parse_column(spec, names=()):
+  """
+  Splits a NAME=PATTERN column specification, raising ValueError if there's no
+  name or it's one of names (the columns already parsed), since JSON Lines
+  output would quietly keep only one of them.
+  """
+  name, sep, pattern = spec.partition('=')
+  if not sep or not name:
+    raise ValueError("column '%s' should look like NAME=PATTERN" % spec)
+  if name in names:
+    raise ValueError("there's more than one column named '%s'" % name)
+  return name, pattern
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+import heapq
+import json
+import os
+import zlib
+
+
+def parse_shard(value):
+  """
+  Parses K/N into (K, N), raising ValueError unless 1 <= K <= N.
+  """
+  k, sep, n = value.partition('/')
+  try:
+    k, n = int(k), int(n)
+  except ValueError:
+    raise ValueError("shard '%s' should look like K/N, as in 1/4" % value)
+  if not 1 <= k <= n:
+    raise ValueError("shard '%s' should have 1 <= K <= N" % value)
+  return k, n
+
+def shard_of(reldir, n):
+  """
+  Returns the shard (1 to n) a directory belongs to, given its path relative
+  to the top of the library with forward slashes. This only depends on the
+  path, so every machine agrees on it.
+  """
+  return zlib.crc32(reldir.encode('utf-8', 'surrogatepass')) % n + 1
+
+
+class ShardFilter(object):
+  """
+  Wraps a walk (see walk.walk) so that it only yields the directories in shard
+  k of n. The walk still has to go everywhere to find them.
+
+  Each directory is also given a key: the position of each directory on the
+  way down to it among its siblings, in the order they were walked. Sorting by
+  key puts directories back in walk order, which is how output from separate
+  shards is merged. If keys is a dict, the key of every directory yielded is
+  stored in it by dirpath, and should be popped once used.
+  """
+
+  def __init__(self, walker, top, k, n, keys=None):
+    self.walker = walker
+    self.top = top
+    self.k = k
+    self.n = n
+    self.keys = keys
+
+  def __iter__(self):
+    pending_keys = {self.top: ()}
+
+    for dirpath, dirs, files in self.walker:
+      key = pending_keys.pop(dirpath, ())
+      for position, entry in enumerate(dirs):
+        pending_keys[entry.path] = key + (position,)
+
+      reldir = os.path.relpath(dirpath, self.top)
+      if reldir == os.curdir:
+        reldir = ''
+      reldir = reldir.replace(os.sep, '/')
+
+      if shard_of(reldir, self.n) == self.k:
+        if self.keys is not None:
+          self.keys[dirpath] = key
+        yield dirpath, dirs, files
+
+
+def write_record(record):
+  return json.dumps(record, ensure_ascii=False, sort_keys=True)
+
+def _read_lines(filename):
+  with open(filename, 'rb') as f:
+    for line in f:
+      if line.strip():
+        yield json.loads(line.decode('utf-8'))
+
+def read_records(filename):
+  """
+  Reads the output of a --mergeable run, returning its header and an iterator
+  over the rest of its records. The file is closed once the iterator is used
+  up (or closed).
+  """
+  lines = _read_lines(filename)
+  try:
+    header = next(lines)
+  except StopIteration:
+    raise ValueError('%s is empty' % filename)
+  if 'shard' not in header:
+    lines.close()
+    raise ValueError("%s wasn't written with --mergeable" % filename)
+  return header, lines
+
+def merge_records(all_records):
+  """
+  Merges the records of each shard (each already in walk order) into a single
+  stream in walk order. Records without a key (totals) come first.
+  """
+  return heapq.merge(
+      *all_records, key=lambda record: tuple(record.get('key', ())))
+
+def check_headers(headers):
+  """
+  Makes sure the headers are from the same command with the same options, and
+  that there's exactly one of each shard. Raises ValueError if not.
+  """
+  options = [dict(header, shard=None) for header in headers]
+  if any(each != options[0] for each in options):
+    raise ValueError('these were not written by the same command and options')
+
+  n = headers[0]['shard'][1]
+  found = sorted(header['shard'][0] for header in headers)
+  if any(header['shard'][1] != n for header in headers):
+    raise ValueError('these were not split into the same number of shards')
+  if found != list(range(1, n + 1)):
+    missing = sorted(set(range(1, n + 1)) - set(found))
+    if missing:
+      raise ValueError('missing shard(s) %s of %d'
+          % (', '.join(str(k) for k in missing), n))
+    raise ValueError('some shards were given more than once')
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+from . import titleformat
+from . import unique
+
+
+def to_number(value):
+  """
+  Reads a formatted value as a number: an int if it is one, otherwise a float
+  if it is one, otherwise whatever intify makes of it (so "320 kbps" is 320).
+  """
+  try:
+    return int(value)
+  except ValueError:
+    pass
+  try:
+    return float(value)
+  except ValueError:
+    return titleformat.intify(value)
+
+
+class GroupStats(object):
+  __slots__ = ('tracks', 'distinct', 'sums')
+
+  def __init__(self, distinct_count, sum_count):
+    self.tracks = 0
+    self.distinct = [set() for i in range(distinct_count)]
+    self.sums = [0] * sum_count
+
+
+class Aggregator(object):
+  """
+  Hash aggregation of tracks by group, in a single pass: how many tracks each
+  group has, how many distinct values each of a number of other patterns has
+  within the group, and the sums of yet more patterns. Distinct values are
+  only kept as digests. Groups are reported in the order they first appeared.
+  """
+
+  def __init__(self, distinct_count=0, sum_count=0):
+    self.distinct_count = distinct_count
+    self.sum_count = sum_count
+    self.groups = {}
+
+  def add_group(self, group):
+    """
+    Returns the stats for group, starting it off with nothing in it (so it's
+    reported even if no track is ever added to it) if it isn't there yet.
+    """
+    stats = self.groups.get(group)
+    if stats is None:
+      stats = self.groups[group] = GroupStats(
+          self.distinct_count, self.sum_count)
+    return stats
+
+  def add(self, group, distinct_values=(), sum_values=()):
+    stats = self.add_group(group)
+    stats.tracks += 1
+    for seen, value in zip(stats.distinct, distinct_values):
+      seen.add(unique.digest(value))
+    for i, value in enumerate(sum_values):
+      stats.sums[i] += to_number(value)
+
+  def results(self):
+    """
+    Yields (group, tracks, [distinct counts], [sums]) for each group.
+    """
+    for group, stats in self.groups.items():
+      yield (group, stats.tracks, [len(seen) for seen in stats.distinct],
+             stats.sums)
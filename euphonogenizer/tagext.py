@@ -68,6 +68,16 @@ def is_mutagen_file(mutagen_file):
     MonkeysAudio, EasyMP3, MP3, MP4, Musepack, OggFLAC, OggSpeex, OggTheora,
     OggVorbis, OggOpus, OptimFROG, SMF, EasyTrueAudio, TrueAudio))
 
+def id3_frames(easytags, leave_out=('APIC',)):
+  """
+  Returns every frame behind a set of EasyID3 tags, including the ones it has
+  no key for (like comments and other TXXX fields), as a sorted list of their
+  reprs. Frames with an ID in leave_out aren't included.
+  """
+  id3 = easytags.__getattribute__('_EasyID3__id3')
+  return sorted(repr(frame) for frame in id3.values()
+                if frame.FrameID not in leave_out)
+
 def url_frame_get(frameid, id3, key):
   urls = [frame.url for frame in id3.getall(frameid)]
   if urls:
@@ -2060,3 +2060,98 @@ def compile_fn_call(current_fn, argv):
   fn = vlookup(current_fn, len(argv))
   return lambda: vcallmarshal(vmarshal(fn(*argv)))
 
+
+class _RecordingTrack(dict):
+  """
+  A copy of a track that remembers every field it's asked for. Formatting only
+  ever looks fields up one at a time; anything that looks at the whole track
+  makes it opaque, and then what was recorded can't be trusted.
+  """
+
+  def __init__(self, track):
+    super(_RecordingTrack, self).__init__(track)
+    self.lookups = []
+    self.opaque = False
+
+  def get(self, key, default=None):
+    self.lookups.append(key)
+    return dict.get(self, key, default)
+
+  def __getitem__(self, key):
+    self.lookups.append(key)
+    return dict.__getitem__(self, key)
+
+  def __contains__(self, key):
+    self.lookups.append(key)
+    return dict.__contains__(self, key)
+
+  def _whole(name):
+    def method(self, *args, **kwargs):
+      self.opaque = True
+      return getattr(dict, name)(self, *args, **kwargs)
+    return method
+
+  __iter__ = _whole('__iter__')
+  __len__ = _whole('__len__')
+  copy = _whole('copy')
+  items = _whole('items')
+  keys = _whole('keys')
+  values = _whole('values')
+
+  del _whole
+
+
+_missing = object()
+
+
+def _hashable(value):
+  return tuple(value) if isinstance(value, list) else value
+
+
+class MemoizingFormatter(object):
+  """
+  Wraps a formatter (anything with format(track, pattern)) to remember what it
+  gave for each pattern, keyed on the values of just the fields the pattern
+  looked up. Another track with the same values for those fields gets the same
+  answer without formatting it again, so a pattern like 'front.jpg' is only
+  ever formatted once, and '%album%.jpg' once per album.
+
+  Since formatting only goes one way for the same values, this is exact even
+  when conditions choose which fields get looked up. Each pattern keeps at
+  most max_results answers, starting over when it runs out.
+  """
+
+  def __init__(self, formatter, max_results=1024):
+    self.formatter = formatter
+    self.max_results = max_results
+    # pattern -> (fields looked up) -> (their values) -> result
+    self._results = {}
+
+  def _values(self, track, fields):
+    return tuple(_hashable(track.get(field, _missing)) for field in fields)
+
+  def format(self, track, pattern):
+    by_fields = self._results.get(pattern)
+    if by_fields:
+      for fields, results in by_fields.items():
+        try:
+          return results[self._values(track, fields)]
+        except (KeyError, TypeError):
+          pass
+
+    recording = _RecordingTrack(track)
+    result = self.formatter.format(recording, pattern)
+    if recording.opaque:
+      return result
+
+    fields = tuple(dict.fromkeys(recording.lookups))
+    try:
+      values = self._values(track, fields)
+      results = self._results.setdefault(pattern, {}).setdefault(fields, {})
+      if len(results) >= self.max_results:
+        results.clear()
+      results[values] = result
+    except TypeError:
+      # Something in the track can't be used as a key.
+      pass
+    return result
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+import hashlib
+import sqlite3
+
+
+# Roughly what one digest costs in memory: the 16 bytes themselves, the bytes
+# object wrapped around them, and its slot in the set.
+_bytes_per_key = 100
+
+
+def digest(*parts):
+  """
+  Returns a 128-bit digest of the given strings. Each part is length-prefixed,
+  so ('ab', 'c') and ('a', 'bc') don't collide.
+  """
+  h = hashlib.blake2b(digest_size=16)
+  for part in parts:
+    encoded = part.encode('utf-8', 'surrogatepass')
+    h.update(str(len(encoded)).encode('ascii') + b':')
+    h.update(encoded)
+  return h.digest()
+
+
+class UniqueKeyStore(object):
+  """
+  Remembers which keys have been seen, keeping only a digest of each. Once the
+  digests in memory would go past max_memory bytes, they're moved to a
+  temporary SQLite database on disk, which SQLite deletes when it's closed.
+  With max_memory of None, everything stays in memory.
+  """
+
+  def __init__(self, max_memory=None):
+    self.max_keys = None
+    if max_memory is not None:
+      self.max_keys = max(1, max_memory // _bytes_per_key)
+    self.recent = set()
+    self.spilled = None
+    self.count = 0
+
+  def __len__(self):
+    return self.count
+
+  def __contains__(self, parts):
+    key = digest(*parts)
+    return key in self.recent or self._is_spilled(key)
+
+  def add(self, *parts):
+    """
+    Records a key made of the given strings, returning True if it hadn't been
+    seen before.
+    """
+    key = digest(*parts)
+
+    if key in self.recent or self._is_spilled(key):
+      return False
+
+    self.recent.add(key)
+    self.count += 1
+
+    if self.max_keys is not None and len(self.recent) >= self.max_keys:
+      self.spill()
+
+    return True
+
+  def _is_spilled(self, key):
+    if self.spilled is None:
+      return False
+    return self.spilled.execute(
+        'SELECT 1 FROM seen WHERE digest = ?', (key,)).fetchone() is not None
+
+  def spill(self):
+    if self.spilled is None:
+      # An empty filename asks SQLite for a private database in a temp file.
+      self.spilled = sqlite3.connect('')
+      self.spilled.execute(
+          'CREATE TABLE seen (digest BLOB PRIMARY KEY) WITHOUT ROWID')
+
+    with self.spilled:
+      self.spilled.executemany(
+          'INSERT INTO seen (digest) VALUES (?)',
+          [(key,) for key in sorted(self.recent)])
+    self.recent = set()
+
+  def close(self):
+    if self.spilled is not None:
+      self.spilled.close()
+      self.spilled = None
+    self.recent = set()
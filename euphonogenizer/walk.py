@@ -0,0 +1,224 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+import collections
+import fnmatch
+import os
+import re
+import stat
+
+try:
+  from os import scandir
+except ImportError:
+  from scandir import scandir
+
+
+# What makes glob treat a pattern as one rather than as a plain path.
+_magic = re.compile(r'[*?[]')
+
+
+def is_hidden(entry):
+  if entry.name.startswith('.'):
+    return True
+  try:
+    # On Windows, DirEntry already has this without another system call.
+    attributes = entry.stat(follow_symlinks=False).st_file_attributes
+    return bool(attributes & stat.FILE_ATTRIBUTE_HIDDEN)
+  except (AttributeError, OSError):
+    return False
+
+
+class ExcludeRules(object):
+  """
+  Glob patterns for things the walk should skip. A pattern with a slash in it
+  is matched against the path relative to the top of the walk (always using
+  forward slashes); otherwise it is matched against the name alone, at any
+  depth. Matching follows fnmatch, so it is case-insensitive on Windows.
+  """
+
+  def __init__(self, patterns=None):
+    self.name_patterns = []
+    self.path_patterns = []
+
+    for each in patterns or []:
+      if '/' in each:
+        self.path_patterns.append(each.strip('/'))
+      else:
+        self.name_patterns.append(each)
+
+  def __bool__(self):
+    return bool(self.name_patterns or self.path_patterns)
+
+  __nonzero__ = __bool__
+
+  def matches(self, name, relpath):
+    for each in self.name_patterns:
+      if fnmatch.fnmatch(name, each):
+        return True
+    for each in self.path_patterns:
+      if fnmatch.fnmatch(relpath, each):
+        return True
+    return False
+
+
+def walk(top, exclude=None, max_depth=None, skip_hidden=False,
+    reltop='', start_depth=0):
+  """
+  Walks the tree under top like os.walk (top-down, without following symlinks
+  to directories), but yields (dirpath, dirs, files) where dirs and files are
+  lists of os.DirEntry, so callers can reuse their type and stat information
+  instead of asking the filesystem again.
+
+  Excluded directories are pruned without being listed. max_depth limits how
+  far below top to descend (0 lists only top itself). Directories that can't be
+  listed are skipped, like os.walk does.
+
+  To walk just part of a larger tree with the same rules, pass the path of top
+  relative to the root of that tree as reltop (with forward slashes), and its
+  depth below the root as start_depth.
+  """
+  rules = exclude if isinstance(exclude, ExcludeRules) else ExcludeRules(exclude)
+  pending = [(top, reltop, start_depth)]
+
+  while pending:
+    dirpath, reldir, depth = pending.pop()
+    dirs = []
+    files = []
+
+    try:
+      entries = scandir(dirpath)
+    except OSError:
+      continue
+
+    try:
+      for entry in entries:
+        relpath = reldir + '/' + entry.name if reldir else entry.name
+
+        if rules and rules.matches(entry.name, relpath):
+          continue
+
+        try:
+          is_dir = entry.is_dir()
+        except OSError:
+          is_dir = False
+
+        if is_dir:
+          if not skip_hidden or not is_hidden(entry):
+            dirs.append((entry, relpath))
+        else:
+          files.append(entry)
+    finally:
+      try:
+        entries.close()
+      except AttributeError:
+        pass
+
+    yield dirpath, [entry for entry, relpath in dirs], files
+
+    if max_depth is not None and depth >= max_depth:
+      continue
+
+    for entry, relpath in reversed(dirs):
+      try:
+        if entry.is_symlink():
+          continue
+      except OSError:
+        continue
+      pending.append((entry.path, relpath, depth + 1))
+
+
+class ListingCache(object):
+  """
+  Lists directories with scandir, and answers glob-style questions about them
+  from then on without going back to the filesystem. Only the max_listings
+  directories asked about most recently are kept, which is plenty when they're
+  asked about in walk order (a directory and its parent, mostly). Anything
+  kept isn't listed again, so only use one for as long as the directories it's
+  asked about can be expected to stay the same.
+  """
+
+  def __init__(self, max_listings=64):
+    self.max_listings = max_listings
+    self._listings = collections.OrderedDict()
+
+  def entries(self, dirname):
+    """
+    Returns an OrderedDict of the names in dirname to their DirEntry, in the
+    order scandir gave them, or None if it can't be listed.
+    """
+    try:
+      listing = self._listings.pop(dirname)
+    except KeyError:
+      pass
+    else:
+      # Put it back as the most recently used.
+      self._listings[dirname] = listing
+      return listing
+
+    try:
+      entries = scandir(dirname or os.curdir)
+    except OSError:
+      listing = None
+    else:
+      try:
+        listing = collections.OrderedDict(
+            (entry.name, entry) for entry in entries)
+      except OSError:
+        listing = None
+      finally:
+        try:
+          entries.close()
+        except AttributeError:
+          pass
+
+    self._listings[dirname] = listing
+    if len(self._listings) > self.max_listings:
+      self._listings.popitem(last=False)
+    return listing
+
+  def glob(self, dirname, pattern):
+    """
+    Returns what glob.glob(os.path.join(dirname, pattern)) would, in the same
+    order, where dirname is taken literally and only pattern (a name, not a
+    path) may have wildcards.
+    """
+    path = os.path.join(dirname, pattern)
+    listing = self.entries(dirname)
+
+    if not _magic.search(pattern):
+      # glob only checks that a plain name exists, and it might exist in
+      # another case on a filesystem that doesn't care.
+      if listing is None:
+        return [path] if os.path.lexists(path) else []
+      if pattern in listing:
+        return [path]
+      lowered = pattern.lower()
+      if any(name.lower() == lowered for name in listing):
+        return [path] if os.path.lexists(path) else []
+      return []
+
+    if listing is None:
+      return []
+
+    names = list(listing)
+    if not pattern.startswith('.'):
+      # glob's wildcards don't match hidden files unless asked to.
+      names = [name for name in names if not name.startswith('.')]
+    return [os.path.join(dirname, name)
+            for name in fnmatch.filter(names, pattern)]
+
+  def isfile(self, path):
+    """
+    Returns os.path.isfile(path), going by what the listing of its directory
+    already knows about it if it can.
+    """
+    dirname, name = os.path.split(path)
+    listing = self.entries(dirname)
+    entry = listing.get(name) if listing is not None else None
+    if entry is None:
+      return os.path.isfile(path)
+    try:
+      return entry.is_file()
+    except OSError:
+      return False
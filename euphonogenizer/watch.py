@@ -0,0 +1,558 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import select
+import socket
+import sqlite3
+import struct
+import sys
+import threading
+import time
+
+from . import index
+from . import mtags
+from . import walk
+
+
+cover_extensions = ('.jpg', '.jpeg', '.png')
+
+
+class WatchUnavailableException(Exception):
+  pass
+
+
+class WatchEvent(object):
+  CHANGED, DELETED, DIR_CREATED, DIR_DELETED, OVERFLOW = range(1, 6)
+
+  def __init__(self, kind, path=None):
+    self.kind = kind
+    self.path = path
+
+  def __eq__(self, other):
+    return (self.kind, self.path) == (other.kind, other.path)
+
+  def __hash__(self):
+    return hash((self.kind, self.path))
+
+
+def _reldir(root, dirpath):
+  reldir = os.path.relpath(dirpath, root)
+  if reldir == os.curdir:
+    return '', 0
+  parts = reldir.split(os.sep)
+  return '/'.join(parts), len(parts)
+
+
+class PollingWatcher(object):
+  """
+  Finds changes by walking the tree every so often and comparing the mtime and
+  size of every interesting file. This works everywhere, including on network
+  shares where inotify never hears about changes made by other machines.
+  """
+
+  def __init__(self, root, walk_options, is_interesting, interval):
+    self.root = root
+    self.walk_options = walk_options
+    self.is_interesting = is_interesting
+    self.interval = interval
+    self.next_poll = time.time() + interval
+    self.snapshot = self.take_snapshot()
+
+  def fileno(self):
+    return None
+
+  def timeout(self):
+    return max(0, self.next_poll - time.time())
+
+  def take_snapshot(self):
+    snapshot = {}
+    for dirpath, dirs, files in walk.walk(self.root, **self.walk_options):
+      for each in files:
+        if self.is_interesting(each.name):
+          try:
+            st = each.stat()
+          except OSError:
+            continue
+          snapshot[each.path] = (st.st_mtime, st.st_size)
+    return snapshot
+
+  def read_events(self):
+    if time.time() < self.next_poll:
+      return []
+
+    current = self.take_snapshot()
+    events = []
+
+    for path, signature in current.items():
+      if self.snapshot.get(path) != signature:
+        events.append(WatchEvent(WatchEvent.CHANGED, path))
+    for path in self.snapshot:
+      if path not in current:
+        events.append(WatchEvent(WatchEvent.DELETED, path))
+
+    self.snapshot = current
+    self.next_poll = time.time() + self.interval
+    return events
+
+  def close(self):
+    pass
+
+
+class InotifyWatcher(object):
+  """
+  Watches every directory in the tree with Linux's inotify, through libc, so
+  that nothing beyond the standard library is needed. New directories are
+  watched (and reported, so their contents can be picked up) as they appear.
+  """
+
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_FROM = 0x00000040
+  IN_MOVED_TO = 0x00000080
+  IN_CREATE = 0x00000100
+  IN_DELETE = 0x00000200
+  IN_DELETE_SELF = 0x00000400
+  IN_MOVE_SELF = 0x00000800
+  IN_Q_OVERFLOW = 0x00004000
+  IN_IGNORED = 0x00008000
+  IN_ONLYDIR = 0x01000000
+  IN_DONT_FOLLOW = 0x02000000
+  IN_ISDIR = 0x40000000
+
+  IN_NONBLOCK = os.O_NONBLOCK
+  IN_CLOEXEC = 0o2000000
+
+  watch_mask = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+      | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+  _event_header = struct.Struct('iIII')
+
+  def __init__(self, root, walk_options, is_interesting):
+    if not sys.platform.startswith('linux'):
+      raise WatchUnavailableException('inotify is only available on Linux')
+
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+      raise WatchUnavailableException("couldn't find the C library")
+
+    self.libc = ctypes.CDLL(libc_name, use_errno=True)
+
+    if not hasattr(self.libc, 'inotify_init1'):
+      raise WatchUnavailableException('this C library has no inotify support')
+
+    self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+    if self.fd < 0:
+      raise WatchUnavailableException(
+          'inotify_init1 failed: ' + os.strerror(ctypes.get_errno()))
+
+    self.root = root
+    self.walk_options = walk_options
+    self.is_interesting = is_interesting
+    self.watches = {}
+
+    self.watch_tree(root)
+
+  def fileno(self):
+    return self.fd
+
+  def timeout(self):
+    return None
+
+  def watch_tree(self, top):
+    """
+    Adds a watch to top and every directory below it, and returns the
+    interesting files that are already there.
+    """
+    reltop, depth = _reldir(self.root, top)
+    found = []
+
+    for dirpath, dirs, files in walk.walk(
+        top, reltop=reltop, start_depth=depth, **self.walk_options):
+      self.add_watch(dirpath)
+      found.extend(each.path for each in files
+                   if self.is_interesting(each.name))
+
+    return found
+
+  def add_watch(self, dirpath):
+    wd = self.libc.inotify_add_watch(
+        self.fd, os.fsencode(dirpath), self.watch_mask)
+    if wd < 0:
+      error = ctypes.get_errno()
+      if error == errno.ENOSPC:
+        raise WatchUnavailableException(
+            'out of inotify watches (raise fs.inotify.max_user_watches)')
+      # The directory went away or can't be read; there's nothing to watch.
+      return
+    self.watches[wd] = dirpath
+
+  def is_excluded(self, dirpath):
+    reldir, depth = _reldir(self.root, dirpath)
+    name = os.path.basename(dirpath)
+    rules = self.walk_options.get('exclude')
+    max_depth = self.walk_options.get('max_depth')
+
+    if rules and rules.matches(name, reldir):
+      return True
+    if max_depth is not None and depth > max_depth:
+      return True
+    if self.walk_options.get('skip_hidden') and name.startswith('.'):
+      return True
+    return False
+
+  def read_events(self):
+    try:
+      data = os.read(self.fd, 1 << 16)
+    except OSError as e:
+      if e.errno == errno.EAGAIN:
+        return []
+      raise
+
+    events = []
+    offset = 0
+
+    while offset < len(data):
+      wd, mask, cookie, length = self._event_header.unpack_from(data, offset)
+      offset += self._event_header.size
+      name = data[offset:offset + length].rstrip(b'\0')
+      offset += length
+
+      if mask & self.IN_Q_OVERFLOW:
+        events.append(WatchEvent(WatchEvent.OVERFLOW))
+        continue
+
+      dirpath = self.watches.get(wd)
+      if dirpath is None:
+        continue
+
+      if mask & self.IN_IGNORED:
+        del self.watches[wd]
+        continue
+
+      if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+        if dirpath != self.root:
+          events.append(WatchEvent(WatchEvent.DIR_DELETED, dirpath))
+        continue
+
+      path = os.path.join(dirpath, os.fsdecode(name))
+
+      if mask & self.IN_ISDIR:
+        if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+          if not self.is_excluded(path):
+            events.append(WatchEvent(WatchEvent.DIR_CREATED, path))
+        elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+          events.append(WatchEvent(WatchEvent.DIR_DELETED, path))
+      elif self.is_interesting(os.path.basename(path)):
+        if mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+          events.append(WatchEvent(WatchEvent.DELETED, path))
+        elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE):
+          events.append(WatchEvent(WatchEvent.CHANGED, path))
+
+    return events
+
+  def close(self):
+    os.close(self.fd)
+
+
+def create_watcher(root, walk_options, is_interesting, poll_interval=None):
+  if poll_interval is None:
+    try:
+      return InotifyWatcher(root, walk_options, is_interesting)
+    except WatchUnavailableException:
+      poll_interval = 10
+
+  return PollingWatcher(root, walk_options, is_interesting, poll_interval)
+
+
+class WatchDaemon(object):
+  """
+  Keeps a LibraryIndex up to date as tags files change, remembers which cover
+  images every directory has, and answers queries about both on a Unix socket.
+
+  The protocol is one JSON request per connection, as a single line, answered
+  by JSON lines ending with {"end": true}, after which the daemon closes the
+  connection. Each connection is answered on its own thread with its own
+  connection to the index, so a slow client doesn't hold up anyone else or the
+  updates. Anything that goes wrong is answered with {"error": message} (even
+  partway through an answer) instead of the end.
+
+    {"query": "tracks"}          -> [dirpath, [[track, ...], ...]] per directory
+    {"query": "covers", "dir": D} -> [name, ...]
+    {"query": "status"}          -> {"root": ..., "tagsfiles": N, "tracks": N}
+  """
+
+  # How long to wait for things to settle after an event before acting on it,
+  # since saving a file usually means a burst of events.
+  settle_time = 0.5
+
+  # How long a client can take to send its request or read the answer before
+  # it's given up on.
+  client_timeout = 30
+
+  def __init__(self, library_index, root, tagsname, socket_path,
+      walk_options, poll_interval=None, log=None):
+    self.index = library_index
+    self.root = root
+    self.tagsname = tagsname
+    self.socket_path = socket_path
+    self.walk_options = walk_options
+    self.poll_interval = poll_interval
+    self.log = log or (lambda message: None)
+    self.covers = {}
+    self.pending = set()
+    self.last_event = 0
+    self.watcher = None
+    self.server = None
+
+  def is_interesting(self, name):
+    return (name == self.tagsname
+            or os.path.splitext(name)[1].lower() in cover_extensions)
+
+  def start(self):
+    # Lets the threads answering queries read while the index is written.
+    self.index.db.execute('PRAGMA journal_mode = WAL')
+    self.server = listen(self.socket_path)
+    self.watcher = create_watcher(
+        self.root, self.walk_options, self.is_interesting, self.poll_interval)
+    self.log('watching %s with %s' % (
+        self.root, self.watcher.__class__.__name__))
+    self.full_refresh()
+
+  def full_refresh(self):
+    covers = {}
+    tagsfiles = []
+
+    for dirpath, dirs, files in walk.walk(self.root, **self.walk_options):
+      for each in files:
+        if each.name == self.tagsname:
+          tagsfiles.append((each.path, each.stat()))
+        elif self.is_interesting(each.name):
+          covers.setdefault(dirpath, set()).add(each.name)
+
+    # The sets are replaced rather than changed from now on, so the threads
+    # answering queries never see one half changed.
+    self.covers = dict((dirpath, frozenset(names))
+                       for dirpath, names in covers.items())
+
+    stats = self.index.refresh(self.root, tagsfiles)
+    self.log_failures(stats)
+    self.log('%d tags files indexed (%d added, %d updated, %d removed)' % (
+        stats.total, stats.added, stats.updated, stats.removed))
+
+  def log_failures(self, stats):
+    for path, e in stats.failed:
+      self.log("couldn't read %s: %s" % (path, e))
+
+  def handle_path(self, path):
+    dirpath, name = os.path.split(path)
+
+    try:
+      st = os.stat(path)
+    except OSError:
+      st = None
+
+    if name == self.tagsname:
+      if st is None:
+        if self.index.remove_tagsfile(path):
+          self.log('removed ' + path)
+      else:
+        stats = self.index.update_tagsfile(path, st)
+        self.log_failures(stats)
+        if stats.added or stats.updated:
+          self.log('indexed ' + path)
+    elif st is None:
+      if name in self.covers.get(dirpath, ()):
+        self.covers[dirpath] = self.covers[dirpath] - frozenset([name])
+    else:
+      self.covers[dirpath] = self.covers.get(dirpath, frozenset()) | frozenset(
+          [name])
+
+  def apply_pending(self):
+    pending, self.pending = self.pending, set()
+
+    for event in pending:
+      if event.kind == WatchEvent.OVERFLOW:
+        self.log('missed some changes; rescanning everything')
+        self.full_refresh()
+        return
+
+    for event in pending:
+      if event.kind == WatchEvent.DIR_DELETED:
+        self.index.remove_dir(event.path)
+        for dirpath in list(self.covers):
+          if dirpath == event.path or dirpath.startswith(event.path + os.sep):
+            del self.covers[dirpath]
+      elif event.kind == WatchEvent.DIR_CREATED:
+        for path in self.watcher.watch_tree(event.path):
+          self.handle_path(path)
+      else:
+        self.handle_path(event.path)
+
+  def serve(self):
+    self.start()
+
+    try:
+      while True:
+        self.run_once()
+    finally:
+      self.stop()
+
+  def run_once(self):
+    readers = [self.server]
+    if self.watcher.fileno() is not None:
+      readers.append(self.watcher)
+
+    timeout = self.watcher.timeout()
+    if self.pending:
+      settle = max(0, self.last_event + self.settle_time - time.time())
+      timeout = settle if timeout is None else min(timeout, settle)
+
+    readable, unused_w, unused_x = select.select(readers, [], [], timeout)
+
+    events = []
+    if self.watcher in readable or self.watcher.fileno() is None:
+      events = self.watcher.read_events()
+    if events:
+      self.pending.update(events)
+      self.last_event = time.time()
+
+    if self.server in readable:
+      thread = threading.Thread(
+          target=self.answer, args=(self.server.accept()[0],))
+      thread.daemon = True
+      thread.start()
+
+    if self.pending and time.time() >= self.last_event + self.settle_time:
+      self.apply_pending()
+
+  def answer(self, connection):
+    library_index = None
+
+    try:
+      connection.settimeout(self.client_timeout)
+      try:
+        request = json.loads(read_line(connection))
+        query = request.get('query')
+      except (ValueError, AttributeError):
+        send_line(connection, {'error': 'the request should be a JSON object'})
+        return
+
+      if query == 'tracks':
+        library_index = index.LibraryIndex(self.index.filename)
+        for dirpath, all_tracks in library_index.iter_dirs():
+          send_line(connection, [dirpath, all_tracks])
+      elif query == 'covers':
+        send_line(connection, sorted(self.covers.get(request.get('dir'), ())))
+      elif query == 'status':
+        library_index = index.LibraryIndex(self.index.filename)
+        tagsfiles, tracks = library_index.count()
+        send_line(connection, {
+            'root': self.root, 'tagsfiles': tagsfiles, 'tracks': tracks})
+      else:
+        send_line(connection, {'error': 'unknown query %r' % (query,)})
+        return
+      send_line(connection, end_of_answer)
+    except (index.IndexUnavailableException, sqlite3.Error, ValueError) as e:
+      try:
+        send_line(connection, {'error': "can't read the index: %s" % e})
+      except socket.error:
+        pass
+    except socket.error:
+      # The client went away (or took too long); that's its problem.
+      pass
+    finally:
+      if library_index is not None:
+        library_index.close()
+      connection.close()
+
+  def stop(self):
+    if self.watcher is not None:
+      self.watcher.close()
+    if self.server is not None:
+      self.server.close()
+      try:
+        os.remove(self.socket_path)
+      except OSError:
+        pass
+
+
+# The last line of every complete answer.
+end_of_answer = {'end': True}
+
+
+def listen(socket_path):
+  if not hasattr(socket, 'AF_UNIX'):
+    raise WatchUnavailableException('Unix sockets are not supported here')
+
+  if os.path.exists(socket_path):
+    try:
+      connect(socket_path).close()
+    except WatchUnavailableException:
+      # Left over from a daemon that didn't shut down cleanly.
+      os.remove(socket_path)
+    else:
+      raise WatchUnavailableException(
+          'a daemon is already listening on ' + socket_path)
+
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.bind(socket_path)
+  server.listen(16)
+  return server
+
+def connect(socket_path):
+  if not hasattr(socket, 'AF_UNIX'):
+    raise WatchUnavailableException('Unix sockets are not supported here')
+
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.connect(socket_path)
+  except socket.error:
+    client.close()
+    raise WatchUnavailableException(
+        'no daemon is listening on %s (start one with the watch command)'
+        % socket_path)
+  return client
+
+def send_line(connection, obj):
+  connection.sendall(json.dumps(obj, ensure_ascii=False).encode('utf-8') + b'\n')
+
+def read_line(connection):
+  chunks = []
+  while True:
+    chunk = connection.recv(4096)
+    if not chunk:
+      break
+    chunks.append(chunk)
+    if b'\n' in chunk:
+      break
+  return b''.join(chunks).split(b'\n', 1)[0].decode('utf-8')
+
+def query(socket_path, request):
+  """
+  Sends a request to the watch daemon and yields each line of the answer. If
+  the daemon answers with an error, or stops before the end of its answer,
+  WatchUnavailableException is raised.
+  """
+  client = connect(socket_path)
+  loads = mtags.get_json_backend().loads
+
+  try:
+    send_line(client, request)
+    for line in client.makefile('rb'):
+      answer = loads(line.decode('utf-8'))
+      if isinstance(answer, dict):
+        if 'error' in answer:
+          raise WatchUnavailableException(
+              'the daemon on %s said: %s' % (socket_path, answer['error']))
+        if answer == end_of_answer:
+          return
+      yield answer
+    raise WatchUnavailableException(
+        'the daemon on %s stopped before the end of its answer' % socket_path)
+  finally:
+    client.close()
@@ -17,12 +17,15 @@ setup(
       "pytest-runner"
     ],
     install_requires = [
-      'simplejson>=3.6.5',
       'mutagen>=1.28',
       'chardet>=2.3.0',
       'colorama>=0.3.7',
       'pillow>=3.2.0',
     ],
+    extras_require = {
+      'fastjson': ['orjson>=3.0'],
+      'simplejson': ['simplejson>=3.6.5'],
+    },
     tests_require = [
       "pytest"
     ],
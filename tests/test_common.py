@@ -0,0 +1,36 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+from euphonogenizer import common
+
+import io
+import os
+
+
+class Stream(io.TextIOWrapper):
+  def __init__(self, interactive):
+    super(Stream, self).__init__(io.BytesIO(), encoding='latin-1')
+    self.interactive = interactive
+
+  def isatty(self):
+    return self.interactive
+
+
+def test_output_is_buffered_until_flushed():
+  stream = Stream(interactive=False)
+  sink = common.OutputSink(stream)
+  sink.write(u'caf\xe9 ♫')
+  sink.write(u'second', end='')
+  assert stream.buffer.getvalue() == b''
+
+  sink.flush()
+  assert stream.buffer.getvalue() == (
+      b'caf\xe9 ?' + os.linesep.encode('ascii') + b'second')
+
+
+def test_interactive_output_is_written_right_away():
+  stream = Stream(interactive=True)
+  sink = common.OutputSink(stream)
+  sink.write(u'line', end='\n')
+  assert stream.buffer.getvalue() == b'line\n'
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+from euphonogenizer import fastcopy
+
+import errno
+import os
+import pytest
+
+
+@pytest.fixture
+def src(tmp_path):
+  path = tmp_path / 'src.flac'
+  path.write_bytes(os.urandom(300000))
+  os.chmod(str(path), 0o640)
+  os.utime(str(path), (1000000000, 1200000000))
+  return path
+
+
+def assert_copied(src, dst):
+  assert dst.read_bytes() == src.read_bytes()
+  st = os.stat(str(dst))
+  assert st.st_mode & 0o777 == 0o640
+  assert int(st.st_mtime) == 1200000000
+
+
+def test_copy(src, tmp_path):
+  copier = fastcopy.FileCopier()
+  dst = tmp_path / 'dst.flac'
+  method = copier.copy(str(src), str(dst))
+  assert_copied(src, dst)
+  assert copier.counts == {method: 1}
+  assert copier.summary() == '1 file copied (1 by %s)' % method
+
+
+def test_falls_back(src, tmp_path, monkeypatch):
+  attempts = []
+
+  def unsupported(infd, outfd, size):
+    attempts.append('unsupported')
+    # Leave a mess behind, which the next method shouldn't see.
+    os.write(outfd, b'partial')
+    raise OSError(errno.EXDEV, 'cross-device')
+
+  def short(infd, outfd, size):
+    attempts.append('short')
+    return False
+
+  monkeypatch.setattr(fastcopy, 'kernel_methods',
+      [('unsupported', unsupported), ('short', short)])
+
+  copier = fastcopy.FileCopier()
+  for n in range(3):
+    dst = tmp_path / ('dst%d.flac' % n)
+    assert copier.copy(str(src), str(dst)) == 'copy2'
+    assert_copied(src, dst)
+
+  # Neither is tried again once it's failed for these devices.
+  assert attempts == ['unsupported', 'short']
+  assert copier.summary() == '3 files copied (3 by copy2)'
+
+
+def test_real_errors_are_raised(src, tmp_path, monkeypatch):
+  def broken(infd, outfd, size):
+    raise OSError(errno.ENOSPC, 'no space left')
+
+  monkeypatch.setattr(fastcopy, 'kernel_methods', [('broken', broken)])
+
+  with pytest.raises(OSError):
+    fastcopy.FileCopier().copy(str(src), str(tmp_path / 'dst.flac'))
+
+
+def test_copy_all(src, tmp_path):
+  copier = fastcopy.FileCopier()
+  dirname = tmp_path / 'a' / 'b'
+  copier.copy_all([(str(dirname), str(src), str(dirname / 'dst.flac'), None)])
+  assert_copied(src, dirname / 'dst.flac')
+
+
+def test_links(src, tmp_path):
+  copier = fastcopy.FileCopier()
+  hard = tmp_path / 'hard.flac'
+  sym = tmp_path / 'sym.flac'
+  assert copier.copy(str(src), str(hard), 'hard') == 'hardlink'
+  assert copier.copy(str(src), str(sym), 'sym') == 'symlink'
+  assert os.path.samefile(str(hard), str(src))
+  assert os.readlink(str(sym)) == str(src)
+  assert copier.summary() == '2 files copied (1 by hardlink, 1 by symlink)'
+
+
+@pytest.mark.parametrize('link,error', [
+    ('hard', errno.EXDEV),
+    ('hard', errno.EMLINK),
+    ('hard', errno.EPERM),
+    ('sym', errno.EPERM),
+])
+def test_link_falls_back_to_copy(src, tmp_path, monkeypatch, link, error):
+  def unlinkable(src, dst):
+    raise OSError(error, os.strerror(error))
+
+  monkeypatch.setattr(os, 'link', unlinkable)
+  monkeypatch.setattr(os, 'symlink', unlinkable)
+
+  dst = tmp_path / 'dst.flac'
+  assert fastcopy.FileCopier().copy(str(src), str(dst), link) not in (
+      'hardlink', 'symlink')
+  assert_copied(src, dst)
@@ -0,0 +1,40 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+from euphonogenizer import grouping
+
+import pytest
+
+
+def grouped(output):
+  return [(group, list(lines)) for group, lines in output.groups()]
+
+
+@pytest.mark.parametrize('max_memory', [None, 0, 2000])
+def test_groups_keep_first_seen_order(max_memory):
+  output = grouping.GroupedOutput(max_memory)
+  expected = {}
+
+  for n in range(500):
+    group = 'group %d' % (n * 7 % 13)
+    line = 'line %d' % n
+    output.add(group, line)
+    expected.setdefault(group, []).append(line)
+
+  assert grouped(output) == list(expected.items())
+  assert grouped(output) == []
+
+
+@pytest.mark.parametrize('max_memory', [None, 0, 2000])
+def test_external_sort_is_stable_with_mixed_directions(max_memory):
+  sorter = grouping.ExternalSorter(max_memory)
+  items = [(n % 3, 'line %d' % (n % 5), n) for n in range(300)]
+
+  for first, second, n in items:
+    sorter.add((first, grouping.Descending(second)), n)
+
+  expected = sorted(items, key=lambda item: item[1], reverse=True)
+  expected = sorted(expected, key=lambda item: item[0])
+  assert [n for key, n in sorter.drain()] == [
+      n for first, second, n in expected]
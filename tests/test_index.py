@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+from euphonogenizer import index
+from euphonogenizer import mtags
+
+import os
+import pytest
+
+
+def write_album(root, name, titles):
+  dirpath = os.path.join(root, name)
+  if not os.path.isdir(dirpath):
+    os.makedirs(dirpath)
+  tracks = [{'@': '%02d.flac' % n, 'ALBUM': name, 'TITLE': title}
+            for n, title in enumerate(titles)]
+  mtags.TagsFile(tracks).write(os.path.join(dirpath, '!.tags'))
+  return tracks
+
+
+def tagsfiles(root):
+  for dirpath, dirnames, filenames in os.walk(root):
+    dirnames.sort()
+    if '!.tags' in filenames:
+      path = os.path.join(dirpath, '!.tags')
+      yield path, os.stat(path)
+
+
+def test_refresh_and_read_back(tmp_path):
+  root = str(tmp_path / 'library')
+  one = write_album(root, 'One', ['a', 'b'])
+  two = write_album(root, 'Two', ['c'])
+  dbfile = str(tmp_path / 'index.db')
+
+  library_index = index.LibraryIndex(dbfile, create=True)
+  stats = library_index.refresh(root, tagsfiles(root))
+  assert (stats.added, stats.unchanged) == (2, 0)
+  assert list(library_index.iter_dirs()) == [
+      (os.path.join(root, 'One'), [one]),
+      (os.path.join(root, 'Two'), [two]),
+  ]
+  library_index.close()
+
+  two = write_album(root, 'Two', ['c', 'd', 'e'])
+  os.remove(os.path.join(root, 'One', '!.tags'))
+
+  library_index = index.LibraryIndex(dbfile)
+  stats = library_index.refresh(root, tagsfiles(root))
+  assert (stats.added, stats.updated, stats.removed) == (0, 1, 1)
+  assert list(library_index.iter_dirs()) == [(os.path.join(root, 'Two'), [two])]
+  library_index.close()
+
+
+def test_refresh_skips_unreadable_tags(tmp_path):
+  root = str(tmp_path / 'library')
+  write_album(root, 'One', ['a'])
+  write_album(root, 'Two', ['b'])
+  dbfile = str(tmp_path / 'index.db')
+
+  library_index = index.LibraryIndex(dbfile, create=True)
+  library_index.refresh(root, tagsfiles(root))
+
+  broken = os.path.join(root, 'Two', '!.tags')
+  with open(broken, 'w') as f:
+    f.write('[{"TITLE": ')
+  write_album(root, 'Three', ['c'])
+
+  stats = library_index.refresh(root, tagsfiles(root))
+  assert (stats.added, stats.unchanged, stats.removed) == (1, 1, 0)
+  assert [path for path, e in stats.failed] == [broken]
+  # What was indexed for the broken file before is still there.
+  assert [dirpath for dirpath, tracks in library_index.iter_dirs()] == [
+      os.path.join(root, name) for name in ('One', 'Three', 'Two')]
+  library_index.close()
+
+
+def test_index_moves_with_the_library(tmp_path):
+  root = str(tmp_path / 'library')
+  one = write_album(root, 'One', ['a'])
+  library_index = index.LibraryIndex(
+      os.path.join(root, 'index.db'), create=True)
+  library_index.refresh(root, tagsfiles(root))
+  library_index.close()
+
+  moved = str(tmp_path / 'moved')
+  os.rename(root, moved)
+  library_index = index.LibraryIndex(os.path.join(moved, 'index.db'))
+  assert library_index.root == moved
+  assert list(library_index.iter_dirs()) == [
+      (os.path.join(moved, 'One'), [one])]
+  library_index.close()
+
+
+def test_missing_index(tmp_path):
+  with pytest.raises(index.IndexUnavailableException):
+    index.LibraryIndex(str(tmp_path / 'nope.db'))
+
+
+def test_field_lookup(tmp_path):
+  root = str(tmp_path / 'library')
+  one = write_album(root, 'One', ['apple', 'banana', 'grape'])
+  two = write_album(root, 'Two', ['pineapple', 'ap'])
+  library_index = index.LibraryIndex(str(tmp_path / 'index.db'), create=True)
+  library_index.refresh(root, tagsfiles(root))
+
+  title = lambda track: track['TITLE']
+  assert library_index.update_field('title', title) == 5
+  assert library_index.update_field('title', title) == 0
+
+  def titles(operator, needle):
+    return [[track['TITLE'] for tracks in all_tracks for track in tracks]
+            for dirpath, all_tracks in
+            library_index.iter_dirs_where('title', operator, needle)]
+
+  assert titles('equals', 'banana') == [['banana']]
+  assert titles('startswith', 'ap') == [['apple'], ['ap']]
+  assert titles('startswith', '') == [['apple', 'banana', 'grape'],
+                                      ['pineapple', 'ap']]
+  assert titles('contains', 'apple') == [['apple'], ['pineapple']]
+  assert titles('contains', 'ra') == [['grape']]
+  assert titles('contains', 'elppa') == []
+
+  write_album(root, 'Two', ['papaya'])
+  library_index.refresh(root, tagsfiles(root))
+  assert library_index.update_field('title', title) == 1
+  assert titles('contains', 'pa') == [['papaya']]
+  assert titles('startswith', 'p') == [['papaya']]
+  library_index.close()
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+from euphonogenizer import manifest
+
+import os
+import pytest
+
+
+@pytest.mark.parametrize('pattern,root', [
+    ('/mnt/usb/%artist%/%title%', '/mnt/usb'),
+    ('/mnt/usb/Music/$lower(%artist%)/%title%', '/mnt/usb/Music'),
+    ('/mnt/usb/Mu%genre%/%title%', '/mnt/usb'),
+    ("/mnt/'usb'/%title%", '/mnt'),
+    ('%artist%/%title%', os.curdir),
+])
+def test_destination_root(pattern, root):
+  assert manifest.destination_root(pattern) == root
+
+
+def test_tags_digest():
+  track = {'@': 'a.flac', 'ARTIST': 'A', 'TITLE': 'T'}
+  same = {'TITLE': 'T', 'ARTIST': 'A', '@': 'b.flac'}
+  assert manifest.tags_digest(track) == manifest.tags_digest(same)
+  assert manifest.tags_digest(track) != manifest.tags_digest(
+      dict(track, TITLE='U'))
+
+
+def test_cover_digest(tmp_path):
+  cover = tmp_path / 'front.jpg'
+  cover.write_bytes(b'image')
+  digest = manifest.cover_digest(str(cover))
+  assert manifest.cover_digest(str(cover)) == digest
+
+  cover.write_bytes(b'another image')
+  assert manifest.cover_digest(str(cover)) != digest
+
+
+def test_manifest(tmp_path):
+  src = tmp_path / 'src.flac'
+  src.write_bytes(b'audio')
+  root = tmp_path / 'dst'
+  dst = str(root / 'a' / 'b.flac')
+
+  m = manifest.SyncManifest(str(root))
+  assert m.get(dst) is None
+  assert not m.is_stale(dst, str(src))
+  assert not m.is_synced(dst, str(src), '', '')
+
+  m.record(dst, str(src))
+  assert not m.is_stale(dst, str(src))
+  assert not m.is_synced(dst, str(src), '', '')
+
+  m.record_metadata(dst, str(src), 'tags', '')
+  assert m.is_synced(dst, str(src), 'tags', '')
+  assert not m.is_synced(dst, str(src), 'other', '')
+  m.save()
+
+  m.record_metadata(str(root / 'unknown.flac'), str(src), 'tags', '')
+  m.close()
+
+  src.write_bytes(b'more audio')
+  m = manifest.SyncManifest(str(root))
+  assert m.is_stale(dst, str(src))
+  assert not m.is_synced(dst, str(src), 'tags', '')
+  # It wasn't saved.
+  assert m.get(str(root / 'unknown.flac')) is None
+  m.close()
+
+
+def test_manifest_saves_as_it_goes(tmp_path, monkeypatch):
+  monkeypatch.setattr(manifest, 'save_every', 2)
+  src = tmp_path / 'src.flac'
+  src.write_bytes(b'audio')
+  root = str(tmp_path / 'dst')
+
+  m = manifest.SyncManifest(root)
+  for name in ('a.flac', 'b.flac', 'c.flac'):
+    m.record(os.path.join(root, name), str(src))
+  m.close()
+
+  m = manifest.SyncManifest(root)
+  assert m.get(os.path.join(root, 'b.flac')) is not None
+  assert m.get(os.path.join(root, 'c.flac')) is None
+  m.close()
@@ -0,0 +1,259 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+from euphonogenizer import albumart
+from euphonogenizer import common
+from euphonogenizer import euphonogenizer
+from euphonogenizer import fastcopy
+from euphonogenizer import manifest
+from euphonogenizer import mtags
+from euphonogenizer.args import parser
+
+from mutagen import File
+from mutagen.easymp4 import EasyMP4Tags
+from PIL import Image
+
+import errno
+import os
+import pytest
+
+
+# A silent MPEG-1 Layer III frame (128 kbps, 44.1 kHz), which is all mutagen
+# needs to see to open a file as an MP3.
+mp3_frame = b'\xff\xfb\x90\x64' + b'\x00' * 413
+
+track = {
+    '@': 'in.mp3',
+    'ARTIST': ['Artist', 'Featured Artist'],
+    'ALBUM': 'Album',
+    'TITLE': 'Title',
+    'DATE': '2001',
+    'TRACKNUMBER': '03',
+    'TOTALTRACKS': '12',
+    'DISCNUMBER': '1',
+    'PUBLISHER': 'Label',
+}
+
+
+class Formatter(object):
+  def format(self, track, pattern):
+    return pattern
+
+
+class CopyFormatter(object):
+  # Every track is an MP3.
+  def format(self, track, pattern):
+    return pattern.replace('$ext(%filename_ext%)', 'mp3')
+
+
+@pytest.fixture
+def handler():
+  args = parser.parse_args(
+      ['copy', '--to', 'out', '--write-file-metadata', '--update-metadata'])
+  formatter = Formatter()
+  return euphonogenizer.MutagenFileMetadataHandler(args, formatter, formatter)
+
+
+def write_mp3(path):
+  with open(path, 'wb') as f:
+    f.write(mp3_frame * 20)
+
+
+@pytest.fixture
+def mp3(tmp_path, handler):
+  path = str(tmp_path / 'out.mp3')
+  write_mp3(path)
+  mutagen_file = File(path, easy=True)
+  handler.handle_metadata(path, mutagen_file, track, True, False)
+  mutagen_file.save()
+  return path
+
+
+def test_unchanged_mp3(handler, mp3):
+  mutagen_file = File(mp3, easy=True)
+  assert mutagen_file['tracknumber'] == ['03/12']
+  assert not handler.has_metadata_changed(mutagen_file, track, True)
+
+
+@pytest.mark.parametrize('changes', [
+    {'TITLE': 'Another Title'},
+    {'ARTIST': 'Artist'},
+    {'TOTALTRACKS': '13'},
+    {'DISCNUMBER': '2'},
+    {'GENRE': 'Rock'},
+])
+def test_changed_mp3(handler, mp3, changes):
+  mutagen_file = File(mp3, easy=True)
+  assert handler.has_metadata_changed(
+      mutagen_file, dict(track, **changes), True)
+
+
+@pytest.mark.parametrize('field', ['COMMENT', 'MYFIELD'])
+def test_changed_custom_field(handler, tmp_path, field):
+  path = str(tmp_path / 'custom.mp3')
+  write_mp3(path)
+  before = dict(track, **{field: 'c1'})
+  handler.handle_metadata(path, None, before, True, False)
+
+  mutagen_file = File(path, easy=True)
+  assert not handler.has_metadata_changed(mutagen_file, before, True)
+  assert handler.has_metadata_changed(
+      mutagen_file, dict(track, **{field: 'c2'}), True)
+
+
+def test_removed_field(handler, mp3):
+  mutagen_file = File(mp3, easy=True)
+  smaller = dict(track)
+  del smaller['DATE']
+  assert handler.has_metadata_changed(mutagen_file, smaller, True)
+
+
+class FakeMP4(object):
+  def __init__(self):
+    self.tags = EasyMP4Tags()
+
+
+def test_mp4_track_numbers(handler):
+  # MP4 keeps track numbers as integers, so the leading zero doesn't survive.
+  mutagen_file = FakeMP4()
+  mutagen_file.tags['tracknumber'] = '3/12'
+  mutagen_file.tags['title'] = 'Title'
+  simple = {'@': 'in.m4a', 'TITLE': 'Title', 'TRACKNUMBER': '03',
+            'TOTALTRACKS': '12'}
+  assert not handler.has_complex_metadata_changed(mutagen_file, simple)
+  assert handler.has_complex_metadata_changed(
+      mutagen_file, dict(simple, TOTALTRACKS='11'))
+
+
+def test_embed_only_changes_once(mp3, tmp_path):
+  cover = str(tmp_path / 'front.png')
+  Image.new('RGB', (4, 4)).save(cover)
+  other = str(tmp_path / 'back.png')
+  Image.new('RGB', (8, 8)).save(other)
+
+  assert albumart.embed(cover, mp3)
+  assert not albumart.embed(cover, mp3)
+  assert albumart.embed(other, mp3)
+
+
+def test_tags_written_in_place(handler, tmp_path):
+  path = str(tmp_path / 'out.mp3')
+  write_mp3(path)
+
+  # There's no room for tags in the file at first.
+  handler.handle_metadata(path, None, track, True, False)
+  assert (handler.writes, handler.rewrites) == (1, 1)
+  assert handler.summary() == '1 file tagged (1 rewritten in full)'
+  size = os.path.getsize(path)
+
+  handler.handle_metadata(
+      path, None, dict(track, TITLE='A Somewhat Longer Title'), False, False)
+  assert (handler.writes, handler.rewrites) == (2, 1)
+  assert os.path.getsize(path) == size
+  assert File(path, easy=True)['title'] == ['A Somewhat Longer Title']
+
+  comment = 'x' * (2 * euphonogenizer.default_padding)
+  handler.handle_metadata(
+      path, None, dict(track, COMMENT=comment), False, False)
+  assert (handler.writes, handler.rewrites) == (3, 2)
+  assert handler.summary() == '3 files tagged (2 rewritten in full)'
+
+
+class PaddingInfo(object):
+  def __init__(self, padding):
+    self.padding = padding
+
+
+@pytest.mark.parametrize('argv,padding', [
+    ([], euphonogenizer.default_padding),
+    (['--padding', '0'], 0),
+])
+def test_choose_padding(argv, padding):
+  args = parser.parse_args(['copy', '--to', 'out'] + argv)
+  handler = euphonogenizer.MutagenFileMetadataHandler(args)
+  assert handler.choose_padding(PaddingInfo(100)) == 100
+  assert handler.rewrites == 0
+  assert handler.choose_padding(PaddingInfo(-100)) == padding
+  assert handler.rewrites == 1
+
+
+@pytest.mark.parametrize('link', ['hard', 'sym'])
+def test_links_arent_written_through(
+    tmp_path, monkeypatch, capsysbinary, link):
+  monkeypatch.chdir(tmp_path)
+  write_mp3('in.mp3')
+  mtags.TagsFile([track]).write('!.tags')
+  with open('in.mp3', 'rb') as f:
+    original = f.read()
+
+  formatter = CopyFormatter()
+  for argv in (['--link', link], ['--write-file-metadata', '--update-metadata']):
+    args = parser.parse_args(['copy', '--to', 'out', '-q'] + argv)
+    euphonogenizer.CopyCommand(args, formatter, formatter).run()
+    common.set_output(None)
+
+  with open('in.mp3', 'rb') as f:
+    assert f.read() == original
+  assert not os.path.islink('out.mp3')
+  assert not os.path.samefile('in.mp3', 'out.mp3')
+  assert File('out.mp3', easy=True)['title'] == ['Title']
+
+
+@pytest.mark.parametrize('argv', [[], ['--io-jobs', '2']])
+def test_unwritten_metadata_isnt_recorded(
+    tmp_path, monkeypatch, capsysbinary, argv):
+  def readonly(self, filename, mutagen_file, is_new_file):
+    raise euphonogenizer.UnwritableMetadataException(filename)
+
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setattr(euphonogenizer.MutagenFileMetadataHandler,
+                      'handle_metadata_write', readonly)
+  write_mp3('in.mp3')
+  mtags.TagsFile([track]).write('!.tags')
+
+  args = parser.parse_args(['copy', '--to', 'out', '-q', '--manifest',
+                            '--write-file-metadata'] + argv)
+  formatter = CopyFormatter()
+  euphonogenizer.CopyCommand(args, formatter, formatter).run()
+  common.set_output(None)
+
+  m = manifest.SyncManifest(str(tmp_path))
+  try:
+    # It was copied, but the tags it should have aren't known to be there.
+    assert m.get('out.mp3')[3] is None
+  finally:
+    m.close()
+
+
+@pytest.mark.parametrize('argv', [[], ['--io-jobs', '2']])
+def test_interrupted_copy_is_copied_again(
+    tmp_path, monkeypatch, capsysbinary, argv):
+  def full(infd, outfd, size):
+    os.write(outfd, b'partial')
+    raise OSError(errno.ENOSPC, 'no space left')
+
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setattr(manifest, 'save_every', 1)
+  write_mp3('in.mp3')
+  mtags.TagsFile([track]).write('!.tags')
+
+  args = parser.parse_args(
+      ['copy', '--to', 'out', '-q', '--manifest'] + argv)
+  formatter = CopyFormatter()
+  with monkeypatch.context() as patched:
+    patched.setattr(fastcopy, 'kernel_methods', [('full', full)])
+    with pytest.raises(OSError):
+      euphonogenizer.CopyCommand(args, formatter, formatter).run()
+
+  assert not os.path.exists('out.mp3')
+  m = manifest.SyncManifest(str(tmp_path))
+  try:
+    assert m.get('out.mp3') is None
+  finally:
+    m.close()
+
+  euphonogenizer.CopyCommand(args, formatter, formatter).run()
+  common.set_output(None)
+
+  assert os.path.getsize('out.mp3') == os.path.getsize('in.mp3')
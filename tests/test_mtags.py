@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+from euphonogenizer import mtags
+
+import codecs
+import json
+import os
+import pytest
+
+album = [
+    {
+      "@" : "01. This.flac",
+      "ALBUM" : "See What You Started by Continuing (Deluxe Edition)",
+      "ARTIST" : "Collective Soul",
+      "GENRE" : ["Rock", "Alternative"],
+      "TITLE" : "This",
+      "TRACKNUMBER" : "01",
+    },
+    {
+      "@" : "02. Hymn for My Father.flac",
+      "ALBUM" : "See What You Started by Continuing (Deluxe Edition)",
+      "ARTIST" : "Collective Soul",
+      "COMMENT" : "Tab\there, \"quoted\", back\\slash, é \x7f\x01",
+      "TITLE" : "Hymn for My Father",
+      "TRACKNUMBER" : "02",
+    },
+    {
+      "@" : "03. Without Me.flac",
+      "ALBUM" : "See What You Started by Continuing (Deluxe Edition)",
+      "ARTIST" : "Collective Soul",
+      "TITLE" : "Without Me",
+      "TRACKNUMBER" : "03",
+    },
+]
+
+
+def available_backends():
+  backends = []
+  for name in mtags.json_backend_preference:
+    try:
+      mtags.json_backend_loaders[name]()
+      backends.append(name)
+    except ImportError:
+      pass
+  return backends
+
+
+@pytest.fixture(params=available_backends())
+def backend(request):
+  yield mtags.set_json_backend(request.param)
+  mtags.set_json_backend()
+
+
+def reference_bytes(tracks):
+  # This is how tags files were written before backends were pluggable.
+  text = json.dumps(mtags.TagsFile(tracks).desaturate(), ensure_ascii=False,
+      sort_keys=True, indent=3, separators=(',', ' : '))
+  return codecs.BOM_UTF8 + text.encode('utf-8') + b'\n'
+
+
+@pytest.mark.parametrize('tracks', [
+    album,
+    album[:1],
+    [],
+    [{}],
+    [{}, {"A" : "1"}, {}],
+    [{"A" : []}],
+    [{"A" : 1, "B" : ["x", 2]}],
+])
+def test_write_is_byte_identical(backend, tracks, tmp_path):
+  filename = str(tmp_path / '!.tags')
+  mtags.TagsFile(tracks).write(filename)
+
+  with open(filename, 'rb') as f:
+    assert f.read() == reference_bytes(tracks)
+
+
+def test_round_trip(backend, tmp_path):
+  filename = str(tmp_path / '!.tags')
+  mtags.TagsFile(album).write(filename)
+  assert mtags.TagsFile(filename).tracks == album
+
+
+def test_read_without_bom(backend, tmp_path):
+  filename = str(tmp_path / '!.tags')
+  with open(filename, 'wb') as f:
+    f.write(json.dumps(
+        mtags.TagsFile(album).desaturate(), ensure_ascii=False).encode('utf-8'))
+  assert mtags.TagsFile(filename).tracks == album
+
+
+def test_write_only_if_changed(tmp_path):
+  filename = str(tmp_path / '!.tags')
+  assert mtags.TagsFile(album).write(filename, only_if_changed=True)
+
+  with open(filename, 'rb') as f:
+    assert f.read() == reference_bytes(album)
+
+  os.utime(filename, (0, 0))
+  assert not mtags.TagsFile(album).write(filename, only_if_changed=True)
+  assert os.path.getmtime(filename) == 0
+
+  assert mtags.TagsFile(album[:2]).write(filename, only_if_changed=True)
+  assert os.path.getmtime(filename) != 0
+  assert mtags.TagsFile(filename).tracks == album[:2]
+  assert os.listdir(str(tmp_path)) == ['!.tags']
+
+
+def test_count_tracks(backend, tmp_path):
+  filename = str(tmp_path / '!.tags')
+  mtags.TagsFile(album).write(filename)
+  assert mtags.count_tracks(filename) == len(album)
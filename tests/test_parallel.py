@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+from euphonogenizer import common
+from euphonogenizer import euphonogenizer
+from euphonogenizer import mtags
+from euphonogenizer import parallel
+from euphonogenizer import titleformat
+from euphonogenizer.args import parser
+
+import multiprocessing
+import os
+import pytest
+import threading
+import time
+
+
+class Formatter(object):
+  # Workers are handed the formatter, so this has to be picklable.
+  def format(self, track, pattern):
+    return str(titleformat.format(pattern, track))
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+  for artist in range(4):
+    for album in range(3):
+      dirpath = tmp_path / ('Artist %d' % artist) / ('Album %d' % album)
+      dirpath.mkdir(parents=True)
+      mtags.TagsFile([{
+          '@': '%02d.flac' % n,
+          'ARTIST': 'Artist %d' % artist,
+          'ALBUM': 'Album %d' % (album % 2),
+          'TITLE': 'Song %d' % (n % 4),
+          'TRACKNUMBER': str(n),
+      } for n in range(1, 8)]).write(str(dirpath / '!.tags'))
+  monkeypatch.chdir(tmp_path)
+
+
+def run_list(capsysbinary, argv):
+  args = parser.parse_args(['list'] + argv)
+  formatter = Formatter()
+  euphonogenizer.ListCommand(args, formatter, formatter).run()
+  common.set_output(None)
+  return capsysbinary.readouterr().out
+
+
+@pytest.mark.parametrize('argv', [
+    [],
+    ['--limit', '30'],
+    ['--unique', '--display', '%title%'],
+    ['--groupby', '%album%', '--display', '%artist% %title%', '--unique'],
+    ['--contains', 'Song 2', '--limit', '50'],
+    ['--sort-by-descending', '%tracknumber%', '--format', 'csv',
+     '--column', 'artist=%artist%', '--column', 'title=%title%'],
+])
+def test_parallel_output_is_identical(library, capsysbinary, argv):
+  serial = run_list(capsysbinary, argv)
+  assert serial
+  assert run_list(capsysbinary, argv + ['--jobs', '3']) == serial
+
+
+def square(n):
+  return n * n
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_staged_pipeline(jobs):
+  copied = []
+  done = []
+  in_flight = [0]
+  most_in_flight = [0]
+  lock = threading.Lock()
+
+  def first_stage(n):
+    with lock:
+      in_flight[0] += 1
+      most_in_flight[0] = max(most_in_flight[0], in_flight[0])
+    # Later work finishes its first stage sooner, to shake up the order.
+    time.sleep(0.002 * (n % 3))
+    copied.append(n)
+
+  def on_done(n, result):
+    with lock:
+      in_flight[0] -= 1
+    done.append((n, result))
+
+  pool = multiprocessing.Pool(2) if jobs > 1 else None
+  try:
+    with parallel.StagedPipeline(
+        3, first_stage, square, on_done, pool, jobs, max_in_flight=4) as p:
+      for n in range(20):
+        p.submit(n, n)
+      p.submit(20)
+  finally:
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+
+  assert sorted(copied) == list(range(21))
+  assert done == [(n, n * n) for n in range(20)]
+  assert most_in_flight[0] <= 4
@@ -0,0 +1,43 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+from euphonogenizer import rows
+
+import json
+import pytest
+
+
+values = [u'Sigur Rós', u'Hoppípolla, "live"', u'1\t2']
+
+
+def test_jsonl():
+  writer = rows.create_writer('jsonl', ['artist', 'title', 'tabbed'])
+  assert writer.header() is None
+  assert json.loads(writer.format_row(values)) == {
+      'artist': values[0], 'title': values[1], 'tabbed': values[2]}
+
+
+def test_csv_and_tsv():
+  writer = rows.create_writer('csv', ['artist', 'title', 'tabbed'])
+  assert writer.header() == 'artist,title,tabbed'
+  assert writer.format_row(values) == (
+      u'Sigur Rós,"Hoppípolla, ""live""",1\t2')
+
+  writer = rows.create_writer('tsv', ['artist', 'title', 'tabbed'])
+  assert writer.header() == 'artist\ttitle\ttabbed'
+  assert writer.format_row(values) == (
+      u'Sigur Rós\t"Hoppípolla, ""live"""\t"1\t2"')
+
+
+def test_parse_column():
+  assert rows.parse_column('album=%album% (%date%)') == (
+      'album', '%album% (%date%)')
+  assert rows.parse_column('eq==') == ('eq', '=')
+  with pytest.raises(ValueError):
+    rows.parse_column('%album%')
+  with pytest.raises(ValueError):
+    rows.parse_column('=%album%')
+  assert rows.parse_column('date=%date%', ['album']) == ('date', '%date%')
+  with pytest.raises(ValueError):
+    rows.parse_column('album=%album%', ['date', 'album'])
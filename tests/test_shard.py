@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+from euphonogenizer import common
+from euphonogenizer import euphonogenizer
+from euphonogenizer import shard
+from euphonogenizer import walk
+from euphonogenizer.args import parser
+
+from tests.test_parallel import Formatter, library
+
+import os
+import pytest
+
+
+def test_parse_shard():
+  assert shard.parse_shard('2/5') == (2, 5)
+  for bad in ['0/2', '3/2', '1', 'a/b', '1/0']:
+    with pytest.raises(ValueError):
+      shard.parse_shard(bad)
+
+
+def test_shard_of_is_stable():
+  # This can never change, or shards from different versions won't merge.
+  assert [shard.shard_of(each, 4) for each in ['', 'a', 'a/b', u'Björk']] \
+      == [1, 4, 1, 3]
+
+
+def test_filter_splits_the_walk(tmp_path):
+  for each in ['a/x', 'a/y', 'b', 'c/z/w']:
+    (tmp_path / each).mkdir(parents=True)
+  top = str(tmp_path)
+
+  everything = [dirpath for dirpath, dirs, files in walk.walk(top)]
+  keys = {}
+  found = []
+  for k in (1, 2, 3):
+    found.extend((keys[dirpath], dirpath) for dirpath, dirs, files in
+                 shard.ShardFilter(walk.walk(top), top, k, 3, keys))
+
+  assert [dirpath for key, dirpath in sorted(found)] == everything
+
+
+def test_check_headers():
+  header = {'cmd': 'list', 'unique': False}
+  shard.check_headers([dict(header, shard=[k, 2]) for k in (2, 1)])
+
+  with pytest.raises(ValueError):
+    shard.check_headers([dict(header, shard=[1, 2])])
+  with pytest.raises(ValueError):
+    shard.check_headers([dict(header, shard=[1, 2]),
+                         dict(header, shard=[2, 2], unique=True)])
+
+
+def test_read_records(tmp_path):
+  filename = str(tmp_path / 'shard')
+  with open(filename, 'wb') as f:
+    f.write(b'{"shard": [1, 2]}\n\n{"count": 3}\n')
+
+  header, records = shard.read_records(filename)
+  assert header == {'shard': [1, 2]}
+  assert list(records) == [{'count': 3}]
+
+  with open(filename, 'wb') as f:
+    f.write(b'{"count": 3}\n')
+  with pytest.raises(ValueError):
+    shard.read_records(filename)
+
+
+def test_stats_cant_be_sharded():
+  with pytest.raises(SystemExit):
+    parser.parse_args(['stats', '--shard', '1/2'])
+
+
+def run(capsysbinary, command_class, argv):
+  args = parser.parse_args(argv)
+  formatter = Formatter()
+  command_class(args, formatter, formatter).run()
+  common.set_output(None)
+  return capsysbinary.readouterr().out
+
+
+@pytest.mark.parametrize('argv', [
+    ['list'],
+    ['list', '--groupby', '%album%', '--display', '%title%', '--unique'],
+    ['count', '--unique', '--display', '%title%'],
+    ['count', '--contains', '3'],
+])
+def test_merged_shards_match_a_single_run(
+    library, tmp_path, capsysbinary, argv):
+  command_class = {
+      'list': euphonogenizer.ListCommand,
+      'count': euphonogenizer.CountCommand,
+  }[argv[0]]
+  single = run(capsysbinary, command_class, argv)
+
+  files = []
+  for k in (1, 2, 3):
+    filename = str(tmp_path / ('shard%d' % k))
+    with open(filename, 'wb') as f:
+      f.write(run(capsysbinary, command_class,
+                  argv + ['--shard', '%d/3' % k, '--mergeable']))
+    files.append(filename)
+
+  merged = run(capsysbinary, euphonogenizer.MergeCommand, ['merge'] + files)
+  assert merged == single
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+from euphonogenizer import common
+from euphonogenizer import euphonogenizer
+from euphonogenizer import stats
+from euphonogenizer.args import parser
+
+from tests.test_parallel import Formatter, library
+
+import pytest
+
+
+def test_to_number():
+  assert stats.to_number('42') == 42
+  assert stats.to_number('3.5') == 3.5
+  assert stats.to_number('320 kbps') == 320
+  assert stats.to_number('') == 0
+  assert stats.to_number('n/a') == 0
+
+
+def test_aggregate_by_group():
+  aggregator = stats.Aggregator(distinct_count=1, sum_count=2)
+  aggregator.add('B', ['x'], ['1', '0.5'])
+  aggregator.add('A', ['x'], ['2', '1'])
+  aggregator.add('B', ['y'], ['3', '0.25'])
+  aggregator.add('B', ['x'], ['4', '0'])
+
+  assert list(aggregator.results()) == [
+      ('B', 3, [2], [8, 0.75]),
+      ('A', 1, [1], [2, 1]),
+  ]
+
+
+def test_empty_group():
+  aggregator = stats.Aggregator(distinct_count=1, sum_count=1)
+  aggregator.add_group(None)
+  assert list(aggregator.results()) == [(None, 0, [0], [0])]
+
+
+
+@pytest.mark.parametrize('argv,expected', [
+    (['--equals', 'nothing'],
+     ['tracks: 0', '%album%: 0 distinct', '%tracknumber%: 0 total']),
+    ([], ['tracks: 84', '%album%: 2 distinct', '%tracknumber%: 336 total']),
+])
+def test_ungrouped_stats(library, capsysbinary, argv, expected):
+  args = parser.parse_args(['stats', '--distinct', '%album%',
+                            '--sum', '%tracknumber%'] + argv)
+  formatter = Formatter()
+  euphonogenizer.StatsCommand(args, formatter, formatter).run()
+  common.set_output(None)
+  assert capsysbinary.readouterr().out.decode().splitlines() == expected
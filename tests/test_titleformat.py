@@ -1613,6 +1613,54 @@ class TestTitleformat_KnownValues:
     assert not result_ascii.truth
 
 
+class CountingFormatter(object):
+  def __init__(self):
+    self.calls = 0
+
+  def format(self, track, pattern):
+    self.calls += 1
+    return str(titleformat.format(pattern, track))
+
+
+def test_memoizing_formatter():
+  counting = CountingFormatter()
+  memo = titleformat.MemoizingFormatter(counting)
+  tracks = [dict(cs_01, TITLE=title, ALBUM=album)
+            for album in ('One', 'Two') for title in ('A', 'B', 'C')]
+
+  for pattern in ('front.jpg', '%album%.jpg', '%title%.jpg'):
+    counting.calls = 0
+    for track in tracks:
+      assert memo.format(track, pattern) == counting.format(track, pattern)
+    # Every track above was formatted twice, but only once by the memo.
+    assert counting.calls == len(tracks) + {
+        'front.jpg': 1, '%album%.jpg': 2, '%title%.jpg': 3}[pattern]
+
+
+def test_memoizing_formatter_conditions():
+  memo = titleformat.MemoizingFormatter(CountingFormatter())
+  pattern = '$if(%discnumber%,%album% %discnumber%,%title%)'
+  for track, expected in [
+      ({'ALBUM': 'Album', 'TITLE': 'A', 'DISCNUMBER': '1'}, 'Album 1'),
+      ({'ALBUM': 'Album', 'TITLE': 'B', 'DISCNUMBER': '1'}, 'Album 1'),
+      ({'ALBUM': 'Album', 'TITLE': 'A'}, 'A'),
+      ({'ALBUM': 'Other', 'TITLE': 'A'}, 'A'),
+      ({'ALBUM': 'Other', 'TITLE': 'A', 'DISCNUMBER': '2'}, 'Other 2'),
+  ]:
+    assert memo.format(track, pattern) == expected
+
+
+class WholeTrackFormatter(object):
+  def format(self, track, pattern):
+    return ','.join(sorted(track))
+
+
+def test_memoizing_formatter_whole_track():
+  memo = titleformat.MemoizingFormatter(WholeTrackFormatter())
+  assert memo.format({'A': '1'}, 'x') == 'A'
+  assert memo.format({'B': '1'}, 'x') == 'B'
+
+
 def run_tests():
   ttf = TestTitleformat_KnownValues()
   for t in test_eval_cases:
@@ -0,0 +1,26 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+from euphonogenizer import unique
+
+import pytest
+
+
+@pytest.mark.parametrize('max_memory', [None, 0, 1000])
+def test_unique_keys(max_memory):
+  store = unique.UniqueKeyStore(max_memory)
+  keys = ['track %d' % (n % 37) for n in range(200)]
+
+  assert [key for key in keys if store.add(key)] == keys[:37]
+  assert len(store) == 37
+  assert ('track 5',) in store
+  assert ('track 99',) not in store
+  store.close()
+
+
+def test_parts_are_kept_apart():
+  store = unique.UniqueKeyStore()
+  assert store.add('ab', 'c')
+  assert store.add('a', 'bc')
+  assert not store.add('a', 'bc')
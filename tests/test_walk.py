@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+from euphonogenizer import euphonogenizer
+from euphonogenizer import walk
+from euphonogenizer.args import parser
+
+from tests.test_parallel import Formatter
+
+import glob
+import os
+import pytest
+
+
+@pytest.fixture
+def library(tmp_path):
+  for each in [
+      'A/Album 1/!.tags',
+      'A/Album 1/01.flac',
+      'A/Album 1/Artwork/front.jpg',
+      'A/Album 2/!.tags',
+      'A/@eaDir/01.flac@SynoEAStream',
+      'B/.git/config',
+      'B/!.tags',
+      'top.txt',
+  ]:
+    path = tmp_path.joinpath(*each.split('/'))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'')
+  return str(tmp_path)
+
+
+def relative_tree(top, walked):
+  return [(os.path.relpath(dirpath, top), dirs, files)
+          for dirpath, dirs, files in walked]
+
+
+def names(walked):
+  for dirpath, dirs, files in walked:
+    yield dirpath, [each.name for each in dirs], [each.name for each in files]
+
+
+def test_same_as_os_walk(library):
+  assert (relative_tree(library, names(walk.walk(library)))
+          == relative_tree(library, os.walk(library)))
+
+
+def test_exclude_prunes_by_name_and_path(library):
+  tree = relative_tree(library, names(walk.walk(
+      library, exclude=['@eaDir', 'A/Album 1/Artwork', '*.txt'])))
+  dirpaths = [each[0] for each in tree]
+  assert os.path.join('A', '@eaDir') not in dirpaths
+  assert os.path.join('A', 'Album 1', 'Artwork') not in dirpaths
+  assert os.path.join('A', 'Album 2') in dirpaths
+  assert 'top.txt' not in dict((d, f) for d, s, f in tree)['.']
+
+
+def test_max_depth_and_hidden(library):
+  tree = relative_tree(library, names(walk.walk(library, max_depth=1)))
+  assert sorted(each[0] for each in tree) == ['.', 'A', 'B']
+
+  tree = relative_tree(library, names(walk.walk(library, skip_hidden=True)))
+  assert os.path.join('B', '.git') not in [each[0] for each in tree]
+  assert '.git' not in dict((d, s) for d, s, f in tree)['B']
+
+
+@pytest.fixture
+def covers(tmp_path):
+  for each in [
+      'Album [Deluxe]/01.flac',
+      'Album [Deluxe]/Front.JPG',
+      'Album [Deluxe]/folder1.jpg',
+      'Album [Deluxe]/folder2.jpg',
+      'Album [Deluxe]/.folder.jpg',
+      'Album [Deluxe]/cover [big].jpg',
+      'Album [Deluxe]/artwork/front.png',
+      'override.png',
+  ]:
+    path = tmp_path.joinpath(*each.split('/'))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'')
+  return str(tmp_path / 'Album [Deluxe]')
+
+
+@pytest.mark.parametrize('dirname,pattern', [
+    ('', 'Front.JPG'),
+    ('', 'front.jpg'),
+    ('', 'missing.jpg'),
+    ('', 'folder*.jpg'),
+    ('', '.folder*.jpg'),
+    ('', '*.jpg'),
+    ('', 'cover [[]big[]].jpg'),
+    ('artwork', 'front.png'),
+    ('missing', 'front.png'),
+    ('missing', '*.png'),
+    (os.pardir, 'override.png'),
+    (os.pardir, '*'),
+])
+def test_listing_cache_globs_like_glob(covers, dirname, pattern):
+  dirname = os.path.join(covers, dirname) if dirname else covers
+  expected = glob.glob(os.path.join(glob.escape(dirname), pattern))
+  assert walk.ListingCache().glob(dirname, pattern) == expected
+
+
+def test_listing_cache_lists_once(covers, monkeypatch):
+  listed = []
+
+  def scandir(path):
+    listed.append(path)
+    return os.scandir(path)
+
+  monkeypatch.setattr(walk, 'scandir', scandir)
+
+  listings = walk.ListingCache()
+  for pattern in ['front.jpg', 'cover.jpg', 'folder*.jpg', '*.png']:
+    listings.glob(covers, pattern)
+  assert listings.isfile(os.path.join(covers, 'folder1.jpg'))
+  assert not listings.isfile(os.path.join(covers, 'artwork'))
+  assert listed == [covers]
+
+
+def test_listing_cache_is_bounded(tmp_path, monkeypatch):
+  listed = []
+
+  def scandir(path):
+    listed.append(os.path.basename(path))
+    return os.scandir(path)
+
+  monkeypatch.setattr(walk, 'scandir', scandir)
+
+  for name in 'abc':
+    (tmp_path / name).mkdir()
+  listings = walk.ListingCache(max_listings=2)
+  for name in 'abacab':
+    listings.glob(str(tmp_path / name), '*.jpg')
+  # Only b is listed twice, since it was the least recently used when c came.
+  assert listed == ['a', 'b', 'c', 'b']
+
+
+def test_per_track_cover_search_stays_bounded(tmp_path, monkeypatch):
+  listed = []
+
+  def scandir(path):
+    listed.append(path)
+    return os.scandir(path)
+
+  monkeypatch.setattr(walk, 'scandir', scandir)
+
+  albums = []
+  for n in range(100):
+    album = tmp_path / ('Album %d' % n)
+    album.mkdir()
+    (album / 'front.jpg').write_bytes(b'')
+    albums.append(str(album))
+
+  args = parser.parse_args(['findcovers', '--include-covers', 'front.jpg',
+                            '--per-track-cover-search'])
+  formatter = Formatter()
+  finder = euphonogenizer.CoverArtFinder(args, formatter, formatter)
+  for album in albums:
+    for n in range(5):
+      track = {'@': '%02d.flac' % n}
+      assert finder.find_cover_art(album, track) == os.path.join(
+          album, 'front.jpg')
+
+  # Every track searched, but each album was only listed once, and the first
+  # ones have long since been let go.
+  assert listed == albums
+  finder.find_cover_art(albums[0], {'@': '01.flac'})
+  assert listed == albums + albums[:1]
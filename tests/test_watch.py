@@ -0,0 +1,137 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# vim:ts=2:sw=2:et:ai
+
+from euphonogenizer import index
+from euphonogenizer import mtags
+from euphonogenizer import walk
+from euphonogenizer import watch
+
+import json
+import os
+import pytest
+import select
+import threading
+import time
+
+
+def write_album(root, name, titles):
+  dirpath = os.path.join(root, name)
+  if not os.path.isdir(dirpath):
+    os.makedirs(dirpath)
+  tracks = [{'@': '%02d.flac' % n, 'ALBUM': name, 'TITLE': title}
+            for n, title in enumerate(titles)]
+  mtags.TagsFile(tracks).write(os.path.join(dirpath, '!.tags'))
+  return tracks
+
+
+def ask(daemon, request):
+  client = watch.connect(daemon.socket_path)
+  watch.send_line(client, request)
+  daemon.run_once()
+  answer = [json.loads(line) for line in client.makefile('rb')]
+  client.close()
+  if answer and answer[-1] == watch.end_of_answer:
+    answer.pop()
+  return answer
+
+
+def settle(daemon):
+  deadline = time.time() + 5
+  daemon.run_once()
+  while daemon.pending and time.time() < deadline:
+    daemon.run_once()
+
+
+@pytest.fixture(params=[None, 0], ids=['inotify', 'polling'])
+def daemon(request, tmp_path):
+  if request.param is None:
+    try:
+      watch.InotifyWatcher(str(tmp_path), {}, lambda name: False).close()
+    except watch.WatchUnavailableException:
+      pytest.skip('inotify is not available here')
+
+  root = str(tmp_path / 'library')
+  write_album(root, 'One', ['a', 'b'])
+  library_index = index.LibraryIndex(str(tmp_path / 'index.db'), create=True)
+  daemon = watch.WatchDaemon(
+      library_index, root, '!.tags', str(tmp_path / 'sock'),
+      {'exclude': walk.ExcludeRules()}, poll_interval=request.param)
+  daemon.settle_time = 0
+  daemon.start()
+  yield daemon
+  daemon.stop()
+  library_index.close()
+
+
+def test_daemon_follows_changes(daemon):
+  root = daemon.root
+  assert ask(daemon, {'query': 'status'})[0]['tracks'] == 2
+
+  two = write_album(root, 'Two', ['c'])
+  open(os.path.join(root, 'Two', 'front.jpg'), 'wb').close()
+  settle(daemon)
+
+  assert ask(daemon, {'query': 'covers', 'dir': os.path.join(root, 'Two')}) \
+      == [['front.jpg']]
+  assert ask(daemon, {'query': 'tracks'})[-1] == [os.path.join(root, 'Two'), [two]]
+
+  os.remove(os.path.join(root, 'One', '!.tags'))
+  settle(daemon)
+
+  assert ask(daemon, {'query': 'status'})[0]['tracks'] == 1
+
+
+def test_slow_client_holds_up_nobody(daemon):
+  slow = watch.connect(daemon.socket_path)
+  daemon.run_once()
+  try:
+    assert ask(daemon, {'query': 'status'})[0]['tracks'] == 2
+  finally:
+    slow.close()
+
+
+def test_error_answers_are_raised(daemon):
+  assert 'error' in ask(daemon, {'query': 'nonsense'})[0]
+  assert 'error' in ask(daemon, ['not', 'a', 'request'])[0]
+
+  # query() only connects once it's iterated, and run_once doesn't always wait
+  # for a connection, so this waits until there is one.
+  def accept():
+    select.select([daemon.server], [], [], 5)
+    daemon.run_once()
+
+  accepting = threading.Thread(target=accept)
+  accepting.start()
+  try:
+    with pytest.raises(watch.WatchUnavailableException):
+      list(watch.query(daemon.socket_path, {'query': 'nonsense'}))
+  finally:
+    accepting.join()
+
+
+def test_stale_socket_is_replaced(tmp_path):
+  socket_path = str(tmp_path / 'sock')
+  watch.listen(socket_path).close()
+  assert os.path.exists(socket_path)
+  watch.listen(socket_path).close()
+
+
+def test_cut_off_answers_are_raised(tmp_path):
+  socket_path = str(tmp_path / 'sock')
+  server = watch.listen(socket_path)
+
+  def answer_partly():
+    connection = server.accept()[0]
+    watch.read_line(connection)
+    watch.send_line(connection, ['/music/Album', []])
+    connection.close()
+
+  answering = threading.Thread(target=answer_partly)
+  answering.start()
+  try:
+    with pytest.raises(watch.WatchUnavailableException):
+      list(watch.query(socket_path, {'query': 'tracks'}))
+  finally:
+    answering.join()
+    server.close()